@@ -1,34 +1,146 @@
 from sqlalchemy.future import select
-from sqlalchemy import select, func, desc, update
-from sqlalchemy.orm import joinedload
+from sqlalchemy import (
+    select, func, desc, insert, update, delete, or_, and_, values, column, String, Integer, case, any_, bindparam,
+    cast, extract, literal, literal_column, union_all, table, tuple_, text as sql_text, BigInteger, Date, DateTime,
+)
+from sqlalchemy.orm import joinedload, aliased
+from sqlalchemy.dialects.postgresql import insert as pg_insert, ARRAY
 from db import AsyncSessionLocal
-from db_models import User, Task, Clan, ClanMember, ClanApplication, ClanCreationRequest
+from db_models import (
+    User, Task, TaskArchive, Clan, ClanMember, ClanStats, ClanApplication, ClanCreationRequest,
+    XpEvent, XpDaily, XpRollupCursor,
+)
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from sqlalchemy.orm import selectinload
+from utils.parsing import DEADLINE_FMT, deadline_str_to_dt, scope_bounds
+from utils.scheduler import (
+    REMINDER_SCHEDULES, reminder_scheduler, reminder_stages, next_reminder_at, due_stage, task_deadline_at,
+    stages_passed,
+)
+from utils.cache import TTLCache, VersionedCache
+from utils.leaderboard import LeaderRow, LeaderboardSnapshot
 # --- USER HELPERS ---
 from datetime import datetime, timedelta
 import pytz
 
+# user_id -> detached User row. Every helper that writes a users row must invalidate it.
+user_cache = TTLCache(maxsize=20_000, ttl=120)
+
+
+def _upsert_user_stmt():
+    """
+    Insert the user, or refresh a changed username, and hand back the row, in one statement.
+    The INSERT only gets a source row when the user is missing or their username changed, so a
+    known, unchanged user writes and locks nothing (a read-only commit: no WAL flush) and is read
+    back by the second branch. Built once: constructing this CTE costs more than running it.
+    """
+    uid, name, handle = bindparam("uid", type_=String), bindparam("name", type_=String), bindparam("handle", type_=String)
+    cur = select(User.id, User.username).where(User.id == uid).cte("cur")
+    needed = or_(
+        ~select(cur.c.id).exists(),
+        and_(handle != "", select(cur.c.username).scalar_subquery().is_distinct_from(handle)),
+    )
+    ins = pg_insert(User).from_select(["id", "name", "username"], select(uid, name, handle).where(needed))
+    up = (
+        ins.on_conflict_do_update(
+            index_elements=[User.id],
+            set_={"username": ins.excluded.username},
+            where=and_(ins.excluded.username != "", User.username.is_distinct_from(ins.excluded.username)),
+        )
+        .returning(*User.__table__.c)
+        .cte("up")
+    )
+    row = union_all(
+        select(*up.c),
+        select(*User.__table__.c).where(User.id == uid, ~select(up.c.id).exists()),
+    ).subquery("row")
+    return select(aliased(User, row)).execution_options(populate_existing=True)
+
+
+_UPSERT_USER = _upsert_user_stmt()
+
 
 async def get_or_create_user(user_id: str, name: str = "Unknown", username: str = ""):
+    # known user with an unchanged username: no DB round trip at all
+    cached = user_cache.get(user_id)
+    if cached is not None and (not username or cached.username == username):
+        return cached
+
+    # one round trip (_UPSERT_USER). A row committed by a concurrent first contact after our
+    # snapshot is the one case it can't see; that rare case falls back to a plain SELECT.
     async with AsyncSessionLocal() as session:
-        result = await session.execute(select(User).where(User.id == user_id))
-        user = result.scalar_one_or_none()
-        if not user:
-            user = User(id=user_id, name=name, username=username)
-            session.add(user)
-            await session.commit()
-            await session.refresh(user)
-        else:
-            if username and user.username != username:
-                user.username = username
-                await session.commit()
+        user = (await session.execute(
+            _UPSERT_USER, {"uid": user_id, "name": name, "handle": username or ""}
+        )).scalar_one_or_none()
+        await session.commit()
+        if user is None:
+            user = (await session.execute(select(User).where(User.id == user_id))).scalar_one()
+        user_cache.set(user_id, user)
         return user
 
+# --- write-behind activity (last_active / username) ---
+# user_id -> (last_active, username). Filled per update by touch_user, written by flush_user_activity.
+_activity_buffer: dict[str, tuple[str, str]] = {}
+
+def _now_str(tz_name: str = "Asia/Tashkent") -> str:
+    return datetime.now(pytz.timezone(tz_name)).strftime("%Y-%m-%d %H:%M:%S")
+
+async def touch_user(user_id: str, name: str = "Unknown", username: str = ""):
+    """
+    Per-update entry point for the middleware. Makes sure the users row exists
+    (a query only for users not in user_cache) and records last-seen time and
+    username in memory; flush_user_activity() writes them in one batch.
+    """
+    cached = user_cache.get(user_id)
+    if cached is None:
+        await get_or_create_user(user_id, name=name, username=username)
+    elif username and cached.username != username:
+        cached.username = username   # keep the cached row consistent until the flush lands
+    _activity_buffer[user_id] = (_now_str(), username or "")
+
+async def flush_user_activity() -> int:
+    """
+    Write buffered activity as one UPDATE users ... FROM (VALUES ...) statement.
+    Returns rows flushed. On failure the batch is merged back (newer entries win).
+    """
+    if not _activity_buffer:
+        return 0
+    batch = dict(_activity_buffer)
+    _activity_buffer.clear()
+
+    v = values(
+        column("id", String), column("last_active", String), column("username", String),
+        name="v",
+    ).data([(uid, seen, uname) for uid, (seen, uname) in batch.items()])
+    stmt = (
+        update(User)
+        .where(User.id == v.c.id)
+        .values(
+            last_active=v.c.last_active,
+            username=func.coalesce(func.nullif(v.c.username, ""), User.username),
+        )
+        .execution_options(synchronize_session=False)
+    )
+    try:
+        async with AsyncSessionLocal() as session:
+            await session.execute(stmt)
+            await session.commit()
+    except Exception:
+        for uid, item in batch.items():
+            _activity_buffer.setdefault(uid, item)
+        raise
+    return len(batch)
+
 async def get_user(user_id: str):
+    cached = user_cache.get(user_id)
+    if cached is not None:
+        return cached
     async with AsyncSessionLocal() as session:
         result = await session.execute(select(User).where(User.id == user_id))
-        return result.scalar_one_or_none()
+        user = result.scalar_one_or_none()
+        if user:
+            user_cache.set(user_id, user)
+        return user
 
 async def set_user_title(user_id: str, title: str):
     async with AsyncSessionLocal() as session:
@@ -37,6 +149,7 @@ async def set_user_title(user_id: str, title: str):
         if user:
             user.extra_title = title
             await session.commit()
+        user_cache.invalidate(user_id)
         return user
 
 async def set_user_goal(user_id: str, goal: str):
@@ -46,6 +159,7 @@ async def set_user_goal(user_id: str, goal: str):
         if user:
             user.goal_of_month = goal
             await session.commit()
+        user_cache.invalidate(user_id)
         return user
 
 async def set_user_about(user_id: str, about: str):
@@ -55,6 +169,7 @@ async def set_user_about(user_id: str, about: str):
         if user:
             user.about_me = about
             await session.commit()
+        user_cache.invalidate(user_id)
         return user
 
 async def update_xp_streak_completed(user_id: str, xp_delta=0, streak_delta=0, completed_delta=0):
@@ -62,10 +177,16 @@ async def update_xp_streak_completed(user_id: str, xp_delta=0, streak_delta=0, c
         result = await session.execute(select(User).where(User.id == user_id))
         user = result.scalar_one_or_none()
         if user:
-            user.xp = max(0, user.xp + xp_delta)
+            old_xp = user.xp or 0
+            user.xp = max(0, old_xp + xp_delta)
             user.streak = max(0, user.streak + streak_delta)
             user.completed = max(0, user.completed + completed_delta)
+            await session.flush()
+            await _clan_stats_add_xp(session, user_id, user.xp - old_xp)
+            await _log_xp(session, user_id, user.xp - old_xp, "admin")
             await session.commit()
+        user_cache.invalidate(user_id)
+        leaderboard.note_xp(user_id, xp_delta)
         return user
 
 async def count_users():
@@ -75,41 +196,159 @@ async def count_users():
 
 
 async def get_user_by_id(user_id: str):
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(select(User).where(User.id == user_id))
-        return result.scalar_one_or_none()
+    return await get_user(user_id)
 
 # --- TASK HELPERS ---
 
+# user_id -> that user's pending tasks in list order. Every helper that writes task rows
+# bumps the user's version (reminder bookkeeping excepted: it is never displayed).
+task_cache = VersionedCache(maxsize=20_000, ttl=120)
+
+def _with_deadline_at(kwargs: dict) -> dict:
+    """Fill deadline_at / next_reminder_at for new rows when callers pass the legacy string."""
+    if "deadline" in kwargs and "deadline_at" not in kwargs:
+        kwargs["deadline_at"] = deadline_str_to_dt(kwargs["deadline"])
+    kwargs["next_reminder_at"] = next_reminder_at(
+        kwargs.get("deadline_at"), kwargs.get("reminders_sent", 0), kwargs.get("priority")
+    )
+    if kwargs.get("repeat") in REPEAT_KINDS and kwargs.get("deadline_at"):
+        # first instance of a series (see RECURRENCE below)
+        kwargs.setdefault("repeat_anchor_at", kwargs["deadline_at"])
+        kwargs["next_occurrence_at"] = kwargs["deadline_at"]
+    return kwargs
+
+def _sync_next_reminder(task: Task):
+    """Recompute task.next_reminder_at after its deadline, priority or status changed."""
+    if (task.status or "pending") != "pending":
+        task.next_reminder_at = None
+    else:
+        task.next_reminder_at = next_reminder_at(task_deadline_at(task), task.reminders_sent, task.priority)
+
+def _deadline_between(start: datetime, end: datetime):
+    """
+    deadline in [start, end]: BETWEEN on deadline_at, or on the legacy string for rows
+    not yet backfilled (its fixed 'YYYY-MM-DD HH:MM' format sorts chronologically).
+    """
+    return or_(
+        Task.deadline_at.between(start, end),
+        and_(
+            Task.deadline_at.is_(None),
+            Task.deadline.between(start.strftime(DEADLINE_FMT), end.strftime(DEADLINE_FMT)),
+        ),
+    )
+
 async def add_task(user_id: str, text: str, **kwargs):
     async with AsyncSessionLocal() as session:
-        task = Task(user_id=user_id, text=text, **kwargs)
+        task = Task(user_id=user_id, text=text, **_with_deadline_at(kwargs))
         session.add(task)
         await session.commit()
         await session.refresh(task)
+        reminder_scheduler.schedule_task(task)
+        task_cache.bump(user_id)
         return task
 
-async def add_tasks_bulk(user_id: str, texts: list[str], **kwargs):
+# Max pending tasks per user: add_tasks_bulk trims pastes to it, _roll_series won't add past it.
+PENDING_TASK_LIMIT = 10
+
+async def count_pending_tasks(user_id: str) -> int:
     async with AsyncSessionLocal() as session:
-        tasks = [Task(user_id=user_id, text=text, **kwargs) for text in texts]
-        session.add_all(tasks)
-        await session.commit()
-        return tasks
+        result = await session.execute(
+            select(func.count()).select_from(Task).where(Task.user_id == user_id, Task.status == "pending")
+        )
+        return result.scalar_one()
+
+async def add_tasks_bulk(user_id: str, texts: list[str], limit: int | None = None, **kwargs):
+    """
+    Insert `texts` as tasks sharing the same fields (deadline=..., priority=...) with one
+    multi-row INSERT ... RETURNING. With `limit`, the users row is locked FOR UPDATE first and
+    only as many tasks as still fit under `limit` pending ones are inserted, so concurrent
+    pastes can't overshoot the cap. Returns the inserted tasks.
+    """
+    fields = _with_deadline_at(kwargs)
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            if limit is not None:
+                await session.execute(select(User.id).where(User.id == user_id).with_for_update())
+                pending = (await session.execute(
+                    select(func.count()).select_from(Task).where(Task.user_id == user_id, Task.status == "pending")
+                )).scalar_one()
+                texts = texts[:max(0, limit - pending)]
+            if not texts:
+                return []
+            result = await session.scalars(
+                insert(Task).returning(Task),
+                [{"user_id": user_id, "text": text, **fields} for text in texts],
+            )
+            tasks = result.all()
+    for task in tasks:
+        reminder_scheduler.schedule_task(task)
+    task_cache.bump(user_id)
+    return tasks
+
+# deadline first (undated last), then creation order
+_TASK_LIST_ORDER = (Task.deadline_at.asc().nulls_last(), Task.deadline.asc().nulls_last(), Task.created_at.asc())
 
 async def get_tasks(user_id: str, status: str = "pending"):
     async with AsyncSessionLocal() as session:
         result = await session.execute(
-            select(Task).where(Task.user_id == user_id, Task.status == status)
+            select(Task)
+            .where(Task.user_id == user_id, Task.status == status)
+            .order_by(*_TASK_LIST_ORDER)
         )
         return result.scalars().all()
 
+async def get_tasks_cached(user_id: str):
+    """get_tasks(user_id) served from task_cache until one of the user's tasks changes."""
+    tasks = task_cache.get(user_id)
+    if tasks is None:
+        version = task_cache.version(user_id)
+        tasks = await get_tasks(user_id)
+        task_cache.set(user_id, tasks, version)
+    return tasks
+
+REPEAT_KINDS = ("daily", "weekly", "monthly")
+
+def _scope_filter(scope: str, tz_name: str = "Asia/Tashkent"):
+    """WHERE clause for a list scope: today/week/month range, repeating, or None for all."""
+    if scope == "repeating":
+        return Task.repeat.in_(REPEAT_KINDS)
+    bounds = scope_bounds(scope, tz_name=tz_name)
+    return _deadline_between(*bounds) if bounds else None
+
+async def get_tasks_filtered(
+    user_id: str,
+    scope: str = "all",
+    order: str = "deadline",
+    status: str = "pending",
+    tz_name: str = "Asia/Tashkent",
+):
+    """
+    Tasks for one list scope ('today' | 'week' | 'month' | 'repeating' | 'all').
+    Date scopes are bounded once and range-scanned on (user_id, status, deadline_at).
+    order='deadline': deadline NULLS LAST, then created_at; order='created': creation order.
+    """
+    conds = [Task.user_id == user_id, Task.status == status]
+    scope_cond = _scope_filter(scope, tz_name)
+    if scope_cond is not None:
+        conds.append(scope_cond)
+    order_by = _TASK_LIST_ORDER if order == "deadline" else (Task.created_at.asc(), Task.id.asc())
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(select(Task).where(*conds).order_by(*order_by))
+        return result.scalars().all()
+
 async def mark_task_done(task_id: int):
     async with AsyncSessionLocal() as session:
         result = await session.execute(select(Task).where(Task.id == task_id))
         task = result.scalar_one_or_none()
         if task:
             task.status = "done"
+            task.completed_at = datetime.now(pytz.utc)
+            task.next_reminder_at = None
+            rolled = await _roll_series(session, [task_id])
             await session.commit()
+            task_cache.bump(task.user_id)
+            _publish_rolled(rolled)
+        reminder_scheduler.cancel(task_id)
         return task
 
 async def delete_task(task_id: int):
@@ -119,6 +358,8 @@ async def delete_task(task_id: int):
         if task:
             await session.delete(task)
             await session.commit()
+            task_cache.bump(task.user_id)
+        reminder_scheduler.cancel(task_id)
         return task
 
 async def count_tasks(user_id: str):
@@ -137,6 +378,24 @@ async def get_top_users(limit: int = 10):
         )
         return result.scalars().all()
 
+
+async def _load_leaderboard() -> list[LeaderRow]:
+    # narrow rows in idx_users_xp order; ties broken by id so ranks are stable between refreshes
+    async with AsyncSessionLocal() as session:
+        rows = await session.execute(
+            select(User.id, User.name, User.extra_title, User.xp).order_by(User.xp.desc(), User.id)
+        )
+        return [LeaderRow(*r) for r in rows]
+
+
+# Profile/leaderboard screens rank against this snapshot. Every XP writer reports its delta,
+# so a big jump (admin grant) forces a refresh; daily-capped task XP just waits for the TTL.
+leaderboard = LeaderboardSnapshot(_load_leaderboard, ttl=300, jump_xp=50)
+
+
+async def get_leaderboard() -> LeaderboardSnapshot:
+    return await leaderboard.fresh()
+
 async def get_all_users_with_tasks():
     async with AsyncSessionLocal() as session:
         result = await session.execute(
@@ -159,8 +418,16 @@ async def update_task_deadline(task_id: int, new_deadline: str):
         task = result.scalar_one_or_none()
         if task:
             task.deadline = new_deadline
+            task.deadline_at = deadline_str_to_dt(new_deadline)
             task.reminders_sent = 0
+            if task.next_occurrence_at is not None:
+                # live instance of a series: the next one follows the moved deadline
+                task.next_occurrence_at = task.deadline_at
+                task.repeat_anchor_at = task.deadline_at
+            _sync_next_reminder(task)
             await session.commit()
+            reminder_scheduler.schedule_task(task)
+            task_cache.bump(task.user_id)
         return task
 
 async def get_task_by_id(task_id: int):
@@ -174,7 +441,12 @@ async def update_task_priority(task_id: int, priority: str):
         task = result.scalar_one_or_none()
         if task:
             task.priority = priority
+            # priority picks the reminder schedule; re-derive the stage index for the new one
+            task.reminders_sent = stages_passed(task_deadline_at(task), priority)
+            _sync_next_reminder(task)
             await session.commit()
+            reminder_scheduler.schedule_task(task)
+            task_cache.bump(task.user_id)
         return task
 
 async def update_task_tags(task_id: int, tag: str):
@@ -189,6 +461,7 @@ async def update_task_tags(task_id: int, tag: str):
             existing.append(tag)
         task.tags = ",".join(existing)
         await session.commit()
+        task_cache.bump(task.user_id)
         return task
 
 
@@ -199,56 +472,544 @@ async def update_task_text(task_id: int, new_text: str):
         if task:
             task.text = new_text
             await session.commit()
+            task_cache.bump(task.user_id)
         return task
+
+
+# --- BULK TASK HELPERS ---
+# One UPDATE/DELETE ... WHERE id = ANY(:ids) AND user_id = :uid RETURNING id per call.
+# Ids the user doesn't own are silently skipped; the returned ids are the rows actually changed.
+
+def _owned_ids(user_id: str, ids: list[int]):
+    """tasks.id = ANY(:ids) AND tasks.user_id = :uid; one array parameter, whatever len(ids)."""
+    ids = [int(i) for i in ids]
+    return and_(Task.id == any_(bindparam("ids", ids, type_=ARRAY(Integer))), Task.user_id == user_id)
+
+async def set_tasks_priority(user_id: str, ids: list[int], priority: str) -> list[int]:
+    """
+    Priority picks the reminder schedule, so the stage index (reminders_sent) and next_reminder_at
+    of pending rows are re-derived for the new schedule and written back in the same transaction.
+    """
+    if not ids:
+        return []
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            rows = (await session.execute(
+                update(Task)
+                .where(_owned_ids(user_id, ids))
+                .values(priority=priority)
+                .returning(Task.id, Task.status, Task.deadline_at, Task.deadline)
+            )).all()
+            now = datetime.now(pytz.utc)
+            params = []
+            for tid, status, dt_at, dl in rows:
+                if status != "pending":
+                    continue
+                dt_at = dt_at or deadline_str_to_dt(dl)
+                sent = stages_passed(dt_at, priority, now)
+                params.append({"id": tid, "reminders_sent": sent,
+                               "next_reminder_at": next_reminder_at(dt_at, sent, priority, now)})
+            if params:
+                await session.execute(update(Task), params)
+    for p in params:
+        reminder_scheduler.schedule(p["id"], p["next_reminder_at"])
+    task_cache.bump(user_id)
+    return [r[0] for r in rows]
+
+async def set_tasks_tag(user_id: str, ids: list[int], tag: str) -> list[int]:
+    """Append `tag` to each task's comma-separated tags unless it is already there."""
+    if not ids:
+        return []
+    tags = func.coalesce(Task.tags, "")
+    async with AsyncSessionLocal() as session:
+        res = await session.execute(
+            update(Task)
+            .where(_owned_ids(user_id, ids))
+            .values(tags=case(
+                (("," + tags + ",").contains(f",{tag},", autoescape=True), Task.tags),
+                (tags == "", tag),
+                else_=Task.tags + "," + tag,
+            ))
+            .returning(Task.id)
+        )
+        changed = res.scalars().all()
+        await session.commit()
+    task_cache.bump(user_id)
+    return changed
+
+async def set_tasks_deadline(user_id: str, ids: list[int], new_deadline: str) -> list[int]:
+    """
+    Same deadline for every row, with reminders restarted. The next reminder only depends on
+    priority then, so it is computed per schedule up front and picked with a CASE.
+    Live instances of a series (next_occurrence_at set) move their trigger and anchor along.
+    """
+    if not ids:
+        return []
+    deadline_at = deadline_str_to_dt(new_deadline)
+    next_at = {prio: next_reminder_at(deadline_at, 0, prio) for prio in REMINDER_SCHEDULES}
+    async with AsyncSessionLocal() as session:
+        res = await session.execute(
+            update(Task)
+            .where(_owned_ids(user_id, ids))
+            .values(
+                deadline=new_deadline,
+                deadline_at=deadline_at,
+                reminders_sent=0,
+                next_occurrence_at=case((Task.next_occurrence_at.isnot(None), deadline_at), else_=None),
+                repeat_anchor_at=case(
+                    (Task.next_occurrence_at.isnot(None), deadline_at), else_=Task.repeat_anchor_at
+                ),
+                next_reminder_at=case(
+                    (Task.status != "pending", None),
+                    else_=case(next_at, value=Task.priority, else_=next_reminder_at(deadline_at, 0, None)),
+                ),
+            )
+            .returning(Task.id, Task.status, Task.next_reminder_at)
+        )
+        rows = res.all()
+        await session.commit()
+    for tid, status, next_reminder in rows:
+        if status == "pending":
+            reminder_scheduler.schedule(tid, next_reminder)
+    task_cache.bump(user_id)
+    return [r[0] for r in rows]
+
+async def delete_tasks(user_id: str, ids: list[int]) -> list[int]:
+    if not ids:
+        return []
+    async with AsyncSessionLocal() as session:
+        res = await session.execute(delete(Task).where(_owned_ids(user_id, ids)).returning(Task.id))
+        deleted = res.scalars().all()
+        await session.commit()
+    for tid in deleted:
+        reminder_scheduler.cancel(tid)
+    task_cache.bump(user_id)
+    return deleted
+
+async def delete_tasks_in_scope(user_id: str, scope: str, tz_name: str = "Asia/Tashkent") -> int:
+    """Delete the user's pending tasks in a list scope (see get_tasks_filtered) with one DELETE. Returns the count."""
+    conds = [Task.user_id == user_id, Task.status == "pending"]
+    scope_cond = _scope_filter(scope, tz_name)
+    if scope_cond is not None:
+        conds.append(scope_cond)
+    async with AsyncSessionLocal() as session:
+        res = await session.execute(delete(Task).where(*conds).returning(Task.id))
+        deleted = res.scalars().all()
+        await session.commit()
+    for tid in deleted:
+        reminder_scheduler.cancel(tid)
+    task_cache.bump(user_id)
+    return len(deleted)
     
-# --- reminders_sent persistence ---
-async def get_tasks_for_reminder_window(min_from: int, min_to: int, sent_flag: int, tz_name: str = "Asia/Tashkent"):
+# --- RECURRENCE ---
+# A repeating series is a chain of task rows. Only the live (newest) instance carries
+# next_occurrence_at (= its deadline). When it is completed, the next instance is inserted from it
+# in SQL and the done row's next_occurrence_at is cleared; if the user is at PENDING_TASK_LIMIT the
+# done row stays armed and the sweep inserts the instance once there is room. When a pending
+# instance passes its deadline it is moved forward in place instead, so an abandoned series keeps
+# one pending row rather than growing by one per period.
+# Monthly series step from repeat_anchor_at: a series started on the 31st falls back to the
+# last day of shorter months (as deadline_for_scope does) and returns to the 31st after them.
+
+RECURRENCE_TZ = "Asia/Tashkent"
+_REPEAT_DAYS = {"daily": 1, "weekly": 7}
+
+def _months_between(a, b):
+    """Calendar-month difference between two local timestamps (SQL)."""
+    return (extract("year", b) - extract("year", a)) * 12 + extract("month", b) - extract("month", a)
+
+def _next_occurrence_local(now_local):
+    """
+    Local deadline of a series' next instance: the first step after `now_local`, and at least one
+    step after the current deadline. A sweep that ran late skips missed steps instead of inserting
+    one overdue row per step.
+    """
+    cur = func.timezone(RECURRENCE_TZ, Task.deadline_at)
+    anchor = func.timezone(RECURRENCE_TZ, func.coalesce(Task.repeat_anchor_at, Task.deadline_at))
+
+    period = case(_REPEAT_DAYS, value=Task.repeat, else_=1)
+    steps = func.greatest(func.floor(extract("epoch", now_local - cur) / (period * 86400)), 0) + 1
+    by_days = cur + func.make_interval(0, 0, 0, cast(steps * period, Integer))
+
+    k = cast(func.greatest(_months_between(anchor, cur) + 1, _months_between(anchor, now_local)), Integer)
+    at_k = anchor + func.make_interval(0, k)   # Postgres clamps Jan 31 + 1 month to Feb 28/29
+    by_months = case((at_k > now_local, at_k), else_=anchor + func.make_interval(0, k + 1))
+
+    return case((Task.repeat == "monthly", by_months), else_=by_days)
+
+async def _advance_overdue(session, source_ids):
+    """
+    Move every pending live instance among `source_ids` to its next occurrence in place
+    (deadline, trigger and reminders restarted). Returns (rows, reminder_params) like _roll_series.
+    """
+    next_local = _next_occurrence_local(func.timezone(RECURRENCE_TZ, func.now()))
+    next_at = func.timezone(RECURRENCE_TZ, next_local)
+    rows = (await session.execute(
+        update(Task)
+        .where(Task.id.in_(source_ids), Task.status == "pending", Task.next_occurrence_at.isnot(None))
+        .values(
+            deadline=func.to_char(next_local, "YYYY-MM-DD HH24:MI"),
+            deadline_at=next_at,
+            next_occurrence_at=next_at,
+            reminders_sent=0,
+        )
+        .returning(Task.id, Task.user_id, Task.deadline_at, Task.priority)
+    )).all()
+    params = [{"id": tid, "next_reminder_at": next_reminder_at(dt_at, 0, prio)} for tid, _, dt_at, prio in rows]
+    if params:
+        await session.execute(update(Task), params)
+    return rows, params
+
+def _pending_count(user_id_col):
+    pending = aliased(Task)
+    return (
+        select(func.count())
+        .select_from(pending)
+        .where(pending.user_id == user_id_col, pending.status == "pending")
+        .scalar_subquery()
+    )
+
+async def _roll_series(session, source_ids, limit: int = PENDING_TASK_LIMIT):
+    """
+    Insert the next instance of every completed live series among `source_ids` (list or SELECT
+    of ids): one UPDATE ... RETURNING (clear next_occurrence_at) feeding INSERT ... SELECT.
+    Per user, only as many series roll as fit under `limit` pending tasks; the rest stay armed.
+    The new rows' reminder times are computed in Python and written in the same transaction.
+    Returns (rows, reminder_params) for _publish_rolled() after commit.
+    """
+    now_local = func.timezone(RECURRENCE_TZ, func.now())
+    ranked = (
+        select(
+            Task.id, Task.user_id,
+            func.row_number().over(partition_by=Task.user_id, order_by=Task.id).label("rn"),
+        )
+        .where(Task.id.in_(source_ids), Task.next_occurrence_at.isnot(None), Task.status != "pending")
+        .subquery()
+    )
+    fits = select(ranked.c.id).where(ranked.c.rn + _pending_count(ranked.c.user_id) <= limit)
+    src = (
+        update(Task)
+        .where(Task.id.in_(fits))
+        .values(next_occurrence_at=None)
+        .returning(
+            Task.user_id, Task.text, Task.priority, Task.tags, Task.repeat, Task.notes, Task.attachment,
+            func.coalesce(Task.repeat_anchor_at, Task.deadline_at).label("anchor_at"),
+            _next_occurrence_local(now_local).label("next_local"),
+        )
+        .cte("src")
+    )
+    next_at = func.timezone(RECURRENCE_TZ, src.c.next_local)
+    stmt = (
+        insert(Task)
+        .from_select(
+            ["user_id", "text", "priority", "tags", "repeat", "notes", "attachment", "repeat_anchor_at",
+             "deadline", "deadline_at", "next_occurrence_at", "status", "reminders_sent", "created_at"],
+            select(
+                src.c.user_id, src.c.text, src.c.priority, src.c.tags, src.c.repeat, src.c.notes, src.c.attachment,
+                src.c.anchor_at,
+                func.to_char(src.c.next_local, "YYYY-MM-DD HH24:MI"), next_at, next_at,
+                literal("pending"), literal(0), func.timezone("UTC", func.now()),
+            ),
+        )
+        .returning(Task.id, Task.user_id, Task.deadline_at, Task.priority)
+    )
+    rows = (await session.execute(stmt)).all()
+    params = [{"id": tid, "next_reminder_at": next_reminder_at(dt_at, 0, prio)} for tid, _, dt_at, prio in rows]
+    if params:
+        await session.execute(update(Task), params)
+    return rows, params
+
+def _publish_rolled(rolled):
+    rows, params = rolled
+    for p in params:
+        reminder_scheduler.schedule(p["id"], p["next_reminder_at"])
+    for uid in {r[1] for r in rows}:
+        task_cache.bump(uid)
+
+async def materialize_due_recurrences(batch_size: int = 1000) -> int:
+    """
+    Periodic sweep over idx_tasks_next_occurrence, in batches (rows locked SKIP LOCKED, so
+    several bot processes can sweep at once):
+    - overdue pending instances move forward in place (_advance_overdue);
+    - completed instances that couldn't roll because of PENDING_TASK_LIMIT roll once there is room.
+    Returns instances moved or inserted.
+    """
+    total = 0
+    for status_cond, step in (
+        (lambda t: t.status == "pending", _advance_overdue),
+        (lambda t: and_(t.status != "pending", _pending_count(t.user_id) < PENDING_TASK_LIMIT), _roll_series),
+    ):
+        while True:
+            live = aliased(Task)
+            due = (
+                select(live.id)
+                .where(live.next_occurrence_at <= func.now(), status_cond(live))
+                .order_by(live.next_occurrence_at)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            )
+            async with AsyncSessionLocal() as session:
+                async with session.begin():
+                    rolled = await step(session, due)
+            _publish_rolled(rolled)
+            total += len(rolled[0])
+            if len(rolled[0]) < batch_size:
+                break
+    return total
+
+async def backfill_recurrence() -> int:
     """
-    Return list of (User, Task) where:
-      - Task.status == 'pending'
-      - Task.reminders_sent == sent_flag
-      - Deadline is between [now+min_from, now+min_to) minutes
-    Deadline is stored as a string 'YYYY-MM-DD HH:MM' in local tz.
+    Arm repeating tasks written before the recurrence engine: the newest pending instance of each
+    (user, text, repeat) series gets next_occurrence_at = deadline_at. One UPDATE; safe to re-run.
     """
+    newer = aliased(Task)
     async with AsyncSessionLocal() as session:
         res = await session.execute(
-            select(Task, User)
-            .join(User, User.id == Task.user_id)
+            update(Task)
             .where(
+                Task.repeat.in_(REPEAT_KINDS),
                 Task.status == "pending",
-                Task.reminders_sent == sent_flag,
-                Task.deadline.isnot(None),
-                Task.deadline != ""
+                Task.deadline_at.isnot(None),
+                Task.next_occurrence_at.is_(None),
+                ~select(newer.id).where(
+                    newer.user_id == Task.user_id,
+                    newer.text == Task.text,
+                    newer.repeat == Task.repeat,
+                    newer.id > Task.id,
+                ).exists(),
+            )
+            .values(
+                next_occurrence_at=Task.deadline_at,
+                repeat_anchor_at=func.coalesce(Task.repeat_anchor_at, Task.deadline_at),
             )
-            .options(joinedload(Task.user))
         )
-        rows = res.all()
-
-    tz = pytz.timezone(tz_name)
-    now = datetime.now(tz)
-    win_start = now + timedelta(minutes=min_from)
-    win_end   = now + timedelta(minutes=min_to)
+        await session.commit()
+        return res.rowcount
+
+# --- ARCHIVE (hot/cold split) ---
+# Done tasks move from tasks to tasks_archive after a while, so the hot table and its indexes
+# only hold rows the list screens can show. History and exports read both through _task_history().
+ARCHIVE_COLUMNS = (
+    "id", "user_id", "text", "deadline", "deadline_at", "reminders_sent", "status",
+    "priority", "tags", "repeat", "notes", "attachment", "created_at", "completed_at",
+)
+
+def _task_history():
+    """tasks UNION ALL tasks_archive (ARCHIVE_COLUMNS), as a subquery."""
+    return union_all(
+        select(*[getattr(Task, c) for c in ARCHIVE_COLUMNS]),
+        select(*[getattr(TaskArchive, c) for c in ARCHIVE_COLUMNS]),
+    ).subquery("task_history")
+
+async def archive_done_tasks(older_than_days: int = 30, batch_size: int = 1000) -> int:
+    """
+    Move tasks completed more than `older_than_days` ago into tasks_archive.
+    Each batch is one DELETE ... RETURNING feeding INSERT ... SELECT in its own short transaction,
+    with rows taken SKIP LOCKED, so lock time is bounded by batch_size. Returns rows moved.
+    """
+    cutoff = datetime.now(pytz.utc) - timedelta(days=older_than_days)
+    total = 0
+    while True:
+        old = aliased(Task)
+        due = (
+            select(old.id)
+            # an armed series row (done, next_occurrence_at still set while the user sat at the
+            # pending limit) is the series itself; the archive doesn't carry it, so it stays hot
+            .where(old.status == "done", old.completed_at < cutoff, old.next_occurrence_at.is_(None))
+            .order_by(old.completed_at)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        moved = (
+            delete(Task)
+            .where(Task.id.in_(due))
+            .returning(*[getattr(Task, c) for c in ARCHIVE_COLUMNS])
+            .cte("moved")
+        )
+        stmt = (
+            insert(TaskArchive)
+            .from_select([*ARCHIVE_COLUMNS, "archived_at"], select(*[moved.c[c] for c in ARCHIVE_COLUMNS], func.now()))
+            .returning(TaskArchive.id)
+        )
+        async with AsyncSessionLocal() as session:
+            async with session.begin():
+                n = len((await session.execute(stmt)).all())
+        total += n
+        if n < batch_size:
+            return total
+
+async def task_storage_stats() -> dict:
+    """
+    On-disk bytes of the hot and cold task tables and of their indexes, plus the hot table's live
+    row count and its dead-row estimate. Archiving frees space only once VACUUM has run, so the
+    byte counts don't drop right after a batch; the row counts do.
+    """
+    stat = table("pg_stat_user_tables", column("relid"), column("n_dead_tup"))
+    async with AsyncSessionLocal() as session:
+        row = (await session.execute(select(
+            func.pg_relation_size(literal_column("'tasks'::regclass")),
+            func.pg_indexes_size(literal_column("'tasks'::regclass")),
+            func.pg_relation_size(literal_column("'tasks_archive'::regclass")),
+            func.pg_indexes_size(literal_column("'tasks_archive'::regclass")),
+            select(func.count(Task.id)).scalar_subquery(),
+            select(stat.c.n_dead_tup).where(stat.c.relid == literal_column("'tasks'::regclass")).scalar_subquery(),
+        ))).one()
+    return dict(zip(
+        ("tasks_table", "tasks_indexes", "archive_table", "archive_indexes", "tasks_rows", "tasks_dead"), row
+    ))
 
-    pairs: list[tuple[User, Task]] = []
-    for t, u in rows:
-        try:
-            dt = tz.localize(datetime.strptime(t.deadline, "%Y-%m-%d %H:%M"))
-        except Exception:
-            continue
-        if win_start <= dt < win_end:
-            pairs.append((u, t))
-    return pairs
+# --- reminders_sent persistence ---
+async def get_upcoming_reminders():
+    """
+    (task_id, next_reminder_at) for every pending task with a reminder stage left.
+    Used once at startup to seed the reminder scheduler.
+    """
+    async with AsyncSessionLocal() as session:
+        res = await session.execute(
+            select(Task.id, Task.next_reminder_at)
+            .where(Task.status == "pending", Task.next_reminder_at.isnot(None))
+        )
+        return res.all()
 
 
-async def bulk_update_task_reminders_sent(task_ids: list[int], new_val: int) -> None:
-    """Set reminders_sent = new_val for all tasks in task_ids."""
-    if not task_ids:
+async def claim_due_reminders(batch_size: int = 500):
+    """
+    Atomically claim up to batch_size due reminders for this worker.
+    Due rows come from one range scan over idx_tasks_next_reminder, whatever the number of
+    stages; they are locked with SELECT ... FOR UPDATE SKIP LOCKED and advanced (reminders_sent,
+    next_reminder_at) in the same transaction, so concurrent bot processes split the due set
+    instead of sending duplicates. Undelivered claims are handed back with release_reminder_claims().
+    Returns [(task_id, user_id, text, lead, claim)] where lead is the stage's timedelta and
+    claim is the (prev_sent, prev_next_at, new_sent, new_next_at) tuple release needs.
+    """
+    now = datetime.now(pytz.utc)
+    claims = []
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            rows = (await session.execute(
+                select(Task.id, Task.user_id, Task.text, Task.priority, Task.deadline_at, Task.deadline,
+                       Task.reminders_sent, Task.next_reminder_at)
+                .where(Task.status == "pending", Task.next_reminder_at <= now)
+                .order_by(Task.next_reminder_at)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            )).all()
+
+            params = []
+            for tid, uid, text, prio, dt_at, dl, sent, next_at in rows:
+                dt_at = dt_at or deadline_str_to_dt(dl)
+                sent = int(sent or 0)
+                stage = due_stage(dt_at, sent, prio, now)
+                if stage is None:
+                    # deadline already over: nothing left to send
+                    params.append({"id": tid, "next_reminder_at": None})
+                    continue
+                new_next = next_reminder_at(dt_at, stage + 1, prio, now)
+                params.append({"id": tid, "reminders_sent": stage + 1, "next_reminder_at": new_next})
+                claims.append((tid, uid, text, reminder_stages(prio)[stage], (sent, next_at, stage + 1, new_next)))
+            if params:
+                await session.execute(update(Task), params)
+    return claims
+
+
+async def release_reminder_claims(claims: list[tuple[int, tuple]]) -> None:
+    """
+    Undo claims whose message was not delivered: [(task_id, claim)] as returned by
+    claim_due_reminders, as one UPDATE tasks ... FROM (VALUES ...) statement. Only rows still
+    at the claimed value are reset, so a newer deadline edit wins.
+    """
+    if not claims:
         return
+    v = values(
+        column("id", Integer), column("new_sent", Integer),
+        column("prev_sent", Integer), column("prev_next", DateTime(timezone=True)),
+        name="v",
+    ).data([(tid, new_sent, prev_sent, prev_next) for tid, (prev_sent, prev_next, new_sent, _new_next) in claims])
+    stmt = (
+        update(Task)
+        .where(Task.id == v.c.id, Task.reminders_sent == v.c.new_sent)
+        .values(reminders_sent=v.c.prev_sent, next_reminder_at=v.c.prev_next)
+        .execution_options(synchronize_session=False)
+    )
     async with AsyncSessionLocal() as session:
-        await session.execute(
-            update(Task).where(Task.id.in_(task_ids)).values(reminders_sent=new_val)
-        )
+        await session.execute(stmt)
         await session.commit()
+
+
+async def backfill_deadline_at(batch_size: int = 1000, tz_name: str = "Asia/Tashkent") -> int:
+    """
+    Copy legacy Task.deadline strings into Task.deadline_at in id-ordered batches,
+    one short transaction per batch. Resumable: only rows whose deadline_at is
+    still NULL are read, so an interrupted run simply picks up where it stopped.
+    Malformed strings are skipped (left NULL). Returns number of rows filled.
+    """
+    filled = 0
+    after_id = 0
+    while True:
+        async with AsyncSessionLocal() as session:
+            rows = (await session.execute(
+                select(Task.id, Task.deadline)
+                .where(
+                    Task.id > after_id,
+                    Task.deadline_at.is_(None),
+                    Task.deadline.isnot(None),
+                    Task.deadline != "",
+                )
+                .order_by(Task.id)
+                .limit(batch_size)
+            )).all()
+            if not rows:
+                return filled
+            after_id = rows[-1][0]
+
+            params = []
+            for tid, dl in rows:
+                dt = deadline_str_to_dt(dl, tz_name)
+                if dt:
+                    params.append({"id": tid, "deadline_at": dt})
+            if params:
+                # ORM bulk UPDATE by primary key -> one executemany per batch
+                await session.execute(update(Task), params)
+                await session.commit()
+                filled += len(params)
+
+
+async def backfill_next_reminder_at(batch_size: int = 1000) -> int:
+    """
+    Compute next_reminder_at for pending tasks with a future deadline that don't have one yet,
+    in id-ordered batches (same pattern as backfill_deadline_at). Returns rows filled.
+    """
+    filled = 0
+    after_id = 0
+    while True:
+        now = datetime.now(pytz.utc)
+        async with AsyncSessionLocal() as session:
+            rows = (await session.execute(
+                select(Task.id, Task.deadline_at, Task.reminders_sent, Task.priority)
+                .where(
+                    Task.id > after_id,
+                    Task.status == "pending",
+                    Task.next_reminder_at.is_(None),
+                    Task.deadline_at > now,
+                )
+                .order_by(Task.id)
+                .limit(batch_size)
+            )).all()
+            if not rows:
+                return filled
+            after_id = rows[-1][0]
+
+            params = []
+            for tid, dt_at, sent, prio in rows:
+                at = next_reminder_at(dt_at, sent, prio, now)
+                if at:
+                    params.append({"id": tid, "next_reminder_at": at})
+            if params:
+                await session.execute(update(Task), params)
+                await session.commit()
+                filled += len(params)
+
+
 async def update_task_reminders_sent(task_id: int, val: int) -> bool:
     from db import AsyncSessionLocal
     from db_models import Task
@@ -358,6 +1119,7 @@ async def approve_application(clan_id: int, user_id: str):
         if not app:
             return False
         app.status = "approved"
+        await _clan_stats_add_member(session, clan_id, user_id, +1)
         member = ClanMember(clan_id=clan_id, user_id=user_id)
         session.add(member)
         await session.commit()
@@ -480,7 +1242,10 @@ async def approve_clan_creation_request(request_id):
         session.add(clan)
         await session.flush()  # Ensure clan.id is generated
 
+        # Every clan gets its clan_stats row up front; the leaderboard inner-joins on it
+        await _clan_stats_create(session, clan.id)
         # Add founder as first member
+        await _clan_stats_add_member(session, clan.id, req.user_id, +1)
         member = ClanMember(clan_id=clan.id, user_id=req.user_id)
         session.add(member)
 
@@ -545,8 +1310,9 @@ from db import AsyncSessionLocal
 async def admin_get_counts():
     async with AsyncSessionLocal() as session:
         users = (await session.execute(select(func.count(User.id)))).scalar_one()
-        tasks_total = (await session.execute(select(func.count(Task.id)))).scalar_one()
-        tasks_done  = (await session.execute(select(func.count()).where(Task.status == "done"))).scalar_one()
+        tasks_archived = (await session.execute(select(func.count(TaskArchive.id)))).scalar_one()
+        tasks_total = (await session.execute(select(func.count(Task.id)))).scalar_one() + tasks_archived
+        tasks_done  = (await session.execute(select(func.count()).where(Task.status == "done"))).scalar_one() + tasks_archived
         tasks_open  = (await session.execute(select(func.count()).where(Task.status != "done"))).scalar_one()
         clans       = (await session.execute(select(func.count(Clan.id)))).scalar_one()
         clan_apps_pend = (await session.execute(
@@ -560,6 +1326,7 @@ async def admin_get_counts():
             "tasks_total": tasks_total,
             "tasks_done": tasks_done,
             "tasks_open": tasks_open,
+            "tasks_archived": tasks_archived,
             "clans": clans,
             "join_pending": clan_apps_pend,
             "create_pending": clan_creations_pend,
@@ -628,10 +1395,10 @@ async def export_users() -> list[dict]:
 
 async def export_tasks() -> list[dict]:
     from db import AsyncSessionLocal
-    from db_models import Task
     async with AsyncSessionLocal() as session:
-        res = await session.execute(select(Task))
-        tasks = res.scalars().all()
+        history = _task_history()
+        res = await session.execute(select(history).order_by(history.c.id))
+        tasks = res.all()
         out = []
         for t in tasks:
             out.append({
@@ -711,48 +1478,318 @@ async def set_user_username(user_id: str, username: str) -> bool:
             return False
         u.username = username or ""
         await session.commit()
+        user_cache.invalidate(user_id)
         return True    
     
 
-# --- XP award with daily cap (respects xp_today/xp_date) ---
-async def award_xp_with_cap(
+# XP for completing a task: base + priority bonus + study-tag bonus
+XP_BASE = 2
+XP_PRIORITY_BONUS = {"low": 0, "medium": 2, "high": 4}
+XP_STUDY_BONUS = 1
+
+
+def _task_xp():
+    return (
+        XP_BASE
+        + case(XP_PRIORITY_BONUS, value=Task.priority, else_=0)
+        + case((Task.tags.contains("study"), XP_STUDY_BONUS), else_=0)
+    )
+
+
+async def complete_tasks(
     user_id: str,
-    requested_xp: int,
-    completed_delta: int = 0,
+    ids: list[int],
     cap: int = 30,
     tz_name: str = "Asia/Tashkent",
 ):
     """
-    Returns (applied_xp, user). Applies a per-day XP cap using User.xp_today/xp_date.
-    Does NOT touch streak (leave your existing streak logic elsewhere).
+    Marks the user's pending tasks in `ids` done and awards their XP under the daily cap,
+    as one statement: UPDATE tasks ... RETURNING xp feeds UPDATE users (row locked FOR UPDATE).
+    Returns (applied_xp, [(task_id, requested_xp, applied_xp)]) in `ids` order; the cap is
+    consumed in that order. Ids that are missing, not the user's or already done are left out.
+    Why the FOR UPDATE read rather than one `UPDATE ... WHERE xp_today + x <= cap`: the credit is
+    partial (whatever is left under the cap) and the caller needs the amount, but RETURNING only
+    sees the new row. So the counter is read under the row lock first; concurrent completions
+    queue on it and each one starts from the previous one's result.
     """
-    from datetime import datetime
-    import pytz
+    ids = list(dict.fromkeys(int(i) for i in ids))
+    if not ids:
+        return 0, []
+    today = datetime.now(pytz.timezone(tz_name)).strftime("%Y-%m-%d")
+
+    done = (
+        update(Task)
+        .where(_owned_ids(user_id, ids), Task.status == "pending")
+        .values(status="done", completed_at=func.now(), next_reminder_at=None)
+        .returning(Task.id, _task_xp().label("xp"))
+        .cte("done")
+    )
+    tot = select(
+        func.coalesce(func.sum(done.c.xp), 0).label("req"),
+        func.count().label("n"),
+    ).cte("tot")
+    cur = (
+        select(User.id, case((User.xp_date == today, func.coalesce(User.xp_today, 0)), else_=0).label("already"))
+        .where(User.id == user_id)
+        .with_for_update()
+        .cte("cur")
+    )
+    applied = func.least(tot.c.req, func.greatest(0, cap - cur.c.already))
+    credit = (
+        update(User)
+        .where(User.id == cur.c.id, tot.c.n > 0)
+        .values(
+            xp=func.coalesce(User.xp, 0) + applied,
+            xp_today=cur.c.already + applied,
+            xp_date=today,
+            completed=func.coalesce(User.completed, 0) + tot.c.n,
+        )
+        .returning(applied.label("applied"))
+        .cte("credit")
+    )
+    stmt = select(done.c.id, done.c.xp, select(credit.c.applied).scalar_subquery())
 
     async with AsyncSessionLocal() as session:
-        user = await session.get(User, user_id)
-        if not user:
-            return 0, None
+        rows = (await session.execute(stmt)).all()
+        # completing the live instance of a repeating series inserts the next one right away
+        rolled = await _roll_series(session, [r[0] for r in rows]) if rows else ([], [])
+        if rows:
+            await _clan_stats_add_xp(session, user_id, int(rows[0][2] or 0))
+            await _log_xp(session, user_id, int(rows[0][2] or 0), "task")
+        await session.commit()
+
+    user_cache.invalidate(user_id)
+    task_cache.bump(user_id)
+    _publish_rolled(rolled)
+    requested = {tid: int(xp) for tid, xp, _ in rows}
+    left = int(rows[0][2] or 0) if rows else 0
+    total = left
+    leaderboard.note_xp(user_id, total)
+    results = []
+    for tid in ids:
+        if tid not in requested:
+            continue
+        reminder_scheduler.cancel(tid)
+        got = min(requested[tid], left)
+        left -= got
+        results.append((tid, requested[tid], got))
+    return total, results
+
 
-        tz = pytz.timezone(tz_name)
-        today = datetime.now(tz).strftime("%Y-%m-%d")
+# --- XP LEDGER & PERIOD LEADERBOARDS ---
+# Every XP credit appends one xp_events row. rollup_xp_events() folds the ledger into per-user,
+# per-local-day buckets (xp_daily) behind a cursor; day/week/month leaderboards read only the buckets.
+# compact_xp_ledger() drops raw events once they are rolled up and past retention.
+XP_TZ = "Asia/Tashkent"
+XP_ROLLUP_CURSOR = "xp_daily"
+XP_EVENTS_KEEP_DAYS = 35                # raw ledger kept for audits; buckets carry the totals after that
+XP_DAILY_KEEP_DAYS = 400
+XP_PERIODS = ("day", "week", "month")
 
-        # reset daily bucket if new day
-        if (user.xp_date or "") != today:
-            user.xp_date = today
-            user.xp_today = 0
 
-        already = int(user.xp_today or 0)
-        allowed = max(0, cap - already)
-        req = max(0, int(requested_xp))
-        applied = min(req, allowed)
+async def _log_xp(session, user_id: str, delta: int, source: str):
+    """Append a ledger row in the caller's transaction (caller commits)."""
+    if delta:
+        await session.execute(insert(XpEvent).values(user_id=user_id, delta=int(delta), source=source))
 
-        user.xp = max(0, int(user.xp or 0) + applied)
-        user.xp_today = already + applied
-        user.completed = max(0, int(user.completed or 0) + int(completed_delta or 0))
 
+async def rollup_xp_events(batch_size: int = 10_000) -> int:
+    """
+    Fold ledger rows past the cursor into xp_daily, one statement per batch: lock the cursor,
+    take the next events in (xid, id) order whose writing transaction is older than the snapshot
+    xmin, upsert their per-day sums and advance the cursor. Every transaction below xmin has
+    finished, and anything that commits later has an xid at or above it, so a slow commit is
+    folded on a later pass instead of being skipped. Returns events folded.
+    """
+    cur = (
+        select(XpRollupCursor.last_xid, XpRollupCursor.last_id)
+        .where(XpRollupCursor.name == XP_ROLLUP_CURSOR)
+        .with_for_update()
+        .cte("cur")
+    )
+    horizon = cast(cast(func.pg_snapshot_xmin(func.pg_current_snapshot()), String), BigInteger)
+    batch = (
+        select(XpEvent.id, XpEvent.xid, XpEvent.user_id, XpEvent.delta, XpEvent.source, XpEvent.created_at)
+        .where(tuple_(XpEvent.xid, XpEvent.id) > tuple_(cur.c.last_xid, cur.c.last_id), XpEvent.xid < horizon)
+        .order_by(XpEvent.xid, XpEvent.id)
+        .limit(batch_size)
+        .cte("batch")
+    )
+    day = cast(func.timezone(XP_TZ, batch.c.created_at), Date)
+    task_xp = case((and_(batch.c.source == "task", batch.c.delta > 0), batch.c.delta), else_=0)
+    ins = pg_insert(XpDaily).from_select(
+        ["user_id", "day", "xp", "task_xp"],
+        select(batch.c.user_id, day, func.sum(batch.c.delta), func.sum(task_xp)).group_by(batch.c.user_id, day),
+    )
+    bucket = (
+        ins.on_conflict_do_update(
+            index_elements=[XpDaily.user_id, XpDaily.day],
+            set_={"xp": XpDaily.xp + ins.excluded.xp, "task_xp": XpDaily.task_xp + ins.excluded.task_xp},
+        )
+        .returning(XpDaily.user_id)
+        .cte("bucket")
+    )
+    last = select(batch.c.xid, batch.c.id).order_by(batch.c.xid.desc(), batch.c.id.desc()).limit(1).subquery()
+    moved = (
+        update(XpRollupCursor)
+        .where(XpRollupCursor.name == XP_ROLLUP_CURSOR)
+        .values(last_xid=select(last.c.xid).scalar_subquery(), last_id=select(last.c.id).scalar_subquery())
+        .where(select(func.count()).select_from(batch).scalar_subquery() > 0)
+        .returning(XpRollupCursor.last_id)
+        .cte("moved")
+    )
+    stmt = select(
+        select(func.count()).select_from(batch).scalar_subquery(),
+        select(func.count()).select_from(bucket).scalar_subquery(),
+        select(func.count()).select_from(moved).scalar_subquery(),
+    )
+
+    total = 0
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            pg_insert(XpRollupCursor).values(name=XP_ROLLUP_CURSOR, last_xid=0, last_id=0).on_conflict_do_nothing()
+        )
         await session.commit()
-        return applied, user
+        while True:
+            folded = int((await session.execute(stmt)).scalar() or 0)
+            await session.commit()
+            total += folded
+            if folded < batch_size:
+                return total
+
+
+async def compact_xp_ledger(
+    keep_days: int = XP_EVENTS_KEEP_DAYS,
+    daily_keep_days: int = XP_DAILY_KEEP_DAYS,
+    batch_size: int = 10_000,
+) -> tuple[int, int]:
+    """
+    Retention: delete raw events that are both rolled up and older than keep_days (in id batches),
+    and buckets older than daily_keep_days. Returns (events deleted, buckets deleted).
+    """
+    cutoff = func.now() - timedelta(days=keep_days)
+    rolled = select(XpRollupCursor).where(XpRollupCursor.name == XP_ROLLUP_CURSOR).subquery()
+    pick = (
+        select(XpEvent.id)
+        .where(
+            tuple_(XpEvent.xid, XpEvent.id) <= tuple_(
+                select(rolled.c.last_xid).scalar_subquery(), select(rolled.c.last_id).scalar_subquery()
+            ),
+            XpEvent.created_at < cutoff,
+        )
+        .order_by(XpEvent.id)
+        .limit(batch_size)
+    )
+    events = 0
+    async with AsyncSessionLocal() as session:
+        while True:
+            res = await session.execute(delete(XpEvent).where(XpEvent.id.in_(pick)))
+            await session.commit()
+            events += res.rowcount or 0
+            if (res.rowcount or 0) < batch_size:
+                break
+        oldest = datetime.now(pytz.timezone(XP_TZ)).date() - timedelta(days=daily_keep_days)
+        res = await session.execute(delete(XpDaily).where(XpDaily.day < oldest))
+        await session.commit()
+    return events, res.rowcount or 0
+
+
+def _period_start(period: str):
+    today = datetime.now(pytz.timezone(XP_TZ)).date()
+    if period == "week":
+        return today - timedelta(days=today.weekday())
+    if period == "month":
+        return today.replace(day=1)
+    return today
+
+
+async def get_xp_leaderboard(period: str = "week", limit: int = 10, clan_id: int | None = None) -> list[LeaderRow]:
+    """
+    Top users by XP earned since the start of the local day/week/month, optionally within one clan.
+    Sums xp_daily buckets (idx_xp_daily_day); lags the ledger by up to one rollup interval.
+    """
+    tot = select(XpDaily.user_id, func.sum(XpDaily.xp).label("xp")).where(XpDaily.day >= _period_start(period))
+    if clan_id is not None:
+        tot = tot.where(XpDaily.user_id.in_(select(ClanMember.user_id).where(ClanMember.clan_id == clan_id)))
+    tot = tot.group_by(XpDaily.user_id).order_by(desc("xp")).limit(limit).subquery()
+    async with AsyncSessionLocal() as session:
+        rows = await session.execute(
+            select(tot.c.user_id, User.name, User.extra_title, tot.c.xp)
+            .join(User, User.id == tot.c.user_id)
+            .order_by(tot.c.xp.desc(), tot.c.user_id)
+        )
+        return [LeaderRow(*r) for r in rows]
+
+
+# --- STREAKS ---
+STREAK_TZ = "Asia/Tashkent"
+
+
+async def update_streaks(day=None) -> int:
+    """
+    Fold one finished local day into every user's streak with a single UPDATE:
+    completed a task that day -> streak + 1 (or 1 if the previous day wasn't folded in), else 0.
+    Activity comes from the XP ledger, so deleting or archiving a finished task doesn't erase the
+    day: raw "task" events while they're retained (one range scan of idx_xp_events_created, probed
+    as a hashed subplan), the buckets' task_xp for older days, so both count the same credits.
+    Idempotent: rows already stamped with `day` (or a later day) are skipped, and users at 0 who
+    stayed inactive aren't rewritten at all. `day` defaults to yesterday. Returns rows updated.
+    """
+    tz = pytz.timezone(STREAK_TZ)
+    today = datetime.now(tz).date()
+    day = day or (today - timedelta(days=1))
+    start = tz.localize(datetime.combine(day, datetime.min.time()))
+    end = tz.localize(datetime.combine(day + timedelta(days=1), datetime.min.time()))
+
+    if day > today - timedelta(days=XP_EVENTS_KEEP_DAYS):
+        active = select(XpEvent.user_id).where(
+            XpEvent.source == "task", XpEvent.delta > 0, XpEvent.created_at >= start, XpEvent.created_at < end,
+        )
+    else:
+        active = select(XpDaily.user_id).where(XpDaily.day == day, XpDaily.task_xp > 0)
+    active = active.cte("active")
+    is_active = User.id.in_(select(active.c.user_id))
+    stmt = (
+        update(User)
+        .where(
+            or_(User.streak_date.is_(None), User.streak_date < day),
+            or_(func.coalesce(User.streak, 0) > 0, is_active),
+        )
+        .values(
+            streak=case(
+                (is_active, case(
+                    (User.streak_date == day - timedelta(days=1), func.coalesce(User.streak, 0) + 1),
+                    else_=1,
+                )),
+                else_=0,
+            ),
+            streak_date=day,
+        )
+    )
+    async with AsyncSessionLocal() as session:
+        res = await session.execute(stmt, execution_options={"synchronize_session": False})
+        await session.commit()
+    user_cache.clear()
+    return res.rowcount or 0
+
+
+async def catch_up_streaks() -> tuple[int, int]:
+    """
+    Fold every finished local day after the last one folded (max streak_date), oldest first, so a
+    bot that was down over one or more midnights still breaks and extends streaks day by day.
+    Falls back to just yesterday on a fresh table; never reaches past the xp_daily retention.
+    Returns (days folded, rows updated).
+    """
+    yesterday = datetime.now(pytz.timezone(STREAK_TZ)).date() - timedelta(days=1)
+    async with AsyncSessionLocal() as session:
+        last = (await session.execute(select(func.max(User.streak_date)))).scalar()
+    day = max(last + timedelta(days=1), yesterday - timedelta(days=XP_DAILY_KEEP_DAYS)) if last else yesterday
+    days = rows = 0
+    while day <= yesterday:
+        rows += await update_streaks(day)
+        days += 1
+        day += timedelta(days=1)
+    return days, rows
 
 
 # List members with user rows (ordered by join time)
@@ -789,55 +1826,106 @@ async def remove_member_from_clan(clan_id: int, user_id: str) -> str:
         if not cm:
             return "not_member"
 
+        await _clan_stats_add_member(session, clan_id, user_id, -1)
         await session.delete(cm)
         await session.commit()
         return "removed"    
     
 
-async def get_clans_xp_leaderboard(limit: int = 10, mode: str = "total"):
-    from db import AsyncSessionLocal
-    from db_models import Clan, ClanMember, User
+# --- CLAN STATS (materialized: db_models.ClanStats) ---
+# Writers update the counters in their own transaction, users row first, then clan_stats,
+# so a concurrent XP award and a join/leave of the same user serialize on the users row lock.
 
-    metric_total = func.coalesce(func.sum(User.xp), 0).label("total_xp")
-    metric_avg   = func.coalesce(func.avg(User.xp), 0).label("avg_xp")
-    member_count = func.count(ClanMember.id).label("member_count")
+async def _clan_stats_add_xp(session, user_id: str, delta: int):
+    """Carry a user's XP change into every clan they belong to (caller commits)."""
+    if delta:
+        await session.execute(
+            update(ClanStats)
+            .where(ClanStats.clan_id.in_(select(ClanMember.clan_id).where(ClanMember.user_id == user_id)))
+            .values(total_xp=ClanStats.total_xp + delta)
+        )
 
-    async with AsyncSessionLocal() as session:
-        stmt = (
-            select(Clan, member_count, metric_total, metric_avg)
-            .join(ClanMember, ClanMember.clan_id == Clan.id, isouter=True)
-            .join(User, User.id == ClanMember.user_id, isouter=True)
-            .where(Clan.is_approved == True)
-            .group_by(Clan.id)
+
+async def _clan_stats_create(session, clan_id: int):
+    """Give a new clan its empty counters row (caller commits)."""
+    await session.execute(pg_insert(ClanStats).values(clan_id=clan_id).on_conflict_do_nothing())
+
+
+async def _clan_stats_add_member(session, clan_id: int, user_id: str, sign: int):
+    """Count a member joining (+1) or leaving (-1) together with their current XP (caller commits)."""
+    xp = (await session.execute(
+        select(User.xp).where(User.id == user_id).with_for_update()
+    )).scalar() or 0
+    ins = pg_insert(ClanStats).values(clan_id=clan_id, member_count=max(sign, 0), total_xp=xp if sign > 0 else 0)
+    await session.execute(ins.on_conflict_do_update(
+        index_elements=[ClanStats.clan_id],
+        set_={"member_count": ClanStats.member_count + sign, "total_xp": ClanStats.total_xp + sign * xp},
+    ))
+
+
+async def reconcile_clan_stats() -> tuple[int, int]:
+    """
+    Recompute every clan's counters from clan_members/users and rewrite the rows that drifted
+    (or are missing). Returns (clans checked, rows rebuilt).
+    The table lock waits out in-flight writers and holds new ones back until the rewrite commits,
+    so an increment can't land between the recount and the overwrite.
+    """
+    truth = (
+        select(
+            Clan.id.label("clan_id"),
+            func.count(ClanMember.id).label("member_count"),
+            func.coalesce(func.sum(User.xp), 0).label("total_xp"),
         )
-        order_metric = desc("total_xp") if mode == "total" else desc("avg_xp")
-        stmt = stmt.order_by(order_metric).limit(limit)
-        res = await session.execute(stmt)
-        # returns list of tuples: (Clan, member_count, total_xp, avg_xp)
-        return res.all()    
-    
+        .select_from(Clan)
+        .outerjoin(ClanMember, ClanMember.clan_id == Clan.id)
+        .outerjoin(User, User.id == ClanMember.user_id)
+        .group_by(Clan.id)
+    )
+    ins = pg_insert(ClanStats).from_select(["clan_id", "member_count", "total_xp"], truth)
+    stmt = ins.on_conflict_do_update(
+        index_elements=[ClanStats.clan_id],
+        set_={"member_count": ins.excluded.member_count, "total_xp": ins.excluded.total_xp},
+        where=or_(
+            ClanStats.member_count != ins.excluded.member_count,
+            ClanStats.total_xp != ins.excluded.total_xp,
+        ),
+    ).returning(ClanStats.clan_id)
 
-async def get_clans_xp_leaderboard_page(page: int = 0, per_page: int = 10, mode: str = "total"):
-    from db import AsyncSessionLocal
-    from db_models import Clan, ClanMember, User
+    async with AsyncSessionLocal() as session:
+        await session.execute(sql_text("LOCK TABLE clan_stats IN SHARE ROW EXCLUSIVE MODE"))
+        fixed = len((await session.execute(stmt)).all())
+        checked = (await session.execute(select(func.count(Clan.id)))).scalar_one()
+        await session.commit()
+    return checked, fixed
+
+
+def _clan_lb_select(mode: str):
+    """
+    Approved clans with their counters, best first. Every clan has a clan_stats row (written when
+    the clan is created, backfilled by reconcile_clan_stats), so this is an inner join ordered by
+    the raw columns: idx_clan_stats_total / idx_clan_stats_avg hand back rows in page order.
+    """
+    metric = ClanStats.total_xp if mode == "total" else ClanStats.avg_xp
+    return (
+        select(Clan, ClanStats.member_count, ClanStats.total_xp, ClanStats.avg_xp)
+        .join(ClanStats, ClanStats.clan_id == Clan.id)
+        .where(Clan.is_approved == True)
+        .order_by(metric.desc(), ClanStats.member_count.desc(), ClanStats.clan_id.desc())
+    )
+
+
+async def get_clans_xp_leaderboard(limit: int = 10, mode: str = "total"):
+    async with AsyncSessionLocal() as session:
+        res = await session.execute(_clan_lb_select(mode).limit(limit))
+        # returns list of tuples: (Clan, member_count, total_xp, avg_xp)
+        return res.all()
 
-    metric_total = func.coalesce(func.sum(User.xp), 0).label("total_xp")
-    metric_avg   = func.coalesce(func.avg(User.xp), 0).label("avg_xp")
-    member_count = func.count(ClanMember.id).label("member_count")
 
+async def get_clans_xp_leaderboard_page(page: int = 0, per_page: int = 10, mode: str = "total"):
     async with AsyncSessionLocal() as session:
         # count approved clans
         total = (await session.execute(select(func.count()).select_from(Clan).where(Clan.is_approved == True))).scalar_one()
 
-        stmt = (
-            select(Clan, member_count, metric_total, metric_avg)
-            .join(ClanMember, ClanMember.clan_id == Clan.id, isouter=True)
-            .join(User, User.id == ClanMember.user_id, isouter=True)
-            .where(Clan.is_approved == True)
-            .group_by(Clan.id)
-        )
-        order_metric = desc("total_xp") if mode == "total" else  desc("avg_xp")
-        stmt = stmt.order_by(order_metric, desc(member_count), Clan.created_at.desc()).offset(page*per_page).limit(per_page)
-        res = await session.execute(stmt)
+        res = await session.execute(_clan_lb_select(mode).offset(page*per_page).limit(per_page))
         rows = res.all()   # [(Clan, member_count, total_xp, avg_xp)]
         return total, rows    
\ No newline at end of file
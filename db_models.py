@@ -1,4 +1,7 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, UniqueConstraint, Boolean
+from sqlalchemy import (
+    Column, Integer, BigInteger, Float, String, Date, DateTime, ForeignKey, Text, UniqueConstraint, Boolean, Computed,
+    func, text,
+)
 from sqlalchemy.orm import declarative_base, relationship
 from datetime import datetime
 
@@ -13,6 +16,7 @@ class User(Base):
     lang          = Column(String, default="en")
     xp            = Column(Integer, default=0)
     streak        = Column(Integer, default=0)
+    streak_date   = Column(Date)                           # last local day folded into streak (nightly job)
     completed     = Column(Integer, default=0)
     last_active   = Column(String)
     extra_title   = Column(String, default="")
@@ -37,18 +41,43 @@ class Task(Base):
     id             = Column(Integer, primary_key=True, autoincrement=True)
     user_id        = Column(String, ForeignKey("users.id"), index=True)
     text           = Column(Text)
-    deadline       = Column(String, index=True)
+    deadline       = Column(String, index=True)          # legacy 'YYYY-MM-DD HH:MM' (Asia/Tashkent)
+    deadline_at    = Column(DateTime(timezone=True))     # typed copy of deadline; see idx_tasks_user_status_dl
     reminders_sent = Column(Integer, default=0)
+    next_reminder_at = Column(DateTime(timezone=True))   # next due stage (see utils/scheduler.py), NULL = none left
     status         = Column(String, default="pending", index=True)
     priority       = Column(String, default="medium")
     tags           = Column(String, default="")
     repeat         = Column(String, default="")
+    repeat_anchor_at   = Column(DateTime(timezone=True))   # first deadline of the series (monthly day-of-month)
+    next_occurrence_at = Column(DateTime(timezone=True))   # live instance of a series: when to insert the next one
     notes          = Column(Text, default="")
     attachment     = Column(String, default="")
     created_at     = Column(DateTime, default=datetime.utcnow, index=True)
+    completed_at   = Column(DateTime(timezone=True))     # set when status becomes 'done'
 
     user = relationship("User", back_populates="tasks")
 
+class TaskArchive(Base):
+    """Cold storage for done tasks (moved by db_helpers.archive_done_tasks); same ids as in tasks."""
+    __tablename__ = "tasks_archive"
+
+    id             = Column(Integer, primary_key=True, autoincrement=False)
+    user_id        = Column(String, index=True)
+    text           = Column(Text)
+    deadline       = Column(String)
+    deadline_at    = Column(DateTime(timezone=True))
+    reminders_sent = Column(Integer, default=0)
+    status         = Column(String, default="done")
+    priority       = Column(String, default="medium")
+    tags           = Column(String, default="")
+    repeat         = Column(String, default="")
+    notes          = Column(Text, default="")
+    attachment     = Column(String, default="")
+    created_at     = Column(DateTime)
+    completed_at   = Column(DateTime(timezone=True))
+    archived_at    = Column(DateTime(timezone=True))
+
 class Clan(Base):
     __tablename__ = "clans"
     __table_args__ = (UniqueConstraint('name', name='uq_clan_name'),)
@@ -79,6 +108,18 @@ class ClanMember(Base):
     clan = relationship("Clan", back_populates="members")
     user = relationship("User", back_populates="clan_memberships")
 
+class ClanStats(Base):
+    """
+    Per-clan counters kept in step with users.xp and clan_members by the db_helpers writers
+    (same transaction); reconcile_clan_stats() re-derives them and repairs any drift.
+    """
+    __tablename__ = "clan_stats"
+
+    clan_id      = Column(Integer, ForeignKey("clans.id", ondelete="CASCADE"), primary_key=True)
+    member_count = Column(Integer, nullable=False, default=0)
+    total_xp     = Column(BigInteger, nullable=False, default=0)
+    avg_xp       = Column(Float, Computed("CASE WHEN member_count > 0 THEN total_xp::float8 / member_count ELSE 0 END", persisted=True))
+
 class ClanApplication(Base):
     __tablename__ = "clan_applications"
     __table_args__ = (UniqueConstraint('clan_id', 'user_id', name='uq_clan_application'),)
@@ -93,6 +134,36 @@ class ClanApplication(Base):
     clan = relationship("Clan", back_populates="applications")
     user = relationship("User", back_populates="clan_applications")
 
+class XpEvent(Base):
+    """Append-only XP ledger (one row per credit). Folded into xp_daily by db_helpers.rollup_xp_events."""
+    __tablename__ = "xp_events"
+
+    id         = Column(BigInteger, primary_key=True, autoincrement=True)
+    user_id    = Column(String, nullable=False)
+    delta      = Column(Integer, nullable=False)
+    source     = Column(String, nullable=False)       # "task" | "award" | "admin"
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    # writing transaction's id: rollup folds an event only once no transaction that old is still open
+    xid        = Column(BigInteger, nullable=False, server_default=text("(pg_current_xact_id()::text::bigint)"))
+
+class XpDaily(Base):
+    """Per-user XP per local (Asia/Tashkent) day; period leaderboards read only this table."""
+    __tablename__ = "xp_daily"
+
+    user_id = Column(String, primary_key=True)
+    day     = Column(Date, primary_key=True)
+    xp      = Column(BigInteger, nullable=False, default=0)
+    task_xp = Column(BigInteger, nullable=False, default=0, server_default="0")   # positive "task" credits only; streaks read this
+
+class XpRollupCursor(Base):
+    """Single row: highest (xp_events.xid, xp_events.id) already folded into xp_daily."""
+    __tablename__ = "xp_rollup_cursor"
+
+    name     = Column(String, primary_key=True)
+    last_xid = Column(BigInteger, nullable=False, default=0)
+    last_id  = Column(BigInteger, nullable=False, default=0)
+
+
 class ClanCreationRequest(Base):
     __tablename__ = "clan_creation_requests"
 
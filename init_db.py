@@ -3,11 +3,37 @@ import asyncio
 from sqlalchemy import text
 from db import engine
 from db_models import Base
+from db_helpers import backfill_deadline_at, backfill_next_reminder_at, backfill_recurrence, reconcile_clan_stats
+
+# columns added after the first deploy (create_all never alters existing tables), plus one-off fills
+MIGRATION_SQL = """
+ALTER TABLE tasks ADD COLUMN IF NOT EXISTS deadline_at TIMESTAMPTZ;
+ALTER TABLE tasks ADD COLUMN IF NOT EXISTS next_reminder_at TIMESTAMPTZ;
+ALTER TABLE tasks ADD COLUMN IF NOT EXISTS repeat_anchor_at TIMESTAMPTZ;
+ALTER TABLE tasks ADD COLUMN IF NOT EXISTS next_occurrence_at TIMESTAMPTZ;
+ALTER TABLE tasks ADD COLUMN IF NOT EXISTS completed_at TIMESTAMPTZ;
+UPDATE tasks SET completed_at = created_at AT TIME ZONE 'UTC' WHERE status = 'done' AND completed_at IS NULL;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS streak_date DATE;
+ALTER TABLE xp_events ADD COLUMN IF NOT EXISTS xid BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE xp_events ALTER COLUMN xid SET DEFAULT (pg_current_xact_id()::text::bigint);
+ALTER TABLE xp_rollup_cursor ADD COLUMN IF NOT EXISTS last_xid BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE xp_daily ADD COLUMN IF NOT EXISTS task_xp BIGINT NOT NULL DEFAULT 0;
+DROP INDEX IF EXISTS idx_tasks_reminder;
+DROP INDEX IF EXISTS idx_clan_stats_total;
+DROP INDEX IF EXISTS idx_clan_stats_avg;
+"""
 
 INDEX_SQL = """
 CREATE INDEX IF NOT EXISTS idx_tasks_user_status    ON tasks (user_id, status);
 CREATE INDEX IF NOT EXISTS idx_tasks_deadline       ON tasks (deadline);
 CREATE INDEX IF NOT EXISTS idx_tasks_user_deadline  ON tasks (user_id, deadline);
+CREATE INDEX IF NOT EXISTS idx_tasks_user_status_dl ON tasks (user_id, status, deadline_at);
+CREATE INDEX IF NOT EXISTS idx_tasks_next_reminder  ON tasks (next_reminder_at) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_tasks_next_occurrence ON tasks (next_occurrence_at) WHERE next_occurrence_at IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_tasks_done_completed ON tasks (completed_at) WHERE status = 'done';
+CREATE INDEX IF NOT EXISTS idx_tasks_archive_user_done ON tasks_archive (user_id, completed_at);
+
+CREATE INDEX IF NOT EXISTS idx_users_xp             ON users (xp DESC, id);
 
 CREATE INDEX IF NOT EXISTS idx_clans_owner          ON clans (owner_id);
 CREATE INDEX IF NOT EXISTS idx_clans_approved       ON clans (is_approved);
@@ -15,14 +41,20 @@ CREATE INDEX IF NOT EXISTS idx_clan_members_clan    ON clan_members (clan_id);
 CREATE INDEX IF NOT EXISTS idx_clan_members_user    ON clan_members (user_id);
 CREATE INDEX IF NOT EXISTS idx_clan_apps_status     ON clan_applications (status);
 CREATE INDEX IF NOT EXISTS idx_clan_apps_clan       ON clan_applications (clan_id);
+CREATE INDEX IF NOT EXISTS idx_clan_stats_rank_total ON clan_stats (total_xp DESC, member_count DESC, clan_id DESC);
+CREATE INDEX IF NOT EXISTS idx_clan_stats_rank_avg   ON clan_stats (avg_xp DESC, member_count DESC, clan_id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_xp_events_created   ON xp_events (created_at);
+CREATE INDEX IF NOT EXISTS idx_xp_events_xid       ON xp_events (xid, id);
+CREATE INDEX IF NOT EXISTS idx_xp_daily_day        ON xp_daily (day) INCLUDE (user_id, xp);
 """
 
 async def main():
     async with engine.begin() as conn:
         # 1) create tables
         await conn.run_sync(Base.metadata.create_all)
-        # 2) create indexes (split & run each statement)
-        for stmt in INDEX_SQL.strip().split(";"):
+        # 2) add new columns, then create indexes (split & run each statement)
+        for stmt in (MIGRATION_SQL + INDEX_SQL).strip().split(";"):
             s = stmt.strip()
             if not s:
                 continue
@@ -32,5 +64,15 @@ async def main():
 
     print("Tables & indexes created!")
 
+    # 3) typed deadlines for rows written before deadline_at existed (resumable)
+    filled = await backfill_deadline_at()
+    print(f"Backfilled deadline_at for {filled} task(s).")
+    filled = await backfill_next_reminder_at()
+    print(f"Backfilled next_reminder_at for {filled} task(s).")
+    armed = await backfill_recurrence()
+    print(f"Armed {armed} repeating task series.")
+    checked, fixed = await reconcile_clan_stats()
+    print(f"Clan stats: {checked} clan(s) checked, {fixed} row(s) rebuilt.")
+
 if __name__ == "__main__":
     asyncio.run(main())
@@ -1,7 +1,9 @@
 import asyncio
+import html
 import pytz
 import os
 import re
+import time
 from aiogram import BaseMiddleware
 from datetime import datetime
 from aiogram import Bot, Dispatcher, F
@@ -12,6 +14,7 @@ from aiogram.types import (
     InlineKeyboardMarkup, InlineKeyboardButton
 )
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.client.default import DefaultBotProperties
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
@@ -19,8 +22,7 @@ import io, csv, zipfile
 from aiogram.types import BufferedInputFile
 from db_helpers import (
     get_or_create_user, get_user, get_user_by_id,
-    add_task, add_tasks_bulk, get_tasks, get_task_by_id,
-    mark_task_done, delete_task, get_top_users, get_all_users_with_tasks,
+    add_tasks_bulk, get_tasks, get_leaderboard, get_all_users_with_tasks,
     set_user_title, update_xp_streak_completed,
     update_task_text, update_task_deadline,
     update_task_priority, update_task_tags,
@@ -30,11 +32,20 @@ from db_helpers import (
     delete_clan, reject_clan_creation_request, approve_clan_creation_request, get_pending_clan_creation_requests, create_clan_creation_request,
     update_clan_info, show_group_card_paginated, admin_get_counts, get_all_user_ids, get_user_by_username,
     admin_get_groups_page, admin_toggle_group_approved, update_task_reminders_sent, set_clan_image,
-    export_users, export_tasks, export_clans, export_members, export_apps, set_user_username, award_xp_with_cap,
-    list_clan_members, remove_member_from_clan, get_clans_xp_leaderboard, get_clans_xp_leaderboard_page, get_tasks_for_reminder_window,
-    bulk_update_task_reminders_sent
+    export_users, export_tasks, export_clans, export_members, export_apps, set_user_username,
+    list_clan_members, remove_member_from_clan, get_clans_xp_leaderboard, get_clans_xp_leaderboard_page,
+    reconcile_clan_stats, get_xp_leaderboard, rollup_xp_events, compact_xp_ledger, catch_up_streaks,
+    get_tasks_filtered, get_upcoming_reminders,
+    claim_due_reminders, release_reminder_claims, user_cache, leaderboard as leaderboard_snapshot, touch_user, flush_user_activity,
+    complete_tasks, set_tasks_priority, set_tasks_tag, set_tasks_deadline, delete_tasks,
+    get_tasks_cached, task_cache, delete_tasks_in_scope, count_pending_tasks, PENDING_TASK_LIMIT, materialize_due_recurrences,
+    archive_done_tasks, task_storage_stats
 )
 from utils.parsing import parse_tasks_text, parse_natural_deadline, deadline_for_scope
+from utils.scheduler import reminder_scheduler, reminder_label, task_deadline_at
+from utils.sender import RateLimitedSender
+from utils.state_store import make_state_store
+from utils.cache import TTLCache
 
 
 
@@ -46,38 +57,53 @@ ADMIN_ID = int(os.getenv("ADMIN_ID", "5480597971"))
 XP_DAILY_CAP = 30
 bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 dp  = Dispatcher()
+reminder_sender = RateLimitedSender(bot)
 PER_PAGE_CLB = 10
 
 
 # — State trackers —
-user_adding_task    = set()
-user_edit_text      = {}
-user_edit_deadline  = {}
-user_edit_priority  = {}
-user_edit_tags      = {}
-users_requesting_group = set()
-users_editing_group = {}
-users_editing_group_photo = {}  # uid -> clan_id
-user_tasks_view = {}        # uid -> {"filter": str, "snapshot": [task_ids]}
-manage_wait = {}  
+# TTL-bounded conversation state (utils/state_store.py), namespaces keyed by user id:
+#   flow                      uid -> {"name": flow, "data": ...}   the one text-input flow the user is in
+#   user_add_scope            uid -> 'free'|'today'|'week'|'month'
+#   user_tasks_view           uid -> {"filter": str, "snapshot": [task_ids]}
+#   manage_select             uid -> {"action": str, "selected": set[int]}
+#   manage_batch              uid -> {"action":"prio"|"tag", "ids":[task_ids]}
+#   user_group_page           uid -> page_number
+# Flows (data in parentheses):
+#   user_adding_task (True) • user_edit_text (task_id) • user_edit_deadline (task_id)
+#   users_requesting_group (True) • users_editing_group (clan_id) • users_editing_group_photo (clan_id)
+#   manage_wait ({"action", "snapshot"}) • manage_custom_tag_wait ([task_ids]) • manage_deadline_wait ([task_ids])
+#   admin_broadcast_wait / admin_addxp_wait / admin_settitle_wait (True)
+# Values are stored by copy: after mutating one, set() it again.
+states = make_state_store()
 
-manage_select = {}          # uid -> {"action": str, "selected": set[int]}
 
-manage_batch = {}            # uid -> {"action":"prio"|"tag", "ids":[task_ids]}
-manage_custom_tag_wait = {} 
+# A user is in at most one flow; starting another replaces it. FlowMiddleware reads the entry once
+# per message and route_flow dispatches with a dict lookup, so routing cost doesn't grow with FLOWS.
+FLOWS: dict[str, tuple] = {}   # flow name -> (handler(msg, data), accepts(msg) | None)
 
-# --- Group Pagination State
-user_group_page = {}  # user_id: page_number
 
-user_add_scope = {}  # uid -> 'free'|'today'|'week'|'month'
+def flow_handler(name: str, accepts=None):
+    """Register `fn(msg, data)` for messages sent while the user is in flow `name`."""
+    def deco(fn):
+        FLOWS[name] = (fn, accepts)
+        return fn
+    return deco
 
-manage_deadline_wait = {}  # uid -> [task_ids] waiting for a single deadline value
 
+async def start_flow(uid, name: str, data=True):
+    await states.set("flow", uid, {"name": name, "data": data})
+
+
+async def end_flow(uid, only: str | None = None):
+    """Leave the current flow (only if it is `only`, when given) and return its data."""
+    if only:
+        cur = await states.get("flow", uid)
+        if not cur or cur["name"] != only:
+            return None
+    cur = await states.pop("flow", uid)
+    return cur["data"] if cur else None
 
-# --- Admin states ---
-admin_broadcast_wait = set()
-admin_addxp_wait     = set()
-admin_settitle_wait  = set()
 
 # — Constants & UX Setup —
 TASHKENT_TZ = pytz.timezone("Asia/Tashkent")
@@ -97,7 +123,7 @@ VALID_BUTTON_TEXTS = set(BUTTONS.values()) | {
     "👥 My Study Group", "➕ Request to Create Group", "🏆 Groups Leaderboard",
     # admin panel entries
     "📣 Broadcast", "➕ Add XP", "🏷️ Set Title", "📈 Stats",
-    "🗂 Groups (Admin)", "⬅️ Exit Admin"
+    "🗂 Groups (Admin)", "⬅️ Exit Admin", "📦 Backup", "📝 Apply to Study Group"
 }
 
 
@@ -258,61 +284,6 @@ FILTERS = [
 ]
 
 
-def _parse_deadline(dt_str: str):
-    if not dt_str:
-        return None
-    try:
-        return TASHKENT_TZ.localize(datetime.strptime(dt_str, "%Y-%m-%d %H:%M"))
-    except Exception:
-        return None
-
-def _filter_tasks(all_tasks, key: str):
-    # all_tasks are pending for the user (from get_tasks)
-    now = datetime.now(TASHKENT_TZ)
-    today = now.date()
-
-    # week bounds: Monday..Sunday
-    monday = today - timedelta(days=today.weekday())
-    sunday = monday + timedelta(days=6)
-
-    # month bounds: first..last
-    first_day = today.replace(day=1)
-    if first_day.month == 12:
-        next_first = first_day.replace(year=first_day.year+1, month=1)
-    else:
-        next_first = first_day.replace(month=first_day.month+1)
-    last_day = next_first - timedelta(days=1)
-
-    out = []
-    for t in all_tasks:
-        if getattr(t, "status", "pending") != "pending":
-            continue
-        d = _parse_deadline(t.deadline)
-
-        if key == "today":
-            if d and d.date() == today:
-                out.append(t)
-        elif key == "week":
-            if d and monday <= d.date() <= sunday:
-                out.append(t)
-        elif key == "month":
-            if d and first_day <= d.date() <= last_day:
-                out.append(t)
-        elif key == "repeating":
-            if (t.repeat or "") in ("daily","weekly","monthly"):
-                out.append(t)
-        else:  # "all"
-            out.append(t)
-    return out
-
-def _sort_tasks(tasks):
-    # sort by deadline (None at bottom), then created_at
-    return sorted(tasks, key=lambda t: (
-        0 if _parse_deadline(t.deadline) else 1,
-        _parse_deadline(t.deadline) or datetime.max.replace(tzinfo=TASHKENT_TZ),
-        t.created_at or datetime.utcnow()
-    ))
-
 def _repeat_pill(t):
     rep = (t.repeat or "")
     return f"  🔁 {rep.capitalize()}" if rep in ("daily","weekly","monthly") else ""
@@ -349,21 +320,34 @@ def _filters_kb(current: str):
     return InlineKeyboardMarkup(inline_keyboard=kb_rows)
 
 
-async def _show_tasks_list(msg_or_call, uid: str, filt: str):
-    all_tasks = await get_tasks(uid)
-    filt = filt if filt in {k for k,_ in FILTERS} else "all"
-    tasks = _sort_tasks(_filter_tasks(all_tasks, filt))
-    snapshot = [t.id for t in tasks]
-    user_tasks_view[uid] = {"filter": filt, "snapshot": snapshot}
+# (uid, filter, task-data version, minute) -> (text, kb, snapshot).
+# The minute bucket keeps relative labels ("Today", past-due bold) and scope bounds current;
+# anything else re-renders only when task_cache's version for the user moves.
+list_render_cache = TTLCache(maxsize=20_000, ttl=90)
+list_render_stats = {"renders": 0, "render_ms": 0.0}
 
-    name = dict(FILTERS)[filt]
-    if not tasks:   
-        text = f"📝 <b>Your Tasks</b> — {name}\n\nNothing here yet. Try another filter."
-    else:
-        blocks = _render_task_blocks(tasks)
-        text = f"📝 <b>Your Tasks</b> — {name} • {len(tasks)}\n" + "\n\n".join(blocks)
 
-    kb = _filters_kb(filt)
+async def _show_tasks_list(msg_or_call, uid: str, filt: str):
+    filt = filt if filt in {k for k,_ in FILTERS} else "all"
+    key = (uid, filt, task_cache.version(uid), int(time.time() // 60))
+    cached = list_render_cache.get(key)
+    if cached is None:
+        started = time.perf_counter()
+        # scope and ordering are both applied in SQL
+        tasks = await get_tasks_filtered(uid, filt)
+        name = dict(FILTERS)[filt]
+        if not tasks:   
+            text = f"📝 <b>Your Tasks</b> — {name}\n\nNothing here yet. Try another filter."
+        else:
+            blocks = _render_task_blocks(tasks)
+            text = f"📝 <b>Your Tasks</b> — {name} • {len(tasks)}\n" + "\n\n".join(blocks)
+        cached = (text, _filters_kb(filt), [t.id for t in tasks])
+        list_render_cache.set(key, cached)
+        list_render_stats["renders"] += 1
+        list_render_stats["render_ms"] += (time.perf_counter() - started) * 1000
+
+    text, kb, snapshot = cached
+    await states.set("user_tasks_view", uid, {"filter": filt, "snapshot": snapshot})
     if isinstance(msg_or_call, Message):
         await msg_or_call.answer(text, reply_markup=kb)
     else:
@@ -380,7 +364,8 @@ class EnsureUserMiddleware(BaseMiddleware):
         u = getattr(event, "from_user", None)
         if u and u.id:
             # this guarantees users row exists before ANY handler runs
-            await get_or_create_user(
+            # (cached users cost no query; last_active/username are written behind)
+            await touch_user(
                 str(u.id),
                 name=u.full_name or "Unknown",
                 username=u.username or ""
@@ -392,19 +377,47 @@ dp.message.middleware(EnsureUserMiddleware())
 dp.callback_query.middleware(EnsureUserMiddleware())
 
 
+class FlowMiddleware(BaseMiddleware):
+    """Outer middleware: one state lookup per message, exposed to filters and handlers as `flow`."""
+    async def __call__(self, handler, event, data):
+        u = getattr(event, "from_user", None)
+        data["flow"] = await states.get("flow", u.id) if u else None
+        return await handler(event, data)
+
+dp.message.outer_middleware(FlowMiddleware())
+
+
+def _is_menu_input(msg: Message) -> bool:
+    # menu buttons and commands always reach their own handlers, even mid-flow
+    text = msg.text or ""
+    return text in VALID_BUTTON_TEXTS or text.startswith("/")
+
+
+def _flow_accepts(msg: Message, flow: dict | None = None) -> bool:
+    entry = FLOWS.get(flow["name"]) if flow else None
+    if entry is None or _is_menu_input(msg):
+        return False
+    accepts = entry[1]
+    return accepts is None or bool(accepts(msg))
+
+
+# registered before every other message handler: a message that belongs to a flow goes there
+@dp.message(_flow_accepts)
+async def route_flow(msg: Message, flow: dict):
+    handler, _ = FLOWS[flow["name"]]
+    await handler(msg, flow["data"])
+
+
 
 
 def _repeat_text(t):
     rep = (t.repeat or "").lower()
     return f"🔁 {rep.capitalize()}" if rep in ("daily", "weekly", "monthly") else ""
 
-def _pretty_deadline_str(dl_str: str) -> str:
-    if not dl_str:
-        return "No deadline"
-    try:
-        dt = TASHKENT_TZ.localize(datetime.strptime(dl_str, "%Y-%m-%d %H:%M"))
-    except Exception:
+def _pretty_deadline(deadline_at: datetime | None) -> str:
+    if deadline_at is None:
         return "No deadline"
+    dt = deadline_at.astimezone(TASHKENT_TZ)
 
     now   = datetime.now(TASHKENT_TZ)
     today = now.date()
@@ -434,7 +447,7 @@ def _render_task_blocks(tasks):
         title = _clip(t.text, 70)
         prio  = (t.priority or "medium").capitalize()
         tag   = (t.tags or "None")
-        due   = _pretty_deadline_str(t.deadline or "")
+        due   = _pretty_deadline(task_deadline_at(t))
 
         line1 = f"{i}) {title}"
         line2_parts = [f"⏰ {due}", f"⚡ {prio}", f"🏷 {tag}"]
@@ -466,9 +479,9 @@ async def cmd_start(msg: Message):
 @dp.message(F.text == BUTTONS["ADD"])
 async def add_task_prompt(msg: Message):
     uid = str(msg.from_user.id)
-    user_adding_task.add(uid)
-    user_add_scope[uid] = "free"  # default
-    await msg.answer("✍️ Send your task(s) now (up to 10 pending). You can paste multiple lines.", reply_markup=main_kb())
+    await start_flow(uid, "user_adding_task")
+    await states.set("user_add_scope", uid, "free")  # default
+    await msg.answer(f"✍️ Send your task(s) now (up to {PENDING_TASK_LIMIT} pending). You can paste multiple lines.", reply_markup=main_kb())
     await msg.answer("🎯 When are these for? Pick a scope:", reply_markup=add_scope_kb())
     
 
@@ -478,7 +491,7 @@ async def addscope_cb(cb: CallbackQuery):
     scope = cb.data.split(":",1)[1]
     if scope not in ("today","week","month","free"):
         return await cb.answer("Unknown", show_alert=True)
-    user_add_scope[uid] = scope
+    await states.set("user_add_scope", uid, scope)
     pretty = {"today":"🌞 Today","week":"🗓️ This Week","month":"📆 This Month","free":"📝 No deadline"}[scope]
 
     await cb.answer(f"Scope: {pretty}")
@@ -492,13 +505,13 @@ async def addscope_cb(cb: CallbackQuery):
 async def tasks_manage_choose(cb: CallbackQuery):
     uid = str(cb.from_user.id)
     action = cb.data.split(":",1)[1]  # done|delete|prio|tag|deadline
-    view = user_tasks_view.get(uid)
+    view = await states.get("user_tasks_view", uid)
     if not view or not view.get("snapshot"):
         return await cb.answer("Nothing to manage.", show_alert=True)
     if action not in {"done","delete","prio","tag","deadline"}:
         return await cb.answer("Unknown action.", show_alert=True)
 
-    manage_select[uid] = {"action": action, "selected": set()}
+    await states.set("manage_select", uid, {"action": action, "selected": set()})
     await _render_select_ui(cb, uid)
     await cb.answer()
 
@@ -514,8 +527,8 @@ def _action_name(a: str) -> str:
 
 async def _get_snapshot_tasks(uid: str):
     # map snapshot ids -> task objects in current order
-    snapshot = (user_tasks_view.get(uid) or {}).get("snapshot", [])
-    tasks = await get_tasks(uid)
+    snapshot = (await states.get("user_tasks_view", uid) or {}).get("snapshot", [])
+    tasks = await get_tasks_cached(uid)
     by_id = {t.id: t for t in tasks}
     ordered = [by_id[i] for i in snapshot if i in by_id]
     return ordered
@@ -539,7 +552,9 @@ def _select_kb(uid: str, tasks, selected: set[int]):
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 async def _render_select_ui(cb_or_msg, uid: str):
-    state = manage_select.get(uid)
+    state = await states.get("manage_select", uid)
+    if not state:
+        return
     action = state["action"]
     tasks = await _get_snapshot_tasks(uid)
     title = f"🧰 <b>Manage tasks</b> — {_action_name(action)}\nTap to select items, then <b>Proceed</b>."
@@ -555,31 +570,34 @@ async def _render_select_ui(cb_or_msg, uid: str):
 @dp.callback_query(F.data.startswith("sel_toggle:"))
 async def sel_toggle(cb: CallbackQuery):
     uid = str(cb.from_user.id)
-    st = manage_select.get(uid)
+    st = await states.get("manage_select", uid)
     if not st: return await cb.answer()
     idx = int(cb.data.split(":")[1])
     if idx in st["selected"]:
         st["selected"].remove(idx)
     else:
         st["selected"].add(idx)
+    await states.set("manage_select", uid, st)
     await _render_select_ui(cb, uid)
     await cb.answer()
 
 @dp.callback_query(F.data == "sel_all")
 async def sel_all(cb: CallbackQuery):
     uid = str(cb.from_user.id)
-    st = manage_select.get(uid)
+    st = await states.get("manage_select", uid)
     if not st: return await cb.answer()
     tasks = await _get_snapshot_tasks(uid)
     st["selected"] = set(range(1, len(tasks)+1))
+    await states.set("manage_select", uid, st)
     await _render_select_ui(cb, uid); await cb.answer()
 
 @dp.callback_query(F.data == "sel_clear")
 async def sel_clear(cb: CallbackQuery):
     uid = str(cb.from_user.id)
-    st = manage_select.get(uid)
+    st = await states.get("manage_select", uid)
     if not st: return await cb.answer()
     st["selected"].clear()
+    await states.set("manage_select", uid, st)
     await _render_select_ui(cb, uid); await cb.answer()
 
 
@@ -587,10 +605,10 @@ async def sel_clear(cb: CallbackQuery):
 @dp.callback_query(F.data == "sel_go")
 async def sel_go(cb: CallbackQuery):
     uid = str(cb.from_user.id)
-    st = manage_select.pop(uid, None)
+    st = await states.pop("manage_select", uid)
     if not st: return await cb.answer()
     action = st["action"]
-    view = user_tasks_view.get(uid) or {}
+    view = await states.get("user_tasks_view", uid) or {}
     snapshot = view.get("snapshot", [])
     # build ids from selected indexes
     if not st["selected"]:
@@ -600,17 +618,17 @@ async def sel_go(cb: CallbackQuery):
 
     # branch like your old flow
     if action == "prio":
-        manage_batch[uid] = {"action":"prio", "ids": ids}
+        await states.set("manage_batch", uid, {"action":"prio", "ids": ids})
         await cb.message.answer("Choose priority for the selected task(s):", reply_markup=_batch_priority_kb())
         return await cb.answer()
 
     if action == "tag":
-        manage_batch[uid] = {"action":"tag", "ids": ids}
+        await states.set("manage_batch", uid, {"action":"tag", "ids": ids})
         await cb.message.answer("Choose a tag (or Custom) for the selected task(s):", reply_markup=_batch_tags_kb())
         return await cb.answer()
 
     if action == "deadline":
-        manage_deadline_wait[uid] = ids
+        await start_flow(uid, "manage_deadline_wait", ids)
         copy_block, reference = build_deadline_examples_text()
         await cb.message.answer(
             "⏰ Send a deadline.\nTap to copy one of these, or type your own:\n"
@@ -621,29 +639,15 @@ async def sel_go(cb: CallbackQuery):
 
     # delete / done
     if action == "delete":
-        deleted = 0
-        for tid in ids:
-            try:
-                await delete_task(tid); deleted += 1
-            except: pass
+        deleted = len(await delete_tasks(uid, ids))
         await cb.message.answer(f"🗑 Deleted: {', '.join(map(str, indices))}  (total {deleted})")
         await _show_tasks_list(cb, uid, (view.get("filter") or "all"))
         return await cb.answer("Done")
 
-    # mark done with XP cap (same as your existing code)
-    requested = 0; count = 0
-    for tid in ids:
-        try:
-            t = await get_task_by_id(tid)
-            if not t: continue
-            base = 2
-            prio_bonus = {"low":0,"medium":2,"high":4}.get((t.priority or "low"), 0)
-            tag_bonus  = 1 if "study" in (t.tags or "") else 0
-            requested += (base + prio_bonus + tag_bonus)
-            await mark_task_done(tid); count += 1
-        except: pass
-
-    applied, _ = await award_xp_with_cap(uid, requested_xp=requested, completed_delta=count, cap=XP_DAILY_CAP, tz_name="Asia/Tashkent")
+    # mark done with XP cap: one statement for the whole selection
+    applied, results = await complete_tasks(uid, ids, cap=XP_DAILY_CAP, tz_name="Asia/Tashkent")
+    count = len(results)
+    requested = sum(req for _, req, _ in results)
     if count == 0:
         await cb.message.answer("Nothing changed.", reply_markup=main_kb())
     elif applied == requested:
@@ -805,7 +809,7 @@ async def tasks_back_cb(cb: CallbackQuery):
 @dp.callback_query(F.data == "tasks_manage")
 async def tasks_manage_open(cb: CallbackQuery):
     uid = str(cb.from_user.id)
-    view = user_tasks_view.get(uid)
+    view = await states.get("user_tasks_view", uid)
     if not view or not view.get("snapshot"):
         await cb.answer("Nothing to manage.", show_alert=True)
         return
@@ -819,7 +823,7 @@ async def tasks_manage_open(cb: CallbackQuery):
 
 @dp.callback_query(F.data == "tasks_manage_cancel")
 async def tasks_manage_cancel(cb: CallbackQuery):
-    manage_wait.pop(str(cb.from_user.id), None)
+    await end_flow(cb.from_user.id, only="manage_wait")
     await cb.answer("Canceled")
 
 
@@ -845,14 +849,12 @@ def _parse_selection_numbers(text: str, max_n: int) -> list[int]:
             except: pass
     return sorted(nums)
 
-@dp.message(lambda m: str(m.from_user.id) in manage_wait and m.text not in VALID_BUTTON_TEXTS)
-async def manage_apply_numbers(msg: Message):
+@flow_handler("manage_wait", accepts=lambda m: m.text)
+async def manage_apply_numbers(msg: Message, state: dict):
     uid = str(msg.from_user.id)
-    state = manage_wait.pop(uid, None)
-    if not state:
-        return
+    await end_flow(uid)
 
-    view = user_tasks_view.get(uid) or {}
+    view = await states.get("user_tasks_view", uid) or {}
     snapshot = state.get("snapshot") or []
     max_n = len(snapshot)
 
@@ -865,16 +867,16 @@ async def manage_apply_numbers(msg: Message):
 
     # ---- edit priority / tag → ask for a choice ----
     if action == "prio":
-        manage_batch[uid] = {"action": "prio", "ids": ids}
+        await states.set("manage_batch", uid, {"action": "prio", "ids": ids})
         return await msg.answer("Choose priority for the selected task(s):", reply_markup=_batch_priority_kb())
 
     if action == "tag":
-        manage_batch[uid] = {"action": "tag", "ids": ids}
+        await states.set("manage_batch", uid, {"action": "tag", "ids": ids})
         return await msg.answer("Choose a tag (or Custom) for the selected task(s):", reply_markup=_batch_tags_kb())
 
     # ---- NEW: deadline → show your existing guide and wait for one value ----
     if action == "deadline":
-        manage_deadline_wait[uid] = ids
+        await start_flow(uid, "manage_deadline_wait", ids)
         try:
             copy_block, reference = build_deadline_examples_text()
             await msg.answer(
@@ -894,37 +896,14 @@ async def manage_apply_numbers(msg: Message):
 
     # ---- delete / done (unchanged) ----
     if action == "delete":
-        deleted = 0
-        for tid in ids:
-            try:
-                await delete_task(tid)
-                deleted += 1
-            except:
-                pass
+        deleted = len(await delete_tasks(uid, ids))
         await msg.answer(f"🗑 Deleted: {', '.join(map(str, indices))}  (total {deleted})")
         return await _show_tasks_list(msg, uid, (view.get("filter") or "all"))
 
     # "done" with XP cap
-    requested = 0
-    count = 0
-    for tid in ids:
-        try:
-            t = await get_task_by_id(tid)
-            if not t:
-                continue
-            base       = 2
-            prio_bonus = {"low":0,"medium":2,"high":4}.get((t.priority or "low"), 0)
-            tag_bonus  = 1 if "study" in (t.tags or "") else 0
-            requested += (base + prio_bonus + tag_bonus)
-            await mark_task_done(tid)
-            count += 1
-        except:
-            pass
-
-    applied, _ = await award_xp_with_cap(
-        uid, requested_xp=requested, completed_delta=count,
-        cap=XP_DAILY_CAP, tz_name="Asia/Tashkent"
-    )
+    applied, results = await complete_tasks(uid, ids, cap=XP_DAILY_CAP, tz_name="Asia/Tashkent")
+    count = len(results)
+    requested = sum(req for _, req, _ in results)
 
     if count == 0:
         return await msg.answer("Nothing changed.", reply_markup=main_kb())
@@ -945,10 +924,10 @@ async def manage_apply_numbers(msg: Message):
 
 
 
-@dp.message(lambda m: str(m.from_user.id) in manage_deadline_wait and m.text)
-async def tasks_batch_deadline_text(msg: Message):
+@flow_handler("manage_deadline_wait", accepts=lambda m: m.text)
+async def tasks_batch_deadline_text(msg: Message, ids: list):
     uid = str(msg.from_user.id)
-    ids = manage_deadline_wait.pop(uid, [])
+    await end_flow(uid)
 
     raw = msg.text.strip()
 
@@ -974,16 +953,10 @@ async def tasks_batch_deadline_text(msg: Message):
         return await msg.answer("⚠️ Couldn't parse that. Try e.g. <b>21:00</b>, <b>tomorrow 09:00</b>, "
                                 "<b>next mon 14:30</b>, <b>in 2h</b>, or <b>YYYY-MM-DD HH:MM</b>.")
 
-    changed = 0
-    for tid in ids:
-        try:
-            await update_task_deadline(tid, iso)
-            changed += 1
-        except:
-            pass
+    changed = len(await set_tasks_deadline(uid, ids, iso))
 
     await msg.answer(f"⏰ Deadline → <b>{iso}</b> for {changed} task(s).")
-    view = user_tasks_view.get(uid) or {}
+    view = await states.get("user_tasks_view", uid) or {}
     await _show_tasks_list(msg, uid, (view.get('filter') or 'all'))
 
 
@@ -993,31 +966,25 @@ async def tasks_batch_deadline_text(msg: Message):
 @dp.callback_query(F.data.startswith("tasks_batch_prio:"))
 async def tasks_batch_prio(cb: CallbackQuery):
     uid = str(cb.from_user.id)
-    data = manage_batch.get(uid)
+    data = await states.get("manage_batch", uid)
     if not data or data.get("action") != "prio":
         return await cb.answer("No selection.", show_alert=True)
 
     prio = cb.data.split(":",1)[1]  # low|medium|high
     ids = data["ids"]
-    changed = 0
-    for tid in ids:
-        try:
-            await update_task_priority(int(tid), prio)
-            changed += 1
-        except:
-            pass
+    changed = len(await set_tasks_priority(uid, ids, prio))
 
-    manage_batch.pop(uid, None)
+    await states.pop("manage_batch", uid)
     await cb.message.answer(f"⚡ Priority → <b>{prio.capitalize()}</b> for {changed} task(s).", reply_markup=main_kb())
 
-    view = user_tasks_view.get(uid) or {}
+    view = await states.get("user_tasks_view", uid) or {}
     await _show_tasks_list(cb, uid, (view.get("filter") or "all"))
     await cb.answer("Updated")
 
 @dp.callback_query(F.data.startswith("tasks_batch_tag:"))
 async def tasks_batch_tag(cb: CallbackQuery):
     uid = str(cb.from_user.id)
-    data = manage_batch.get(uid)
+    data = await states.get("manage_batch", uid)
     if not data or data.get("action") != "tag":
         return await cb.answer("No selection.", show_alert=True)
 
@@ -1025,60 +992,48 @@ async def tasks_batch_tag(cb: CallbackQuery):
     ids = data["ids"]
 
     if val == "custom":
-        manage_custom_tag_wait[uid] = ids
+        await start_flow(uid, "manage_custom_tag_wait", ids)
         await cb.message.answer("✏️ Send one tag (e.g., <code>errands</code>). I’ll set it for the selected task(s).")
         await cb.answer()
         return
 
     # quick tag
-    changed = 0
-    for tid in ids:
-        try:
-            await update_task_tags(int(tid), val)
-            changed += 1
-        except:
-            pass
+    changed = len(await set_tasks_tag(uid, ids, val))
 
-    manage_batch.pop(uid, None)
+    await states.pop("manage_batch", uid)
     await cb.message.answer(f"🏷 Tag → <b>{val}</b> for {changed} task(s).", reply_markup=main_kb())
 
-    view = user_tasks_view.get(uid) or {}
+    view = await states.get("user_tasks_view", uid) or {}
     await _show_tasks_list(cb, uid, (view.get("filter") or "all"))
     await cb.answer("Updated")
-@dp.message(lambda m: str(m.from_user.id) in manage_custom_tag_wait and m.text)
-async def tasks_batch_tag_custom_text(msg: Message):
+@flow_handler("manage_custom_tag_wait", accepts=lambda m: m.text)
+async def tasks_batch_tag_custom_text(msg: Message, ids: list):
     uid = str(msg.from_user.id)
-    ids = manage_custom_tag_wait.pop(uid, [])
+    await end_flow(uid)
     raw = msg.text.strip()
     tag = raw.lstrip("#").strip().split()[0].lower()[:30]  # simple, safe
 
     if not tag:
         return await msg.answer("Empty tag. Try again from Manage → Set tag.", reply_markup=main_kb())
 
-    changed = 0
-    for tid in ids:
-        try:
-            await update_task_tags(int(tid), tag)
-            changed += 1
-        except:
-            pass
+    changed = len(await set_tasks_tag(uid, ids, tag))
 
     await msg.answer(f"🏷 Tag → <b>{tag}</b> for {changed} task(s).")
-    view = user_tasks_view.get(uid) or {}
+    view = await states.get("user_tasks_view", uid) or {}
     await _show_tasks_list(msg, uid, (view.get('filter') or 'all'))
 
 @dp.callback_query(F.data == "tasks_batch_cancel")
 async def tasks_batch_cancel(cb: CallbackQuery):
     uid = str(cb.from_user.id)
-    manage_batch.pop(uid, None)
-    manage_custom_tag_wait.pop(uid, None)
+    await states.pop("manage_batch", uid)
+    await end_flow(uid, only="manage_custom_tag_wait")
     await cb.answer("Canceled")
 
 
 @dp.callback_query(F.data == "tasks_clear_confirm")
 async def tasks_clear_confirm(cb: CallbackQuery):
     uid = str(cb.from_user.id)
-    view = user_tasks_view.get(uid)
+    view = await states.get("user_tasks_view", uid)
     if not view: 
         return await cb.answer("Nothing to clear.", show_alert=True)
     filt = view["filter"]
@@ -1095,14 +1050,7 @@ async def tasks_clear_confirm(cb: CallbackQuery):
 async def tasks_clear_do(cb: CallbackQuery):
     uid  = str(cb.from_user.id)
     filt = cb.data.split(":",1)[1]
-    all_tasks = await get_tasks(uid)
-    targets = _sort_tasks(_filter_tasks(all_tasks, filt))
-    deleted = 0
-    for t in targets:
-        try:
-            await delete_task(t.id)
-            deleted += 1
-        except: pass
+    deleted = await delete_tasks_in_scope(uid, filt)
     await cb.message.answer(f"🗑 Cleared {deleted} task(s) from {dict(FILTERS)[filt]}.")
     await _show_tasks_list(cb, uid, filt)
     await cb.answer()
@@ -1111,33 +1059,21 @@ async def tasks_clear_do(cb: CallbackQuery):
 @dp.callback_query(F.data.startswith("done:"))
 async def cb_done(call: CallbackQuery):
     tid  = int(call.data.split(":",1)[1])
-    task = await get_task_by_id(tid)
-    if not task:
+
+    # mark done + award with cap, in one statement
+    applied, results = await complete_tasks(
+        str(call.from_user.id), [tid],
+        cap=XP_DAILY_CAP,
+        tz_name="Asia/Tashkent",
+    )
+    if not results:
         await call.answer("Task not found.", show_alert=True)
         try:
-            await call.message.edit_text("⚠️ Task no longer exists.")
+            await call.message.edit_text("⚠️ Task no longer exists or is already done.")
         except:
             pass
         return
 
-    # XP calc
-    base       = 2
-    prio_bonus = {"low":0,"medium":2,"high":4}.get((task.priority or "low"), 0)
-    tag_bonus  = 1 if "study" in (task.tags or "") else 0
-    xp_gain    = base + prio_bonus + tag_bonus
-
-    # mark done first
-    await mark_task_done(tid)
-
-    # award with cap
-    applied, _ = await award_xp_with_cap(
-        str(call.from_user.id),
-        requested_xp=xp_gain,
-        completed_delta=1,
-        cap=XP_DAILY_CAP,
-        tz_name="Asia/Tashkent",
-    )
-
     if applied > 0:
         await call.answer(f"✅ Done! +{applied} XP")
     else:
@@ -1149,9 +1085,7 @@ async def cb_done(call: CallbackQuery):
 @dp.callback_query(F.data == "clear_all")
 async def cb_clear_all(call: CallbackQuery):
     uid   = str(call.from_user.id)
-    tasks = await get_tasks(uid)
-    for t in tasks:
-        await delete_task(t.id)
+    await delete_tasks_in_scope(uid, "all")
     await call.answer("🗑️ All cleared!")
     await call.message.answer("Back to main menu.", reply_markup=main_kb())
 
@@ -1166,14 +1100,14 @@ async def cb_menu(call: CallbackQuery):
 @dp.callback_query(F.data.startswith("edit_text:"))
 async def cb_edit_text(call: CallbackQuery):
     tid = int(call.data.split(":",1)[1])
-    user_edit_text[str(call.from_user.id)] = tid
+    await start_flow(call.from_user.id, "user_edit_text", tid)
     await call.answer()
     await call.message.answer("✏️ Send the new text:", reply_markup=main_kb())
 
 @dp.callback_query(F.data.startswith("edit_deadline:"))
 async def cb_edit_deadline(call: CallbackQuery):
     tid = int(call.data.split(":",1)[1])
-    user_edit_deadline[str(call.from_user.id)] = tid
+    await start_flow(call.from_user.id, "user_edit_deadline", tid)
     await call.answer()
 
     copy_block, reference = build_deadline_examples_text()
@@ -1232,10 +1166,10 @@ def uname(u) -> str:
     return f"@{handle}" if handle else (getattr(u, "name", "") or "")
 
 
-@dp.message(lambda m: str(m.from_user.id) in user_edit_deadline and m.text not in VALID_BUTTON_TEXTS)
-async def handle_edit_deadline(msg: Message):
+@flow_handler("user_edit_deadline", accepts=lambda m: m.text)
+async def handle_edit_deadline(msg: Message, tid: int):
     uid = str(msg.from_user.id)
-    tid = user_edit_deadline.pop(uid)
+    await end_flow(uid)
     raw = msg.text.strip()
 
     # Try natural-language parsing first
@@ -1348,15 +1282,15 @@ async def cb_set_group_photo(cb: CallbackQuery):
     if not user_clans or user_clans[0].owner_id != uid:
         return await cb.answer("Only founders can set the cover photo.", show_alert=True)
     clan = user_clans[0]
-    users_editing_group_photo[uid] = clan.id
+    await start_flow(uid, "users_editing_group_photo", clan.id)
     await cb.message.answer("🖼 Send a <b>photo</b> to use as your group cover.")
     await cb.answer()
 
 
-@dp.message(lambda m: str(m.from_user.id) in users_editing_group_photo and m.photo)
-async def handle_group_photo(msg: Message):
+@flow_handler("users_editing_group_photo", accepts=lambda m: m.photo)
+async def handle_group_photo(msg: Message, clan_id: int):
     uid = str(msg.from_user.id)
-    clan_id = users_editing_group_photo.pop(uid)
+    await end_flow(uid)
     fid = msg.photo[-1].file_id  # highest resolution
     ok = await set_clan_image(clan_id, fid)
     if ok:
@@ -1365,49 +1299,42 @@ async def handle_group_photo(msg: Message):
         await msg.answer("❌ Failed to update group photo.", reply_markup=main_kb())
 
 
-@dp.message(lambda m: str(m.from_user.id) in user_edit_text and m.text not in VALID_BUTTON_TEXTS)
-async def handle_edit_text(msg: Message):
+@flow_handler("user_edit_text", accepts=lambda m: m.text)
+async def handle_edit_text(msg: Message, tid: int):
     uid = str(msg.from_user.id)
-    tid = user_edit_text.pop(uid)
+    await end_flow(uid)
     await update_task_text(tid, msg.text)
     await msg.answer("✅ Text updated!", reply_markup=main_kb())
 
 
 
-@dp.message(lambda m: str(m.from_user.id) in user_adding_task and m.text not in VALID_BUTTON_TEXTS)
-async def catch_add_task(msg: Message):
+@flow_handler("user_adding_task", accepts=lambda m: m.text)
+async def catch_add_task(msg: Message, _):
     uid    = str(msg.from_user.id)
-    pending= await get_tasks(uid)
-    if len(pending) >= 10:
-        user_adding_task.discard(uid)
-        user_add_scope.pop(uid, None)
-        return await msg.answer("⚠️ You already have 10 pending tasks.", reply_markup=main_kb())
+    if await count_pending_tasks(uid) >= PENDING_TASK_LIMIT:
+        await end_flow(uid)
+        await states.pop("user_add_scope", uid)
+        return await msg.answer(f"⚠️ You already have {PENDING_TASK_LIMIT} pending tasks.", reply_markup=main_kb())
 
     parsed = parse_tasks_text(msg.text)
     if not parsed:
         return await msg.answer("⚠️ Invalid format. Try again.", reply_markup=main_kb())
 
-    scope = user_add_scope.get(uid, "free")
-    added = 0
-
-    if scope == "free":
-        await add_tasks_bulk(uid, parsed)
-        added = len(parsed)
-    else:
+    scope = await states.get("user_add_scope", uid, "free")
+    fields = {}
+    if scope != "free":
         dt = deadline_for_scope(scope, tz_name="Asia/Tashkent")
-        deadline_str = dt.strftime("%Y-%m-%d %H:%M")
-        for text in parsed:
-            try:
-                await add_task(uid, text, deadline=deadline_str)
-            except TypeError:
-                # if your add_task signature is positional (text, deadline)
-                await add_task(uid, text, deadline_str)
-            added += 1
-
-    user_adding_task.discard(uid)
-    user_add_scope.pop(uid, None)
+        fields["deadline"] = dt.strftime("%Y-%m-%d %H:%M")
+
+    # one INSERT for the whole paste; the cap is re-checked under a lock inside it
+    added = len(await add_tasks_bulk(uid, parsed, limit=PENDING_TASK_LIMIT, **fields))
+
+    await end_flow(uid)
+    await states.pop("user_add_scope", uid)
     pretty = {"today":"🌞 Today","week":"🗓️ This Week","month":"📆 This Month","free":"📝 No deadline"}[scope]
-    await msg.answer(f"✅ Added {added} task(s) ({pretty}).", reply_markup=main_kb())
+    skipped = len(parsed) - added
+    note = f"\n⚠️ {skipped} skipped — limit is {PENDING_TASK_LIMIT} pending tasks." if skipped else ""
+    await msg.answer(f"✅ Added {added} task(s) ({pretty}).{note}", reply_markup=main_kb())
 
 
 # — Profile, Leaderboard, Report —
@@ -1420,6 +1347,7 @@ async def profile(msg: Message):
     curr, nxt, pct = _rank_progress(user.xp)
     bar = _bar10(pct)  # ▰▰▰▱… 10-seg bar
     next_line = f"➡️ Next: {'⚡ ' + nxt if nxt else '—'}"
+    board = await get_leaderboard()
 
     text = (
         "👤 <b>Profile</b>\n"
@@ -1430,6 +1358,7 @@ async def profile(msg: Message):
         f"✅ Completed: {user.completed}\n"
         f"🔥 Streak: {user.streak} days\n"
         f"⚡ XP: {user.xp} ({curr})\n"
+        f"🏅 Rank: #{board.rank(user.id, user.xp)} of {board.total(user.id)}\n"
         f"{bar}\n"
 
         f"{next_line}"
@@ -1439,20 +1368,59 @@ async def profile(msg: Message):
 
 
 
+LB_PERIODS = {"all": "🏅 All time", "day": "📅 Today", "week": "🗓 This week", "month": "📆 This month"}
+
+def _user_lb_kb(period: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text=f"• {label} •" if p == period else label, callback_data=f"plb:{p}")
+        for p, label in LB_PERIODS.items()
+    ]])
+
+def _lb_line(pos, u, me=False, rank=True):
+    line = (f"{pos}. {u.name}{' | ⚜️ '+u.extra_title+' ⚜️' if u.extra_title else ''}"
+            f" – {u.xp} XP" + (f" ({get_rank(u.xp)})" if rank else ""))
+    return f"<b>{line}</b> ⬅️" if me else line
+
+async def _user_lb_text(user, period: str = "all") -> str:
+    if period != "all":
+        top = await get_xp_leaderboard(period, limit=10)
+        lines = [_lb_line(i+1, u, u.user_id == user.id, rank=False) for i, u in enumerate(top)]
+        return (f"🏅 <b>Top 10 — {LB_PERIODS[period].split(' ', 1)[1]}</b>\n" + ("\n".join(lines) or "No XP earned yet.")
+                + "\n\n<i>XP earned in the period; updates every minute.</i>")
+
+    board = await get_leaderboard()
+    top = board.top_ranked(user, 10)
+    lines = [_lb_line(pos, u, u.user_id == user.id) for pos, u in top]
+    shown = {u.user_id for _, u in top}
+    if user.id not in shown:
+        my_rank, window = board.around(user, k=5)
+        lines.append(f"\n📍 <b>Around you</b> (#{my_rank} of {board.total(user.id)})")
+        lines += [_lb_line(pos, u, u.user_id == user.id) for pos, u in window if u.user_id not in shown]
+    return (
+        "🏅 <b>Top 10 Leaderboard</b>\n" + "\n".join(lines) +
+        "\n\n<b>Ranks:</b>\n🎯 Rookie under 200 XP\n⚡ Achiever 200–499\n🔥 Crusher 500–1199\n"
+        "🏆 Master 1200–2499\n🌟 Legend 2500+"
+    )
+
 @dp.message(F.text == BUTTONS["LB"])
 async def leaderboard(msg: Message):
-    top = await get_top_users(10)
-    lines = [
-        f"{i+1}. {u.name}{' | ⚜️ '+u.extra_title+' ⚜️' if u.extra_title else ''}"
-        f" – {u.xp} XP ({get_rank(u.xp)})"
-        for i,u in enumerate(top)
-    ]
-    await msg.answer(
-    "🏅 <b>Top 10 Leaderboard</b>\n" + "\n".join(lines) +
-    "\n\n<b>Ranks:</b>\n🎯 Rookie under 200 XP\n⚡ Achiever 200–499\n🔥 Crusher 500–1199\n"
-    "🏆 Master 1200–2499\n🌟 Legend 2500+",
-    parse_mode=ParseMode.HTML
-    )
+    user = await get_user(str(msg.from_user.id))
+    await msg.answer(await _user_lb_text(user), parse_mode=ParseMode.HTML, reply_markup=_user_lb_kb("all"))
+
+@dp.callback_query(F.data.startswith("plb:"))
+async def leaderboard_period_cb(cb: CallbackQuery):
+    period = cb.data.split(":")[1]
+    if period not in LB_PERIODS:
+        return await cb.answer()
+    user = await get_user(str(cb.from_user.id))
+    text, kb = await _user_lb_text(user, period), _user_lb_kb(period)
+    try:
+        await cb.message.edit_text(text, parse_mode=ParseMode.HTML, reply_markup=kb)
+    except TelegramBadRequest as e:
+        # same period tapped twice: Telegram rejects an unchanged edit; anything else gets a fresh message
+        if "message is not modified" not in str(e):
+            await cb.message.answer(text, parse_mode=ParseMode.HTML, reply_markup=kb)
+    await cb.answer()
 
 
 @dp.message(F.text == BUTTONS["REPORT"])
@@ -1520,14 +1488,14 @@ async def browse_groups(msg: Message):
     all_clans = [c for c in await get_all_clans() if c.is_approved]
     if not all_clans:
         return await msg.answer("No study groups exist yet. You can be the first to create one!")
-    user_group_page[uid] = 0
+    await states.set("user_group_page", uid, 0)
     await show_group_card(msg, all_clans[0], 1, len(all_clans))
 
 
 
 @dp.message(lambda m: m.text == "➕ Request to Create Group")
 async def request_create_group(msg: Message):
-    users_requesting_group.add(str(msg.from_user.id))
+    await start_flow(msg.from_user.id, "users_requesting_group")
     await msg.answer(
         "📝 To request a new Study Group, send the following info as ONE message:\n"
         "- Group Name\n- Description\n- Requirements (optional)\n"
@@ -1614,7 +1582,7 @@ async def cb_edit_group_info(cb: CallbackQuery):
     if not user_clans or user_clans[0].owner_id != uid:
         return await cb.answer("Only founders can edit group info.", show_alert=True)
     clan = user_clans[0]
-    users_editing_group[uid] = clan.id
+    await start_flow(uid, "users_editing_group", clan.id)
     await cb.message.answer(
         "Send the new group info as 4 lines:\n"
         "Name\nDescription\nRequirements\nLink"
@@ -1628,16 +1596,16 @@ async def group_page_cb(cb: CallbackQuery):
     all_clans = [c for c in await get_all_clans() if c.is_approved]
     if not all_clans:
         return await cb.answer("No study groups exist yet.", show_alert=True)
-    user_group_page[uid] = page
+    await states.set("user_group_page", uid, page)
     await cb.message.delete()  # Remove previous card
     await show_group_card_paginated(cb.message, all_clans, page)
 
 
 
-@dp.message(lambda m: str(m.from_user.id) in users_editing_group)
-async def handle_edit_group_info(msg: Message):
+@flow_handler("users_editing_group", accepts=lambda m: m.text)
+async def handle_edit_group_info(msg: Message, clan_id: int):
     uid = str(msg.from_user.id)
-    clan_id = users_editing_group.pop(uid)
+    await end_flow(uid)
     lines = msg.text.split("\n")
     name = lines[0].strip() if len(lines) > 0 else ""
     desc = lines[1].strip() if len(lines) > 1 else ""
@@ -1647,9 +1615,9 @@ async def handle_edit_group_info(msg: Message):
     await msg.answer("Group info updated!", reply_markup=main_kb())
 
 
-@dp.message(lambda m: str(m.from_user.id) in users_requesting_group)
-async def handle_group_request(msg: Message):
-    users_requesting_group.discard(str(msg.from_user.id))
+@flow_handler("users_requesting_group", accepts=lambda m: m.text)
+async def handle_group_request(msg: Message, _):
+    await end_flow(msg.from_user.id)
     lines = msg.text.strip().split("\n")
     if len(lines) < 2:
         return await msg.answer("Invalid format. Please provide group name and description at least.")
@@ -1789,6 +1757,7 @@ async def clan_members_cb(cb: CallbackQuery):
         InlineKeyboardButton(text=f"{page+1}/{pages}", callback_data="noop"),
         InlineKeyboardButton(text="⏭ Next", callback_data=f"clan_members:{clan.id}:{next_p}"),
     ])
+    kb_rows.append([InlineKeyboardButton(text="🗓 Top this week", callback_data=f"clan_week:{clan.id}")])
     kb_rows.append([InlineKeyboardButton(text="⬅️ Back", callback_data="back_my_group")])
 
     kb = InlineKeyboardMarkup(inline_keyboard=kb_rows)
@@ -1799,6 +1768,29 @@ async def clan_members_cb(cb: CallbackQuery):
         await cb.message.answer(text, parse_mode=ParseMode.HTML, reply_markup=kb)
     await cb.answer()
 
+@dp.callback_query(F.data.startswith("clan_week:"))
+async def clan_week_cb(cb: CallbackQuery):
+    uid = str(cb.from_user.id)
+    clan_id = int(cb.data.split(":")[1])
+
+    user_clans = await get_user_clans(uid)
+    clan = next((c for c in user_clans if c.id == clan_id), None)
+    if not clan:
+        return await cb.answer("Only members can view the list.", show_alert=True)
+
+    top = await get_xp_leaderboard("week", limit=10, clan_id=clan_id)
+    lines = [_lb_line(i+1, u, u.user_id == uid, rank=False) for i, u in enumerate(top)]
+    text = (f"🗓 <b>{clan.name}</b> — Top this week\n\n" + ("\n".join(lines) or "No XP earned yet this week.")
+            + "\n\n<i>XP earned since Monday; updates every minute.</i>")
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⬅️ Back", callback_data=f"clan_members:{clan_id}:0")]
+    ])
+    try:
+        await cb.message.edit_text(text, parse_mode=ParseMode.HTML, reply_markup=kb)
+    except TelegramBadRequest:
+        await cb.message.answer(text, parse_mode=ParseMode.HTML, reply_markup=kb)
+    await cb.answer()
+
 @dp.callback_query(F.data.startswith("leave_clan:"))
 async def leave_clan_cb(cb: CallbackQuery):
     uid = str(cb.from_user.id)
@@ -1943,14 +1935,14 @@ async def admin_entry(msg: Message):
 @dp.message(F.text == "📣 Broadcast")
 async def admin_broadcast_start(msg: Message):
     if msg.from_user.id != ADMIN_ID: return
-    admin_broadcast_wait.add(msg.from_user.id)
+    await start_flow(msg.from_user.id, "admin_broadcast_wait")
     await msg.answer("Send the <b>message</b> to broadcast to all users.\n(Reply with text/photo/caption)")
 
 
-@dp.message(lambda m: m.from_user.id == ADMIN_ID and m.from_user.id in admin_broadcast_wait)
-async def admin_broadcast_do(msg: Message):
+@flow_handler("admin_broadcast_wait", accepts=lambda m: m.from_user.id == ADMIN_ID)
+async def admin_broadcast_do(msg: Message, _):
     # exit "waiting" mode
-    admin_broadcast_wait.discard(msg.from_user.id)
+    await end_flow(msg.from_user.id)
 
     user_ids = await get_all_user_ids()
     total = len(user_ids)
@@ -1988,12 +1980,12 @@ async def admin_broadcast_do(msg: Message):
 @dp.message(F.text == "➕ Add XP")
 async def admin_addxp_start(msg: Message):
     if msg.from_user.id != ADMIN_ID: return
-    admin_addxp_wait.add(msg.from_user.id)
+    await start_flow(msg.from_user.id, "admin_addxp_wait")
     await msg.answer("Send: `<user_id or @username> <xp_delta>`", parse_mode=ParseMode.HTML)
 
-@dp.message(lambda m: m.from_user.id == ADMIN_ID and m.from_user.id in admin_addxp_wait)
-async def admin_addxp_do(msg: Message):
-    admin_addxp_wait.discard(msg.from_user.id)
+@flow_handler("admin_addxp_wait", accepts=lambda m: m.from_user.id == ADMIN_ID and m.text)
+async def admin_addxp_do(msg: Message, _):
+    await end_flow(msg.from_user.id)
     try:
         ident, delta = msg.text.strip().split(maxsplit=1)
         delta = int(delta)
@@ -2008,12 +2000,12 @@ async def admin_addxp_do(msg: Message):
 @dp.message(F.text == "🏷️ Set Title")
 async def admin_settitle_start(msg: Message):
     if msg.from_user.id != ADMIN_ID: return
-    admin_settitle_wait.add(msg.from_user.id)
+    await start_flow(msg.from_user.id, "admin_settitle_wait")
     await msg.answer("Send: `<user_id or @username> | <title>`", parse_mode=ParseMode.HTML)
 
-@dp.message(lambda m: m.from_user.id == ADMIN_ID and m.from_user.id in admin_settitle_wait)
-async def admin_settitle_do(msg: Message):
-    admin_settitle_wait.discard(msg.from_user.id)
+@flow_handler("admin_settitle_wait", accepts=lambda m: m.from_user.id == ADMIN_ID and m.text)
+async def admin_settitle_do(msg: Message, _):
+    await end_flow(msg.from_user.id)
     if "|" not in msg.text:
         return await msg.answer("Format error. Use: `<id|@username> | <title>`", reply_markup=admin_menu_kb())
     ident, title = [x.strip() for x in msg.text.split("|", 1)]
@@ -2032,12 +2024,34 @@ async def admin_exit(msg: Message):
 async def admin_stats(msg: Message):
     if msg.from_user.id != ADMIN_ID: return
     s = await admin_get_counts()
+    ts = await task_storage_stats()
+    r = reminder_scheduler.stats()
+    d = reminder_digest_stats
+    uc = user_cache.stats()
+    tc = task_cache.stats()
+    lr = list_render_cache.stats()
+    avg_ms = list_render_stats["render_ms"] / list_render_stats["renders"] if list_render_stats["renders"] else 0.0
+    st = states.stats()
+    lb = leaderboard_snapshot.stats()
     text = (
         "📈 <b>Stats</b>\n"
         f"Users: <b>{s['users']}</b>\n"
         f"Tasks: <b>{s['tasks_total']}</b> | ✅ Done: {s['tasks_done']} | ⏳ Open: {s['tasks_open']}\n"
+        f"Task storage: hot {ts['tasks_rows']} rows (~{ts['tasks_dead'] or 0} dead), "
+        f"{_mb(ts['tasks_table'])} MB + {_mb(ts['tasks_indexes'])} MB idx • "
+        f"archive {s['tasks_archived']} rows, {_mb(ts['archive_table'])} MB + {_mb(ts['archive_indexes'])} MB idx\n"
         f"Clans: <b>{s['clans']}</b>\n"
-        f"Pending: Join <b>{s['join_pending']}</b>, Create <b>{s['create_pending']}</b>"
+        f"Pending: Join <b>{s['join_pending']}</b>, Create <b>{s['create_pending']}</b>\n"
+        f"Reminders: queued {r['queued']} • fired {r['fired']} • lag avg {r['lag_avg']:.2f}s / max {r['lag_max']:.2f}s\n"
+        f"Reminder digests: {d['reminders']} due → {d['messages']} messages delivered (max {d['max_per_user']}/user)\n"
+        f"Last reminder batch: {reminder_sender.format_report()}\n"
+        f"User cache: {uc['size']} cached • hits {uc['hits']} / misses {uc['misses']} ({uc['hit_rate']:.0%})\n"
+        f"Task cache: {tc['size']} cached • hits {tc['hits']} / misses {tc['misses']} ({tc['hit_rate']:.0%})\n"
+        f"Task list renders: hits {lr['hits']} / misses {lr['misses']} ({lr['hit_rate']:.0%})"
+        f" • {avg_ms:.1f} ms per render • ~{lr['hits'] * avg_ms / 1000:.1f}s saved\n"
+        f"Leaderboard snapshot: {lb['rows']} users • {lb['refreshes']} refreshes"
+        f" • age {(lb['age'] or 0):.0f}s\n"
+        f"Conversation state: " + " • ".join(f"{k} {v}" for k, v in st.items())
     )
     await msg.answer(text, parse_mode=ParseMode.HTML, reply_markup=admin_menu_kb())
 
@@ -2127,40 +2141,125 @@ async def admin_group_delete(cb: CallbackQuery):
 
 
 
-# — Reminders Loop (SQL-filtered windows) —
-async def check_reminders():
+# — Reminders Loop (event-driven: sleep until the next fire time) —
+REMINDER_BATCH = 500
+# running totals: due reminders vs. digest messages actually delivered after per-user coalescing
+reminder_digest_stats = {"reminders": 0, "messages": 0, "max_per_user": 0}
+# the event loop only keeps weak references to tasks: hold background work here until it finishes
+background_tasks: set[asyncio.Task] = set()
+
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+REMINDER_TEXT_MAX = 300     # task text per reminder line
+TELEGRAM_TEXT_MAX = 4096    # Telegram's limit, in UTF-16 code units
+
+
+def _tg_len(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _build_reminder_digests(claims) -> list[tuple]:
+    """
+    One message per user per tick: [(task_ids, chat_id, text)].
+    A single due task keeps the classic "⏰ 1h to go: …" line; several become a digest, split into
+    as many messages as Telegram's length limit needs. Task text is clipped and HTML-escaped, so
+    one task can't turn the whole digest into a rejected (and dropped) message.
+    """
+    per_user = {}
+    for tid, uid, text, lead, _claim in claims:
+        line = f"{reminder_label(lead)}: {html.escape(_clip(text, REMINDER_TEXT_MAX))}"
+        per_user.setdefault(uid, []).append((tid, line))
+
+    outbox = []
+    for uid, items in per_user.items():
+        reminder_digest_stats["max_per_user"] = max(reminder_digest_stats["max_per_user"], len(items))
+        if len(items) == 1:
+            outbox.append(((items[0][0],), uid, items[0][1]))
+            continue
+        chunks, cur, size = [], [], 0
+        for tid, line in items:
+            entry = f"• {line}"
+            # 64 units stay free for the "⏰ N tasks due soon (i/n):" header
+            if cur and size + _tg_len(entry) + 1 > TELEGRAM_TEXT_MAX - 64:
+                chunks.append(cur)
+                cur, size = [], 0
+            cur.append((tid, entry))
+            size += _tg_len(entry) + 1
+        chunks.append(cur)
+        for i, chunk in enumerate(chunks, 1):
+            part = f" ({i}/{len(chunks)})" if len(chunks) > 1 else ""
+            body = f"⏰ {len(items)} tasks due soon{part}:\n" + "\n".join(entry for _, entry in chunk)
+            outbox.append((tuple(tid for tid, _ in chunk), uid, body))
+    reminder_digest_stats["reminders"] += len(claims)
+    return outbox
+
+
+async def _claim_all_due() -> list:
+    """Claim every due reminder in REMINDER_BATCH chunks, so one tick digests the whole burst."""
+    claims = []
     while True:
         try:
-            # 1-hour window: [60, 61) minutes (catch the minute edge once)
-            pairs_1h = await get_tasks_for_reminder_window(60, 61, sent_flag=0, tz_name="Asia/Tashkent")
-            if pairs_1h:
-                ids = []
-                for usr, t in pairs_1h:
-                    try:
-                        await bot.send_message(usr.id, f"⏰ 1h to go: {t.text}")
-                        ids.append(t.id)
-                    except Exception:
-                        pass
-                await bulk_update_task_reminders_sent(ids, 1)
-
-            # 10-minute window: [10, 11) minutes
-            pairs_10m = await get_tasks_for_reminder_window(10, 11, sent_flag=1, tz_name="Asia/Tashkent")
-            if pairs_10m:
-                ids = []
-                for usr, t in pairs_10m:
-                    try:
-                        await bot.send_message(usr.id, f"⚠️ 10m left: {t.text}")
-                        ids.append(t.id)
-                    except Exception:
-                        pass
-                await bulk_update_task_reminders_sent(ids, 2)
+            batch = await claim_due_reminders(REMINDER_BATCH)
+        except Exception as e:
+            if not claims:
+                raise
+            print(f"⏰ Reminder claim failed: {e}")   # still deliver what this tick already holds
+            return claims
+        claims += batch
+        if len(batch) < REMINDER_BATCH:
+            return claims
 
-        except Exception:
-            # optional: print or log
-            pass
 
-        # tick every ~60s is enough
-        await asyncio.sleep(60)
+async def check_reminders():
+    # seed once; afterwards the task helpers keep the heap in sync
+    for tid, next_at in await get_upcoming_reminders():
+        reminder_scheduler.schedule(tid, next_at)
+
+    while True:
+        await reminder_scheduler.wait()
+        # the heap only decides *when* to wake; the DB claim decides *what* this process sends,
+        # so several bot processes can run side by side without duplicate reminders
+        reminder_scheduler.pop_due()
+        try:
+            claims = await _claim_all_due()
+            undo = {}          # task_id -> claim, handed back if delivery fails
+            for tid, uid, text, lead, claim in claims:
+                # arm the following stage whether or not this send goes through
+                reminder_scheduler.schedule(tid, claim[3])
+                undo[tid] = claim
+            # one digest per user for the whole tick, however many claim batches it took
+            outbox = _build_reminder_digests(claims)
+            if outbox:
+                # deliver in the background so a big burst can't delay the next fire time
+                spawn(_deliver_reminders(outbox, undo))
+        except Exception as e:
+            print(f"⏰ Reminder claim failed: {e}")
+
+
+async def _deliver_reminders(outbox: list[tuple], undo: dict):
+    try:
+        delivered, dropped = await reminder_sender.send_many(outbox)
+        reminder_digest_stats["messages"] += len(delivered)
+        done = {tid for ids in delivered + dropped for tid in ids}
+        # claims already marked the rows as sent; hand back only transient failures
+        # (a blocked bot or a deleted chat would fail again on every wake until the deadline)
+        released = [(tid, claim) for tid, claim in undo.items() if tid not in done]
+        await release_reminder_claims(released)
+        for tid, claim in released:
+            # the row is due again at its previous fire time; put it back on the heap so this
+            # process retries it instead of waiting for another process or the max_sleep poll
+            reminder_scheduler.schedule(tid, claim[1])
+        d = reminder_digest_stats
+        print(f"⏰ Reminders: {len(undo)} due → {len(delivered)}/{len(outbox)} message(s) • {reminder_sender.format_report()}"
+              f" • total {d['reminders']} due / {d['messages']} sent, max {d['max_per_user']} per user")
+    except Exception as e:
+        print(f"⏰ Reminder delivery failed: {e}")
 
 
 
@@ -2231,11 +2330,135 @@ async def groups_leaderboard_toggle(cb: CallbackQuery):
 
 
 
+# — Activity write-behind —
+ACTIVITY_FLUSH_EVERY = 5  # seconds
+
+async def flush_activity_loop():
+    while True:
+        await asyncio.sleep(ACTIVITY_FLUSH_EVERY)
+        try:
+            await flush_user_activity()
+        except Exception as e:
+            print(f"🕒 Activity flush failed: {e}")
+
+
+# — State store housekeeping (expired flows are otherwise only dropped when touched) —
+async def state_sweep_loop():
+    while True:
+        await asyncio.sleep(60)
+        states.sweep()
+
+
+# — Repeating tasks: insert the next instance once the live one's deadline has passed —
+RECURRENCE_SWEEP_EVERY = 60  # seconds
+
+async def recurrence_loop():
+    while True:
+        try:
+            await materialize_due_recurrences()
+        except Exception as e:
+            print(f"🔁 Recurrence sweep failed: {e}")
+        await asyncio.sleep(RECURRENCE_SWEEP_EVERY)
+
+
+# — Hot/cold split: done tasks move to tasks_archive after ARCHIVE_AFTER_DAYS —
+ARCHIVE_AFTER_DAYS = 30
+ARCHIVE_EVERY = 6 * 3600  # seconds
+
+def _mb(n: int) -> str:
+    return f"{(n or 0) / 1_048_576:.1f}"
+
+async def _list_query_ms(uid: str) -> float:
+    started = time.perf_counter()
+    await get_tasks_filtered(uid, "all")
+    return (time.perf_counter() - started) * 1000
+
+async def archive_loop():
+    probe = str(ADMIN_ID)   # list-query latency is sampled on the admin's own list
+    while True:
+        try:
+            before, ms_before = await task_storage_stats(), await _list_query_ms(probe)
+            moved = await archive_done_tasks(ARCHIVE_AFTER_DAYS)
+            if moved:
+                # rows, not MB: the freed pages only become reusable (or are truncated) after VACUUM
+                after, ms_after = await task_storage_stats(), await _list_query_ms(probe)
+                print(
+                    f"🗄 Archived {moved} done task(s): tasks {before['tasks_rows']} → {after['tasks_rows']} live rows "
+                    f"(~{after['tasks_dead'] or 0} dead awaiting vacuum), list query {ms_before:.1f} → {ms_after:.1f} ms"
+                )
+        except Exception as e:
+            print(f"🗄 Archival failed: {e}")
+        await asyncio.sleep(ARCHIVE_EVERY)
+
+
+# — clan_stats counters are maintained incrementally; this re-derives them and repairs drift —
+CLAN_STATS_RECONCILE_EVERY = 6 * 3600  # seconds
+
+async def clan_stats_reconcile_loop():
+    while True:
+        await asyncio.sleep(CLAN_STATS_RECONCILE_EVERY)
+        try:
+            checked, fixed = await reconcile_clan_stats()
+            if fixed:
+                print(f"🏆 Clan stats drifted: rebuilt {fixed} of {checked} clan row(s)")
+        except Exception as e:
+            print(f"🏆 Clan stats reconcile failed: {e}")
+
+
+# — XP ledger: fold xp_events into xp_daily every minute, apply retention once a day —
+XP_ROLLUP_EVERY = 60            # seconds
+XP_COMPACT_EVERY = 24 * 3600    # seconds
+
+async def xp_rollup_loop():
+    last_compact = 0.0
+    while True:
+        try:
+            await rollup_xp_events()
+            if time.monotonic() - last_compact > XP_COMPACT_EVERY:
+                events, buckets = await compact_xp_ledger()
+                last_compact = time.monotonic()
+                if events or buckets:
+                    print(f"📒 XP ledger compacted: {events} event(s), {buckets} daily bucket(s) dropped")
+        except Exception as e:
+            print(f"📒 XP rollup failed: {e}")
+        await asyncio.sleep(XP_ROLLUP_EVERY)
+
+
+# — Streaks: fold each finished Asia/Tashkent day into users.streak right after local midnight —
+STREAK_RUN_DELAY = 30  # seconds past midnight, so completions stamped at 23:59:59 have committed
+
+async def streak_loop():
+    tz = TASHKENT_TZ
+    while True:
+        try:
+            started = time.perf_counter()
+            days, n = await catch_up_streaks()   # every missed day up to yesterday; a no-op if already done
+            if days:
+                print(f"🔥 Streaks: {days} day(s) folded, {n} user(s) updated in {time.perf_counter() - started:.2f}s")
+        except Exception as e:
+            print(f"🔥 Streak job failed: {e}")
+        now = datetime.now(tz)
+        midnight = tz.localize(datetime.combine(now.date() + timedelta(days=1), datetime.min.time()))
+        await asyncio.sleep((midnight - now).total_seconds() + STREAK_RUN_DELAY)
+
+
 # — Run —
 async def main():
     print("✅ Smart Planner v2 running…")
-    asyncio.create_task(check_reminders())
-    await dp.start_polling(bot)
+    spawn(check_reminders())
+    spawn(flush_activity_loop())
+    spawn(state_sweep_loop())
+    spawn(recurrence_loop())
+    spawn(archive_loop())
+    spawn(clan_stats_reconcile_loop())
+    spawn(xp_rollup_loop())
+    spawn(streak_loop())
+    try:
+        await dp.start_polling(bot)
+    finally:
+        # final flush so the last few seconds of activity aren't lost on shutdown
+        await flush_user_activity()
+        await states.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,55 @@
+from datetime import datetime, timedelta
+
+import pytz
+
+from conftest import run
+
+
+def test_archive_moves_old_done_tasks_and_row_counts_follow(db):
+    from db import AsyncSessionLocal
+    from db_models import Task, User
+
+    now = datetime.now(pytz.utc)
+
+    async def scenario():
+        async with AsyncSessionLocal() as session:
+            session.add(User(id="u1", name="u1"))
+            session.add_all(
+                [Task(user_id="u1", text=f"old{i}", status="done", completed_at=now - timedelta(days=40)) for i in range(5)]
+                + [Task(user_id="u1", text="recent", status="done", completed_at=now - timedelta(days=2)),
+                   Task(user_id="u1", text="open", status="pending")]
+            )
+            await session.commit()
+        before = await db.task_storage_stats()
+        moved = await db.archive_done_tasks(30, batch_size=2)
+        after = await db.task_storage_stats()
+        counts = await db.admin_get_counts()
+        return before["tasks_rows"], moved, after["tasks_rows"], counts["tasks_archived"]
+
+    assert run(scenario()) == (7, 5, 2, 5)
+
+
+def test_archive_keeps_an_armed_series_row(db):
+    from sqlalchemy import select
+
+    from db import AsyncSessionLocal
+    from db_models import Task, User
+
+    now = datetime.now(pytz.utc)
+
+    async def scenario():
+        async with AsyncSessionLocal() as session:
+            session.add(User(id="u1", name="u1"))
+            session.add(Task(
+                user_id="u1", text="weekly review", status="done", repeat="weekly",
+                completed_at=now - timedelta(days=40), next_occurrence_at=now - timedelta(days=33),
+            ))
+            await session.commit()
+        moved = await db.archive_done_tasks(30)
+        async with AsyncSessionLocal() as session:
+            left = (await session.execute(select(Task.text, Task.next_occurrence_at))).all()
+        return moved, left
+
+    moved, left = run(scenario())
+    assert moved == 0
+    assert [text for text, _ in left] == ["weekly review"]
@@ -0,0 +1,84 @@
+"""
+Dispatch-latency benchmark: a text message from a user who is in a flow, fed through the real
+Dispatcher, as the number of registered flows grows. The old chain of per-flow lambda filters is
+rebuilt on a scratch Dispatcher as the baseline. Run with `-s` to see the timings.
+"""
+import asyncio
+import statistics
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("aiogram")
+
+from aiogram import Dispatcher
+from aiogram.types import Chat, Message, Update, User
+
+UID = 777
+SIZES = (20, 200, 1000)
+ROUNDS = 100
+
+
+def _update(n: int) -> Update:
+    return Update(update_id=n, message=Message(
+        message_id=n, date=datetime.now(), text="some flow input",
+        chat=Chat(id=UID, type="private"), from_user=User(id=UID, is_bot=False, first_name="bench"),
+    ))
+
+
+async def _median_us(dp, bot) -> float:
+    samples = []
+    for i in range(ROUNDS):
+        upd = _update(i)
+        started = time.perf_counter()
+        await dp.feed_update(bot, upd)
+        samples.append((time.perf_counter() - started) * 1e6)
+    return statistics.median(samples)
+
+
+def _filter_chain(n: int, hits: list) -> Dispatcher:
+    """The pre-router layout: one `@dp.message(lambda m: str(m.from_user.id) in X)` per flow."""
+    dp = Dispatcher()
+    waiting = [set() for _ in range(n)]
+    waiting[-1].add(str(UID))   # worst case: the user's flow is registered last
+    for ids in waiting:
+        dp.message.register(lambda m: hits.append(1), lambda m, ids=ids: str(m.from_user.id) in ids)
+    return dp
+
+
+def test_flow_dispatch_cost_does_not_grow_with_flows():
+    import db_helpers
+    import main
+
+    hits = []
+
+    async def bench_flow(msg, data):
+        hits.append(data)
+
+    async def scenario():
+        db_helpers.user_cache.set(str(UID), SimpleNamespace(id=str(UID), username=""))
+        router, chain = {}, {}
+        try:
+            await main.states.set("flow", UID, {"name": "bench", "data": 1})
+            main.flow_handler("bench")(bench_flow)
+            for n in SIZES:
+                while len(main.FLOWS) < n:
+                    main.flow_handler(f"bench_pad_{len(main.FLOWS)}")(bench_flow)
+                router[n] = await _median_us(main.dp, main.bot)
+                chain[n] = await _median_us(_filter_chain(n, hits), main.bot)
+        finally:
+            for name in [k for k in main.FLOWS if k.startswith("bench")]:
+                del main.FLOWS[name]
+            await main.states.pop("flow", UID)
+            db_helpers.user_cache.invalidate(str(UID))
+            db_helpers._activity_buffer.pop(str(UID), None)
+        return router, chain
+
+    router, chain = asyncio.run(scenario())
+    for n in SIZES:
+        print(f"{n:>5} flows: state router {router[n]:7.1f} µs/update • filter chain {chain[n]:8.1f} µs/update")
+    assert len(hits) == 2 * len(SIZES) * ROUNDS
+    assert router[SIZES[-1]] < 3 * router[SIZES[0]]
+    assert chain[SIZES[-1]] > router[SIZES[-1]]
@@ -0,0 +1,90 @@
+"""
+get_or_create_user micro-benchmark: the single upsert against the previous SELECT-then-INSERT path.
+Run with `-s` to see the timings; the assertions only pin round trips and the first-contact race.
+"""
+import asyncio
+import time
+
+from sqlalchemy import event, select
+
+from conftest import run
+
+N = 200
+
+
+async def _select_then_insert(user_id: str, name: str, username: str):
+    """The pre-upsert implementation, kept here as the benchmark baseline."""
+    from db import AsyncSessionLocal
+    from db_models import User
+
+    async with AsyncSessionLocal() as session:
+        user = (await session.execute(select(User).where(User.id == user_id))).scalar_one_or_none()
+        if not user:
+            user = User(id=user_id, name=name, username=username)
+            session.add(user)
+            await session.commit()
+            await session.refresh(user)
+        elif username and user.username != username:
+            user.username = username
+            await session.commit()
+        return user
+
+
+class _Statements:
+    def __init__(self, engine):
+        self.n = 0
+        self._engine = engine.sync_engine
+
+    def _count(self, *args):
+        self.n += 1
+
+    def __enter__(self):
+        event.listen(self._engine, "before_cursor_execute", self._count)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self._engine, "before_cursor_execute", self._count)
+
+
+async def _timed(h, fn, prefix: str, rename: bool = False):
+    from db import engine
+
+    with _Statements(engine) as stmts:
+        started = time.perf_counter()
+        for i in range(N):
+            h.user_cache.clear()   # measure the database path, not the cache
+            await fn(f"{prefix}{i}", "bench", f"handle{i}{'x' if rename else ''}")
+        ms = (time.perf_counter() - started) * 1000 / N
+    return ms, stmts.n / N
+
+
+def test_upsert_takes_one_round_trip(db):
+    h = db
+
+    async def scenario():
+        return {
+            ("old", "new user"): await _timed(h, _select_then_insert, "a"),
+            ("new", "new user"): await _timed(h, h.get_or_create_user, "b"),
+            ("old", "renamed"): await _timed(h, _select_then_insert, "a", rename=True),
+            ("new", "renamed"): await _timed(h, h.get_or_create_user, "b", rename=True),
+            ("old", "unchanged"): await _timed(h, _select_then_insert, "a", rename=True),
+            ("new", "unchanged"): await _timed(h, h.get_or_create_user, "b", rename=True),
+        }
+
+    result = run(scenario())
+    for (impl, case), (ms, per_call) in result.items():
+        print(f"get_or_create_user [{impl}] {case}: {ms:.2f} ms/call, {per_call:.1f} statements/call")
+    assert result[("new", "new user")][1] == 1
+    assert result[("new", "renamed")][1] == 1
+    assert result[("old", "new user")][1] == 3
+    assert result[("new", "unchanged")][1] == 1
+
+
+def test_concurrent_first_contact_does_not_collide(db):
+    h = db
+
+    async def scenario():
+        users = await asyncio.gather(*(h.get_or_create_user("u1", "u1", "same") for _ in range(20)))
+        return {u.id for u in users}
+
+    assert run(scenario()) == {"u1"}
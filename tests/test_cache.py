@@ -0,0 +1,22 @@
+from utils.cache import VersionedCache
+
+
+def test_versions_stay_bounded():
+    cache = VersionedCache(maxsize=100)
+    for key in range(10_000):
+        cache.bump(key)
+    assert cache.stats()["versions"] == 100
+
+
+def test_load_that_raced_an_evicted_bump_is_rejected():
+    cache = VersionedCache(maxsize=2)
+    seen = cache.version("a")      # reader starts loading "a"
+    cache.bump("a")                # writer changes it...
+    cache.bump("b")
+    cache.bump("c")                # ...and "a"'s version is forgotten
+    cache.set("a", "stale", seen)
+    assert cache.get("a") is None
+
+    fresh = cache.version("a")
+    cache.set("a", "fresh", fresh)
+    assert cache.get("a") == "fresh"
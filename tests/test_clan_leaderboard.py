@@ -0,0 +1,78 @@
+from sqlalchemy import select
+
+from conftest import run
+
+
+async def _found_clan(db, owner: str, name: str):
+    req = await db.create_clan_creation_request(owner, owner, name, "", "", "")
+    return await db.approve_clan_creation_request(req.id)
+
+
+async def _stats(session):
+    from db_models import ClanStats
+
+    rows = (await session.execute(select(ClanStats.clan_id, ClanStats.member_count, ClanStats.total_xp))).all()
+    return sorted(tuple(r) for r in rows)
+
+
+def test_new_clans_page_by_their_stats_row(db):
+    from db import AsyncSessionLocal
+    from db_models import Clan, User
+
+    async def scenario():
+        async with AsyncSessionLocal() as session:
+            session.add_all([User(id=f"u{i}", name=f"u{i}", xp=100 * i) for i in range(1, 4)])
+            session.add(User(id="u0", name="u0", xp=0))
+            await session.commit()
+        big = await _found_clan(db, "u3", "big")
+        small = await _found_clan(db, "u1", "small")
+        fresh = await _found_clan(db, "u0", "fresh")
+        async with AsyncSessionLocal() as session:
+            session.add(Clan(name="pending", owner_id="u2", is_approved=False))
+            await session.commit()
+
+        pages = [await db.get_clans_xp_leaderboard_page(p, per_page=2) for p in range(2)]
+        top = await db.get_clans_xp_leaderboard(limit=10, mode="avg")
+        return (big.id, small.id, fresh.id), pages, top
+
+    ids, pages, top = run(scenario())
+    assert [total for total, _ in pages] == [3, 3]
+    assert [(c.id, c.name, n, xp) for _, rows in pages for c, n, xp, _ in rows] == [
+        (ids[0], "big", 1, 300), (ids[1], "small", 1, 100), (ids[2], "fresh", 1, 0),
+    ]
+    assert [c.name for c, *_ in top] == ["big", "small", "fresh"]
+
+
+def test_incremental_clan_stats_match_a_full_recount(db):
+    from db import AsyncSessionLocal
+    from db_models import User
+
+    async def scenario():
+        async with AsyncSessionLocal() as session:
+            session.add_all([User(id=f"u{i}", name=f"u{i}", xp=10 * i) for i in range(1, 6)])
+            await session.commit()
+        a = await _found_clan(db, "u1", "a")
+        b = await _found_clan(db, "u2", "b")
+        for clan, uid in [(a, "u3"), (a, "u4"), (b, "u4"), (b, "u5")]:
+            await db.create_clan_application(clan.id, uid)
+            await db.approve_application(clan.id, uid)
+
+        await db.update_xp_streak_completed("u4", xp_delta=25)   # member of both clans
+        await db.update_xp_streak_completed("u1", xp_delta=-100)  # clamped at zero
+        await db.add_tasks_bulk("u3", ["t1", "t2"], deadline=None, priority="low")
+        await db.complete_tasks("u3", [t.id for t in await db.get_tasks("u3")], cap=30)
+        await db.remove_member_from_clan(a.id, "u4")
+        await db.update_xp_streak_completed("u4", xp_delta=7)    # lands in b only
+        await db.remove_member_from_clan(b.id, "u5")
+
+        async with AsyncSessionLocal() as session:
+            incremental = await _stats(session)
+        checked, fixed = await db.reconcile_clan_stats()
+        async with AsyncSessionLocal() as session:
+            recounted = await _stats(session)
+        return checked, fixed, incremental, recounted
+
+    checked, fixed, incremental, recounted = run(scenario())
+    assert (checked, fixed) == (2, 0)
+    assert incremental == recounted
+    assert [n for _, n, _ in recounted] == [2, 2]
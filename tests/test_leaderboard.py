@@ -0,0 +1,40 @@
+import asyncio
+from types import SimpleNamespace
+
+from utils.leaderboard import LeaderboardSnapshot, LeaderRow
+
+XP = [100, 90, 90, 90, 80, 70, 70, 60, 50, 40, 30, 30, 20]
+
+
+def _board(rows):
+    async def load():
+        return rows
+    return asyncio.run(LeaderboardSnapshot(load).fresh())
+
+
+def _expected_rank(rows, user_id, live_xp, xp):
+    """1 + users with more XP, the user counted at live_xp."""
+    others = [r.xp for r in rows if r.user_id != user_id]
+    return 1 + sum(x > xp for x in others + [live_xp])
+
+
+def test_window_positions_are_tie_aware_ranks():
+    rows = [LeaderRow(f"u{i}", f"u{i}", "", xp) for i, xp in enumerate(XP)]
+    board = _board(rows)
+    # u6 (snapshot 70) has since earned up to 90, tying the three users above
+    me = SimpleNamespace(id="u6", name="u6", extra_title="", xp=90)
+
+    my_rank, window = board.around(me, k=4)
+    assert my_rank == 2
+    for pos, row in window:
+        xp = me.xp if row.user_id == me.id else row.xp
+        assert pos == _expected_rank(rows, me.id, me.xp, xp), row
+    assert [pos for pos, _ in window] == [1, 2, 2, 2, 2, 6]   # u0, then me tied with u1-u3 at 90, then u4
+
+
+def test_top_rows_share_ranks_on_ties():
+    rows = [LeaderRow(f"u{i}", f"u{i}", "", xp) for i, xp in enumerate(XP)]
+    board = _board(rows)
+    outsider = SimpleNamespace(id="new", name="new", extra_title="", xp=0)
+    assert [pos for pos, _ in board.top_ranked(outsider, 8)] == [1, 2, 2, 2, 5, 6, 6, 8]
+    assert board.rank(outsider.id, 30) == 11
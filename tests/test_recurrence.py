@@ -0,0 +1,30 @@
+from datetime import datetime, timedelta
+
+import pytz
+from sqlalchemy import select
+
+from conftest import run
+
+
+def test_next_instance_keeps_notes_and_attachment(db):
+    from db import AsyncSessionLocal
+    from db_models import Task, User
+
+    due = datetime.now(pytz.utc) + timedelta(hours=2)
+
+    async def scenario():
+        async with AsyncSessionLocal() as session:
+            session.add(User(id="u1", name="u1"))
+            task = Task(
+                user_id="u1", text="gym", status="pending", repeat="daily", priority="high",
+                deadline_at=due, next_occurrence_at=due, notes="legs", attachment="photo:AgAD",
+            )
+            session.add(task)
+            await session.commit()
+        await db.complete_tasks("u1", [task.id])
+        async with AsyncSessionLocal() as session:
+            return (await session.execute(
+                select(Task.text, Task.priority, Task.notes, Task.attachment).where(Task.status == "pending")
+            )).all()
+
+    assert [tuple(r) for r in run(scenario())] == [("gym", "high", "legs", "photo:AgAD")]
@@ -0,0 +1,78 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytz
+from sqlalchemy import text
+
+from conftest import run
+
+TZ = pytz.timezone("Asia/Tashkent")
+
+
+async def _seed(h, users: int, per_user: int):
+    """Pending medium tasks 30 min out whose 1h stage is already due."""
+    deadline = (datetime.now(TZ) + timedelta(minutes=30)).strftime("%Y-%m-%d %H:%M")
+    for u in range(users):
+        uid = f"u{u}"
+        await h.get_or_create_user(uid, uid)
+        await h.add_tasks_bulk(uid, [f"t{i}" for i in range(per_user)], deadline=deadline, priority="medium")
+    async with h.AsyncSessionLocal() as session:
+        await session.execute(text("UPDATE tasks SET next_reminder_at = now() - interval '1 minute'"))
+        await session.commit()
+
+
+async def _worker(h, seen: list, batch: int):
+    while True:
+        claims = await h.claim_due_reminders(batch)
+        seen.extend(tid for tid, *_ in claims)
+        if not claims:
+            return
+        await asyncio.sleep(0)
+
+
+def test_workers_split_due_reminders_exactly_once(db):
+    h = db
+
+    async def scenario():
+        await _seed(h, users=20, per_user=10)
+        seen = []
+        await asyncio.gather(*(_worker(h, seen, batch=7) for _ in range(4)))
+        return seen
+
+    seen = run(scenario())
+    assert len(seen) == 200
+    assert len(set(seen)) == 200
+
+
+def test_released_claims_are_claimed_again_once(db):
+    h = db
+
+    async def scenario():
+        await _seed(h, users=2, per_user=5)
+        first = await h.claim_due_reminders(100)
+        # hand back half, as a transient send failure would
+        await h.release_reminder_claims([(tid, claim) for tid, *_, claim in first[:5]])
+        seen = []
+        await asyncio.gather(*(_worker(h, seen, batch=2) for _ in range(3)))
+        return first, seen
+
+    first, seen = run(scenario())
+    assert len(first) == 10
+    assert sorted(seen) == sorted(tid for tid, *_ in first[:5])
+
+
+def test_release_does_not_override_a_newer_edit(db):
+    h = db
+
+    async def scenario():
+        await _seed(h, users=1, per_user=1)
+        (tid, _uid, _text, _lead, claim), = await h.claim_due_reminders(10)
+        new_deadline = (datetime.now(TZ) + timedelta(days=2)).strftime("%Y-%m-%d %H:%M")
+        await h.update_task_deadline(tid, new_deadline)   # resets reminders_sent to 0
+        await h.release_reminder_claims([(tid, claim)])
+        task = await h.get_task_by_id(tid)
+        return task, claim
+
+    task, claim = run(scenario())
+    assert task.reminders_sent == 0
+    assert task.next_reminder_at != claim[1]
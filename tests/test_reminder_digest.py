@@ -0,0 +1,61 @@
+import pytest
+
+from conftest import run
+from test_reminder_claims import _seed
+from utils.scheduler import ReminderScheduler
+
+
+def test_one_digest_per_user_across_claim_batches(db, monkeypatch):
+    pytest.importorskip("aiogram")
+    import main
+
+    monkeypatch.setattr(main, "REMINDER_BATCH", 4)
+    monkeypatch.setitem(main.reminder_digest_stats, "messages", 0)
+    released = []
+
+    async def send_many(outbox):
+        return [outbox[0][0]], []   # first message delivered, the other one fails transiently
+
+    async def release(claims):
+        released.extend(tid for tid, _ in claims)
+
+    monkeypatch.setattr(main.reminder_sender, "send_many", send_many)
+    monkeypatch.setattr(main, "release_reminder_claims", release)
+    monkeypatch.setattr(main, "reminder_scheduler", ReminderScheduler())
+
+    async def scenario():
+        await _seed(db, users=2, per_user=6)
+        claims = await main._claim_all_due()
+        outbox = main._build_reminder_digests(claims)
+        await main._deliver_reminders(outbox, {tid: claim for tid, *_, claim in claims})
+        return claims, outbox
+
+    claims, outbox = run(scenario())
+    assert len(claims) == 12
+    assert sorted(len(ids) for ids, _, _ in outbox) == [6, 6]
+    assert all(body.startswith("⏰ 6 tasks due soon:") for _, _, body in outbox)
+    assert main.reminder_digest_stats["messages"] == 1
+    assert sorted(released) == sorted(outbox[1][0])
+    # released claims are back on the heap at their previous fire time, due now
+    assert sorted(main.reminder_scheduler.pop_due()) == sorted(released)
+
+
+def test_digest_escapes_task_text_and_fits_telegram_limits():
+    pytest.importorskip("aiogram")
+    from datetime import timedelta
+
+    import main
+
+    lead = timedelta(hours=1)
+    claims = [(1, "u1", "read <b chapter & notes", lead, None)]
+    claims += [(100 + i, "u1", f"task {i} " + "x" * 250, lead, None) for i in range(200)]
+    claims += [(9, "u2", "a <b> lone task", lead, None)]
+
+    outbox = main._build_reminder_digests(claims)
+    mine = [(ids, body) for ids, chat, body in outbox if chat == "u1"]
+    assert len(mine) > 1
+    assert all(main._tg_len(body) <= main.TELEGRAM_TEXT_MAX for _, body in mine)
+    assert sorted(tid for ids, _ in mine for tid in ids) == sorted(tid for tid, *_ in claims[:-1])
+    assert "read &lt;b chapter &amp; notes" in mine[0][1]
+    assert mine[0][1].startswith(f"⏰ 201 tasks due soon (1/{len(mine)}):")
+    assert [body for _, chat, body in outbox if chat == "u2"] == ["⏰ 1h to go: a &lt;b&gt; lone task"]
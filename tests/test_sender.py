@@ -0,0 +1,35 @@
+import asyncio
+
+from aiogram.exceptions import TelegramForbiddenError, TelegramNetworkError
+
+from utils.sender import RateLimitedSender
+
+
+class FakeBot:
+    """send_message outcome per chat id: None (delivered) or an exception to raise."""
+
+    def __init__(self, outcomes: dict):
+        self.outcomes = outcomes
+        self.calls = 0
+
+    async def send_message(self, chat_id, text):
+        self.calls += 1
+        err = self.outcomes.get(chat_id)
+        if err is not None:
+            raise err
+
+
+def test_send_many_separates_permanent_from_transient_failures():
+    bot = FakeBot({
+        "blocked": TelegramForbiddenError(method=None, message="Forbidden: bot was blocked by the user"),
+        "flaky": TelegramNetworkError(method=None, message="timeout"),
+    })
+    sender = RateLimitedSender(bot, global_rate=1000, per_chat_rate=1000)
+    messages = [("k1", "ok", "hi"), ("k2", "blocked", "hi"), ("k3", "flaky", "hi")]
+
+    delivered, dropped = asyncio.run(sender.send_many(messages))
+
+    assert delivered == ["k1"]
+    assert dropped == ["k2"]   # k3 is neither: the caller hands its claim back for a later retry
+    assert sender.last_report["failed"] == 2
+    assert sender.last_report["dropped"] == 1
@@ -0,0 +1,103 @@
+import asyncio
+import contextlib
+import time
+from urllib.parse import urlparse
+
+import pytest
+
+from utils.state_store import MemoryStateStore, RedisError, RedisStateStore
+
+
+async def _roundtrips(store):
+    await store.set("manage_select", 1, {"action": "prio", "selected": {3, 1, 2}})
+    await store.set("flow", 1, {"name": "user_edit_text", "data": 42})
+    got = await store.get("manage_select", 1)
+    assert got == {"action": "prio", "selected": {1, 2, 3}}
+    assert await store.has("flow", 1)
+    assert await store.pop("flow", 1) == {"name": "user_edit_text", "data": 42}
+    assert await store.get("flow", 1, "gone") == "gone"
+
+
+def test_memory_store_roundtrips_json():
+    asyncio.run(_roundtrips(MemoryStateStore()))
+
+
+def test_values_that_are_not_json_are_refused():
+    with pytest.raises(TypeError):
+        asyncio.run(MemoryStateStore().set("flow", 1, object()))
+
+
+def test_redis_store_roundtrips_json(redis_url):
+    async def scenario():
+        store = RedisStateStore(redis_url, prefix="test")
+        try:
+            await _roundtrips(store)
+        finally:
+            await store.close()
+
+    asyncio.run(scenario())
+
+
+def test_concurrent_lookups_do_not_queue_on_one_connection(redis_url):
+    async def scenario():
+        store = RedisStateStore(redis_url, prefix="test")
+        try:
+            await asyncio.gather(*(store.set("flow", i, {"name": "f", "data": i}) for i in range(50)))
+            # a blocked command holds its connection; the others must still be answered meanwhile
+            blocked = asyncio.create_task(store._redis.blpop("test:never", timeout=2))
+            await asyncio.sleep(0.05)
+            started = time.perf_counter()
+            got = await asyncio.gather(*(store.get("flow", i) for i in range(50)))
+            waited = time.perf_counter() - started
+            blocked.cancel()
+            return got, waited
+        finally:
+            await store.close()
+
+    got, waited = asyncio.run(scenario())
+    assert [v["data"] for v in got] == list(range(50))
+    assert waited < 1
+
+
+def test_cancelled_command_does_not_poison_the_connection(redis_url):
+    async def scenario():
+        store = RedisStateStore(redis_url, prefix="test")
+        try:
+            await store.set("flow", 1, "first")
+            await store.set("flow", 2, "second")
+            seen = []
+            for yields in range(8):   # cancel GET flow:1 at every point of its round trip
+                task = asyncio.create_task(store.get("flow", 1))
+                for _ in range(yields):
+                    await asyncio.sleep(0)
+                task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await task
+                seen.append(await store.get("flow", 2))
+            return seen
+        finally:
+            await store.close()
+
+    assert asyncio.run(scenario()) == ["second"] * 8
+
+
+def test_auth_uses_the_acl_username_from_the_url(redis_url):
+    u = urlparse(redis_url)
+
+    async def scenario():
+        admin = RedisStateStore(redis_url, prefix="test")
+        good = RedisStateStore(f"redis://planner:s3cret@{u.hostname}:{u.port}{u.path}", prefix="test")
+        bad = RedisStateStore(f"redis://planner:wrong@{u.hostname}:{u.port}{u.path}", prefix="test")
+        try:
+            await admin._redis.acl_setuser("planner", enabled=True, passwords=["+s3cret"], keys=["test:*"], commands=["+@all"])
+            await good.set("flow", 7, True)
+            with pytest.raises(RedisError):
+                await bad.get("flow", 7)
+            stored = await good.has("flow", 7)
+            await admin._redis.acl_deluser("planner")
+            return stored
+        finally:
+            for store in (admin, good, bad):
+                await store.close()
+
+    assert asyncio.run(scenario()) is True
@@ -0,0 +1,80 @@
+from datetime import datetime, timedelta
+
+import pytz
+from sqlalchemy import insert, select
+
+from conftest import run
+
+
+def _local_noon(day):
+    tz = pytz.timezone("Asia/Tashkent")
+    return tz.localize(datetime.combine(day, datetime.min.time())) + timedelta(hours=12)
+
+
+def test_catch_up_folds_missed_days_in_order_from_the_ledger(db):
+    from db import AsyncSessionLocal
+    from db_models import User, XpEvent
+
+    today = datetime.now(pytz.timezone("Asia/Tashkent")).date()
+    d = lambda n: today - timedelta(days=n)
+
+    async def scenario():
+        async with AsyncSessionLocal() as session:
+            session.add_all([
+                User(id="steady", name="s", streak=2, streak_date=d(4)),
+                User(id="lapsed", name="l", streak=5, streak_date=d(4)),
+                User(id="idle", name="i", streak=0, streak_date=d(4)),
+            ])
+            for uid, days in (("steady", (3, 2, 1)), ("lapsed", (3,))):
+                for n in days:
+                    await session.execute(insert(XpEvent).values(
+                        user_id=uid, delta=10, source="task", created_at=_local_noon(d(n)),
+                    ))
+            await session.commit()   # no task rows at all: deleted tasks must not erase a day
+
+        first = await db.catch_up_streaks()
+        again = await db.catch_up_streaks()
+        async with AsyncSessionLocal() as session:
+            rows = (await session.execute(select(User.id, User.streak, User.streak_date))).all()
+        return first, again, {r.id: (r.streak, r.streak_date) for r in rows}
+
+    first, again, users = run(scenario())
+    assert first[0] == 3
+    assert again == (0, 0)
+    assert users["steady"] == (5, d(1))
+    assert users["lapsed"] == (0, d(2))
+    assert users["idle"] == (0, d(4))
+
+
+def test_bucket_fallback_counts_only_task_xp_like_the_ledger(db):
+    from db import AsyncSessionLocal
+    from db_models import User, XpEvent
+
+    today = datetime.now(pytz.timezone("Asia/Tashkent")).date()
+    recent = today - timedelta(days=2)
+    old = today - timedelta(days=db.XP_EVENTS_KEEP_DAYS + 2)
+
+    async def scenario():
+        async with AsyncSessionLocal() as session:
+            for day in (recent, old):
+                session.add_all([
+                    User(id=f"granted-{day}", name="g", streak=3, streak_date=day - timedelta(days=1)),
+                    User(id=f"worked-{day}", name="w", streak=3, streak_date=day - timedelta(days=1)),
+                ])
+                for uid, source in ((f"granted-{day}", "admin"), (f"worked-{day}", "task")):
+                    await session.execute(insert(XpEvent).values(
+                        user_id=uid, delta=10, source=source, created_at=_local_noon(day),
+                    ))
+            await session.commit()
+        await db.rollup_xp_events()
+        streaks = {}
+        for day in (old, recent):   # old reads the xp_daily buckets, recent reads the raw ledger
+            await db.update_streaks(day)
+            async with AsyncSessionLocal() as session:
+                rows = (await session.execute(select(User.id, User.streak).where(User.id.like(f"%-{day}")))).all()
+            streaks[day] = dict(rows)
+        return streaks
+
+    streaks = run(scenario())
+    for day in (old, recent):
+        assert streaks[day] == {f"granted-{day}": 0, f"worked-{day}": 4}, day
@@ -0,0 +1,63 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytz
+from sqlalchemy import func, select
+
+from conftest import run
+
+CAP = 30
+
+
+async def _user_totals(uid):
+    from db import AsyncSessionLocal
+    from db_models import User, XpEvent
+
+    async with AsyncSessionLocal() as session:
+        user = (await session.execute(select(User).where(User.id == uid))).scalar_one()
+        logged = (await session.execute(
+            select(func.coalesce(func.sum(XpEvent.delta), 0)).where(XpEvent.user_id == uid)
+        )).scalar()
+    return user.xp, user.xp_today, int(logged)
+
+
+def test_concurrent_completions_never_exceed_the_daily_cap(db):
+    from db import AsyncSessionLocal
+    from db_models import User
+
+    yesterday = (datetime.now(pytz.timezone("Asia/Tashkent")) - timedelta(days=1)).strftime("%Y-%m-%d")
+
+    async def scenario():
+        async with AsyncSessionLocal() as session:
+            # yesterday's counter is spent: the first completion of today must reset it, exactly once
+            session.add(User(id="u1", name="u1", xp=100, xp_today=CAP, xp_date=yesterday))
+            await session.commit()
+        await db.add_tasks_bulk("u1", [f"t{i}" for i in range(40)], deadline=None, priority="medium")
+        ids = [t.id for t in await db.get_tasks("u1")]
+        runs = await asyncio.gather(*(db.complete_tasks("u1", [tid], cap=CAP) for tid in ids))
+        return [applied for applied, _ in runs], await _user_totals("u1")
+
+    applied, (xp, xp_today, logged) = run(scenario())
+    assert sum(applied) == CAP
+    assert sorted(applied, reverse=True)[:9] == [4] * 7 + [2, 0]
+    assert (xp, xp_today, logged) == (100 + CAP, CAP, CAP)
+
+
+def test_double_tapped_completions_credit_each_task_once(db):
+    async def scenario():
+        await db.get_or_create_user("u1", "u1")
+        await db.add_tasks_bulk("u1", [f"t{i}" for i in range(12)], deadline=None, priority="low")
+        ids = [t.id for t in await db.get_tasks("u1")]
+        # eight overlapping "done" taps, each over a different rotation of the same ids
+        runs = await asyncio.gather(*(
+            db.complete_tasks("u1", ids[k:] + ids[:k], cap=CAP) for k in range(0, 16, 2)
+        ))
+        return ids, runs, await _user_totals("u1")
+
+    ids, runs, (xp, xp_today, logged) = run(scenario())
+    credited = [tid for _, results in runs for tid, _, _ in results]
+    assert sorted(credited) == sorted(ids)
+    applied = sum(a for a, _ in runs)
+    requested = sum(req for _, results in runs for _, req, _ in results)
+    assert applied == min(requested, CAP)
+    assert (xp, xp_today, logged) == (applied, applied, applied)
@@ -0,0 +1,87 @@
+from sqlalchemy import func, insert, select, text
+
+from conftest import run
+
+
+async def _event(session, user_id, delta):
+    from db_models import XpEvent
+
+    await session.execute(insert(XpEvent).values(user_id=user_id, delta=delta, source="task"))
+
+
+async def _daily_total(user_id):
+    from db import AsyncSessionLocal
+    from db_models import XpDaily
+
+    async with AsyncSessionLocal() as session:
+        return int((await session.execute(
+            select(func.coalesce(func.sum(XpDaily.xp), 0)).where(XpDaily.user_id == user_id)
+        )).scalar())
+
+
+def test_rollup_waits_for_an_open_transaction_with_a_lower_id(db):
+    from db import AsyncSessionLocal
+
+    async def scenario():
+        slow = AsyncSessionLocal()
+        try:
+            await _event(slow, "u1", 5)               # lower id, still uncommitted
+            async with AsyncSessionLocal() as fast:
+                await _event(fast, "u1", 7)
+                await fast.commit()
+            first = await db.rollup_xp_events()
+            await slow.commit()
+        finally:
+            await slow.close()
+        second = await db.rollup_xp_events()
+        return first, second, await _daily_total("u1")
+
+    assert run(scenario()) == (0, 2, 12)
+
+
+def test_rollup_folds_a_late_commit_from_an_older_reader(db):
+    """An older transaction that commits after a newer xid was folded must still be picked up."""
+    from db import AsyncSessionLocal
+
+    async def scenario():
+        early = AsyncSessionLocal()
+        late = AsyncSessionLocal()
+        try:
+            await early.execute(text("SELECT pg_current_xact_id()"))   # takes the lower xid first
+            await _event(late, "u1", 3)                                 # lower event id, higher xid
+            await _event(early, "u1", 4)
+            await early.commit()
+            first = await db.rollup_xp_events()
+            await late.commit()
+        finally:
+            await early.close()
+            await late.close()
+        second = await db.rollup_xp_events()
+        third = await db.rollup_xp_events()
+        return first, second, third, await _daily_total("u1")
+
+    assert run(scenario()) == (1, 1, 0, 7)
+
+
+def test_weekly_board_can_be_scoped_to_one_clan(db):
+    from db import AsyncSessionLocal
+    from db_models import Clan, ClanMember, User
+
+    async def scenario():
+        async with AsyncSessionLocal() as session:
+            session.add_all([User(id=u, name=u) for u in ("a", "b", "c")])
+            session.add(Clan(id=1, name="c1", owner_id="a", is_approved=True))
+            await session.flush()
+            session.add_all([ClanMember(clan_id=1, user_id="a"), ClanMember(clan_id=1, user_id="b")])
+            for uid, delta in (("a", 5), ("b", 9), ("c", 50)):
+                await _event(session, uid, delta)
+            await session.commit()
+        await db.rollup_xp_events()
+        return (
+            [(r.user_id, r.xp) for r in await db.get_xp_leaderboard("week", clan_id=1)],
+            [r.user_id for r in await db.get_xp_leaderboard("week")],
+        )
+
+    clan, everyone = run(scenario())
+    assert clan == [("b", 9), ("a", 5)]
+    assert everyone == ["c", "b", "a"]
@@ -0,0 +1,109 @@
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Small in-process LRU cache with a per-entry TTL.
+    Not shared between bot processes, so keep TTLs short for anything another process may change.
+    """
+
+    def __init__(self, maxsize: int = 10_000, ttl: float = 120.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()   # key -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0,
+        }
+
+
+class VersionedCache:
+    """
+    Per-key cache invalidated by version bumps instead of explicit deletes.
+    Writers call bump(key) after changing the underlying data. Readers take version(key)
+    *before* loading and store the value under it, so a load that raced with a write is
+    never served. The version is also a cheap "did anything change?" token for derived caches.
+
+    Versions come from one monotonic clock and are kept for at most `maxsize` recently bumped keys;
+    forgetting a key raises the floor that unknown keys report, so a version never repeats and a
+    load started before the eviction is still rejected.
+    Like TTLCache this lives in one process: bumps made by another bot process aren't seen here,
+    so with several processes the TTL is the only bound on staleness.
+    """
+
+    def __init__(self, maxsize: int = 10_000, ttl: float = 120.0):
+        self.maxsize = maxsize
+        self._versions: OrderedDict = OrderedDict()   # key -> version of its last bump
+        self._clock = 0
+        self._floor = 0
+        self._entries = TTLCache(maxsize, ttl)   # key -> (version, value)
+        self.hits = 0
+        self.misses = 0
+
+    def version(self, key) -> int:
+        return self._versions.get(key, self._floor)
+
+    def bump(self, key):
+        self._clock += 1
+        self._versions[key] = self._clock
+        self._versions.move_to_end(key)
+        while len(self._versions) > self.maxsize:
+            _, forgotten = self._versions.popitem(last=False)
+            self._floor = max(self._floor, forgotten)
+        self._entries.invalidate(key)
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != self.version(key):
+            self.misses += 1
+            return default
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, version: int):
+        if version == self.version(key):
+            self._entries.set(key, (version, value))
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "versions": len(self._versions),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0,
+        }
@@ -0,0 +1,95 @@
+import asyncio
+import time
+from bisect import bisect_left
+from collections import namedtuple
+
+LeaderRow = namedtuple("LeaderRow", "user_id name extra_title xp")
+
+
+class LeaderboardSnapshot:
+    """
+    In-memory copy of the user leaderboard (rows sorted by xp desc), refreshed lazily when older
+    than `ttl` or after a large XP change (note_xp). Rank lookups bisect the snapshot instead of
+    counting everyone above the user, so the screens never scan the users table.
+    Small XP changes are tolerated until the next refresh; callers pass the user's live xp, so
+    the user's *own* rank is always current relative to the snapshot.
+    """
+
+    def __init__(self, loader, ttl: float = 300.0, jump_xp: int = 50):
+        self._loader = loader        # async () -> [LeaderRow] sorted by xp desc
+        self.ttl = ttl
+        self.jump_xp = jump_xp
+        self.rows: list[LeaderRow] = []
+        self._neg_xp: list[int] = []   # -xp per row, ascending -> bisectable
+        self._pos: dict[str, int] = {}
+        self._built_at = 0.0
+        self._dirty = True
+        self._lock = asyncio.Lock()
+        self.refreshes = 0
+
+    def note_xp(self, user_id: str, delta: int):
+        if abs(int(delta or 0)) >= self.jump_xp:
+            self._dirty = True
+
+    def invalidate(self):
+        self._dirty = True
+
+    async def fresh(self) -> "LeaderboardSnapshot":
+        if self._dirty or time.monotonic() - self._built_at > self.ttl:
+            async with self._lock:
+                if self._dirty or time.monotonic() - self._built_at > self.ttl:
+                    self._dirty = False
+                    rows = await self._loader()
+                    self.rows = rows
+                    self._neg_xp = [-int(r.xp or 0) for r in rows]
+                    self._pos = {r.user_id: i for i, r in enumerate(rows)}
+                    self._built_at = time.monotonic()
+                    self.refreshes += 1
+        return self
+
+    def top(self, n: int = 10) -> list[LeaderRow]:
+        return self.rows[:n]
+
+    def total(self, user_id: str) -> int:
+        return len(self.rows) + (0 if user_id in self._pos else 1)
+
+    def rank(self, user_id: str, xp: int) -> int:
+        """1 + number of other users with more XP (ties share a rank)."""
+        xp = int(xp or 0)
+        above = bisect_left(self._neg_xp, -xp)
+        pos = self._pos.get(user_id)
+        if pos is not None and pos < above:
+            above -= 1   # the user's own, older snapshot row
+        return above + 1
+
+    def _rank_row(self, row: LeaderRow, user_id: str, xp: int) -> int:
+        """rank() of another user's snapshot row, with `user_id` counted at their live `xp`."""
+        if row.user_id == user_id:
+            return self.rank(user_id, xp)
+        return self.rank(user_id, row.xp) + (1 if xp > int(row.xp or 0) else 0)
+
+    def top_ranked(self, user, n: int = 10) -> list[tuple[int, LeaderRow]]:
+        """[(rank, row)] for the top n rows, numbered like rank() (ties share a rank)."""
+        xp = int(user.xp or 0)
+        return [(self._rank_row(r, user.id, xp), r) for r in self.rows[:n]]
+
+    def around(self, user, k: int = 5) -> tuple[int, list[tuple[int, LeaderRow]]]:
+        """
+        (my_rank, [(rank, row)]) for up to k users either side of `user` (a User row, live xp),
+        with the user's own row included in place. Every position is a rank() (ties share it).
+        """
+        xp = int(user.xp or 0)
+        me = LeaderRow(user.id, user.name, user.extra_title, xp)
+        cut = bisect_left(self._neg_xp, -xp)
+        window = [r for r in self.rows[max(0, cut - k - 1):cut + k + 1] if r.user_id != user.id]
+        above = [r for r in window if (r.xp or 0) > xp][-k:]
+        below = [r for r in window if (r.xp or 0) <= xp][:k]
+        my_rank = self.rank(user.id, xp)
+        return my_rank, [(self._rank_row(r, user.id, xp), r) for r in above + [me] + below]
+
+    def stats(self) -> dict:
+        return {
+            "rows": len(self.rows),
+            "age": time.monotonic() - self._built_at if self._built_at else None,
+            "refreshes": self.refreshes,
+        }
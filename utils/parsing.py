@@ -47,6 +47,50 @@ def templates_menu() -> InlineKeyboardMarkup:
 
 
 
+DEADLINE_FMT = "%Y-%m-%d %H:%M"
+
+
+def deadline_str_to_dt(s: str, tz_name: str = "Asia/Tashkent") -> datetime | None:
+    """
+    Legacy Task.deadline string ('YYYY-MM-DD HH:MM', local time) -> tz-aware datetime.
+    Returns None for empty or malformed values.
+    """
+    if not s:
+        return None
+    try:
+        return pytz.timezone(tz_name).localize(datetime.strptime(s, DEADLINE_FMT))
+    except Exception:
+        return None
+
+
+def scope_bounds(scope: str, tz_name: str = "Asia/Tashkent") -> tuple[datetime, datetime] | None:
+    """
+    Inclusive [start, end] bounds of a list scope, for BETWEEN predicates.
+    today -> 00:00..23:59:59.999999 of today
+    week  -> Monday 00:00..Sunday end
+    month -> first day 00:00..last day end
+    Any other scope returns None (no date restriction).
+    """
+    tz = pytz.timezone(tz_name)
+    today = datetime.now(tz).date()
+    s = (scope or "").lower()
+
+    if s == "today":
+        first, last = today, today
+    elif s == "week":
+        first = today - timedelta(days=today.weekday())
+        last = first + timedelta(days=6)
+    elif s == "month":
+        first = today.replace(day=1)
+        last = today.replace(day=monthrange(today.year, today.month)[1])
+    else:
+        return None
+
+    start = tz.localize(datetime(first.year, first.month, first.day))
+    end = tz.localize(datetime(last.year, last.month, last.day, 23, 59, 59, 999999))
+    return start, end
+
+
 WEEKDAYS = {"mon": 0, "tue": 1, "wed": 2, "thu": 3, "fri": 4, "sat": 5, "sun": 6}
 PERIODS = {"morning": (9, 0), "afternoon": (14, 0), "evening": (19, 0), "night": (22, 0), "tonight": (22, 0)}
 
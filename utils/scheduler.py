@@ -0,0 +1,173 @@
+import asyncio
+import heapq
+from datetime import datetime, timedelta, timezone
+
+from utils.parsing import deadline_str_to_dt
+
+# Reminder schedule per task priority: lead times before the deadline, in firing order.
+# Stage i fires when Task.reminders_sent == i. Adding a stage costs no extra query:
+# the due set is always the one indexed scan over Task.next_reminder_at.
+REMINDER_SCHEDULES: dict[str, list[timedelta]] = {
+    "high":   [timedelta(hours=24), timedelta(hours=3), timedelta(hours=1), timedelta(minutes=10)],
+    "medium": [timedelta(hours=1), timedelta(minutes=10)],
+    "low":    [timedelta(hours=1)],
+}
+
+
+def reminder_stages(priority: str | None) -> list[timedelta]:
+    return REMINDER_SCHEDULES.get(priority or "medium", REMINDER_SCHEDULES["medium"])
+
+
+def reminder_label(lead: timedelta) -> str:
+    """'⏰ 24h to go' / '⏰ 1h to go' / '⚠️ 10m left'"""
+    minutes = int(lead.total_seconds() // 60)
+    if minutes >= 60:
+        return f"⏰ {minutes // 60}h to go"
+    return f"⚠️ {minutes}m left"
+
+
+def task_deadline_at(task) -> datetime | None:
+    """Typed deadline of a Task, falling back to the legacy string for un-backfilled rows."""
+    return getattr(task, "deadline_at", None) or deadline_str_to_dt(getattr(task, "deadline", "") or "")
+
+
+def stages_passed(deadline_at: datetime | None, priority: str | None, now: datetime | None = None) -> int:
+    """
+    reminders_sent for a task that switches to `priority`'s schedule: the number of its stages
+    whose fire time is already behind `now`. reminders_sent indexes into the schedule, so a
+    count carried over from another priority would skip stages or replay them.
+    """
+    if deadline_at is None:
+        return 0
+    now = now or datetime.now(timezone.utc)
+    return sum(1 for lead in reminder_stages(priority) if deadline_at - lead <= now)
+
+
+def next_reminder_at(deadline_at: datetime | None, reminders_sent: int, priority: str | None,
+                     now: datetime | None = None) -> datetime | None:
+    """
+    Fire time of the next unsent stage that is still ahead of `now`, or None when nothing is left.
+    Stages whose time already passed (e.g. a task added 30 min before its deadline) are skipped.
+    """
+    if deadline_at is None:
+        return None
+    now = now or datetime.now(timezone.utc)
+    for lead in reminder_stages(priority)[int(reminders_sent or 0):]:
+        if deadline_at - lead > now:
+            return deadline_at - lead
+    return None
+
+
+def due_stage(deadline_at: datetime | None, reminders_sent: int, priority: str | None,
+              now: datetime) -> int | None:
+    """
+    Latest stage whose fire time has passed, or None.
+    If we woke up late (e.g. after a restart) stale stages are skipped in favour of the latest one;
+    nothing is sent once the deadline itself is over.
+    """
+    if deadline_at is None or deadline_at <= now:
+        return None
+    stages = reminder_stages(priority)
+    stage = None
+    for i in range(int(reminders_sent or 0), len(stages)):
+        if deadline_at - stages[i] <= now:
+            stage = i
+    return stage
+
+
+class ReminderScheduler:
+    """
+    In-process min-heap of (Task.next_reminder_at, task_id).
+    Loaded once at startup, then kept in sync by the task helpers (schedule/cancel).
+    The reminder loop sleeps until the head entry is due, or until an earlier one is pushed.
+    Cancelled/rescheduled entries are dropped lazily when they reach the head.
+    """
+
+    # max_sleep bounds how long a reminder created by *another* bot process can go unnoticed
+    def __init__(self, max_sleep: float = 300.0):
+        self._heap: list[tuple[datetime, int]] = []
+        self._live: dict[int, datetime] = {}   # task_id -> current fire_at
+        self._wakeup = asyncio.Event()
+        self.max_sleep = max_sleep
+        # jitter accounting: lag = actual pop time - scheduled fire time
+        self.wakeups = 0
+        self.fired = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+
+    def __len__(self) -> int:
+        return len(self._live)
+
+    def schedule(self, task_id: int, fire_at: datetime | None):
+        if fire_at is None:
+            return self.cancel(task_id)
+        self._live[task_id] = fire_at
+        heapq.heappush(self._heap, (fire_at, task_id))
+        if self._heap[0] == (fire_at, task_id):
+            self._wakeup.set()   # new earliest entry: re-arm the sleeper
+        if len(self._heap) > 2 * len(self._live) + 1024:
+            self._compact()
+
+    def schedule_task(self, task):
+        self.schedule(task.id, task.next_reminder_at)
+
+    def cancel(self, task_id: int):
+        self._live.pop(task_id, None)
+
+    def clear(self):
+        self._heap.clear()
+        self._live.clear()
+
+    def _compact(self):
+        self._heap = [(at, tid) for tid, at in self._live.items()]
+        heapq.heapify(self._heap)
+
+    def _prune(self):
+        while self._heap and self._live.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def next_fire_at(self) -> datetime | None:
+        self._prune()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: datetime | None = None) -> list[int]:
+        """Remove and return ids of every entry with fire_at <= now."""
+        now = now or datetime.now(timezone.utc)
+        due = []
+        while True:
+            self._prune()
+            if not self._heap or self._heap[0][0] > now:
+                return due
+            fire_at, tid = heapq.heappop(self._heap)
+            del self._live[tid]
+            lag = max(0.0, (now - fire_at).total_seconds())
+            self.fired += 1
+            self.lag_total += lag
+            self.lag_max = max(self.lag_max, lag)
+            due.append(tid)
+
+    async def wait(self):
+        """Sleep until the earliest entry is due (capped at max_sleep), or until woken by schedule()."""
+        self._wakeup.clear()
+        head = self.next_fire_at()
+        delay = self.max_sleep
+        if head is not None:
+            delay = min(delay, (head - datetime.now(timezone.utc)).total_seconds())
+        if delay > 0:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+        self.wakeups += 1
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self._live),
+            "wakeups": self.wakeups,
+            "fired": self.fired,
+            "lag_avg": (self.lag_total / self.fired) if self.fired else 0.0,
+            "lag_max": self.lag_max,
+        }
+
+
+reminder_scheduler = ReminderScheduler()
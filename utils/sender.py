@@ -0,0 +1,128 @@
+import asyncio
+import time
+
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNotFound, TelegramRetryAfter, TelegramUnauthorizedError,
+)
+
+# Telegram bot limits: ~30 msg/s overall, ~1 msg/s into the same private chat.
+GLOBAL_RATE   = 25.0
+PER_CHAT_RATE = 1.0
+
+# Errors a retry can't fix: the user blocked the bot, the chat is gone, the request itself is invalid.
+PERMANENT_ERRORS = (TelegramForbiddenError, TelegramNotFound, TelegramBadRequest, TelegramUnauthorizedError)
+
+SENT, TRANSIENT, PERMANENT = "sent", "transient", "permanent"
+
+
+class TokenBucket:
+    """Classic token bucket; `pause()` blocks every acquirer (used for RetryAfter)."""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def pause(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            self._refill(now)
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return
+            await asyncio.sleep((1.0 - self.tokens) / self.rate)
+
+
+class RateLimitedSender:
+    """
+    Bounded-concurrency bot.send_message fan-out.
+    Each send waits for its chat's bucket, then a concurrency slot, then the global bucket.
+    RetryAfter pauses the global bucket for the requested time and the message is retried.
+    """
+
+    def __init__(self, bot, global_rate: float = GLOBAL_RATE, per_chat_rate: float = PER_CHAT_RATE,
+                 concurrency: int = 20, max_retries: int = 3):
+        self.bot = bot
+        self.per_chat_rate = per_chat_rate
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate)
+        self._chats: dict[str, TokenBucket] = {}
+        self._slots = asyncio.Semaphore(concurrency)
+        self.last_report: dict = {}
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        key = str(chat_id)
+        b = self._chats.get(key)
+        if b is None:
+            b = self._chats[key] = TokenBucket(self.per_chat_rate, capacity=1.0)
+        return b
+
+    def _prune_chats(self):
+        # a bucket that has been idle long enough is full again -> no need to keep it
+        now = time.monotonic()
+        idle = 1.0 / self.per_chat_rate
+        self._chats = {k: b for k, b in self._chats.items() if now - b.updated < idle or now < b.blocked_until}
+
+    async def _send_one(self, chat_id, text: str, stats: dict) -> str:
+        """SENT, or TRANSIENT (worth retrying later) / PERMANENT (drop it) on failure."""
+        await self._chat_bucket(chat_id).acquire()
+        outcome = TRANSIENT   # RetryAfter on every attempt
+        async with self._slots:
+            for _ in range(self.max_retries + 1):
+                await self._global.acquire()
+                try:
+                    await self.bot.send_message(chat_id, text)
+                    stats["sent"] += 1
+                    return SENT
+                except TelegramRetryAfter as e:
+                    stats["retried"] += 1
+                    self._global.pause(e.retry_after)
+                except PERMANENT_ERRORS:
+                    outcome = PERMANENT
+                    break
+                except Exception:
+                    break   # network/server trouble
+        stats["failed"] += 1
+        if outcome == PERMANENT:
+            stats["dropped"] += 1
+        return outcome
+
+    async def send_many(self, messages: list[tuple]) -> tuple[list, list]:
+        """
+        messages: [(key, chat_id, text)]. Returns (delivered keys, keys that failed permanently);
+        keys in neither list failed transiently. Throughput of the call is kept in `last_report`.
+        """
+        stats = {"sent": 0, "failed": 0, "dropped": 0, "retried": 0}
+        started = time.monotonic()
+        results = await asyncio.gather(*(self._send_one(chat_id, text, stats) for _, chat_id, text in messages))
+        elapsed = time.monotonic() - started
+        self._prune_chats()
+
+        stats["total"] = len(messages)
+        stats["elapsed"] = elapsed
+        stats["per_sec"] = (stats["sent"] / elapsed) if elapsed > 0 else 0.0
+        self.last_report = stats
+        delivered = [key for (key, _, _), res in zip(messages, results) if res == SENT]
+        dropped = [key for (key, _, _), res in zip(messages, results) if res == PERMANENT]
+        return delivered, dropped
+
+    def format_report(self) -> str:
+        r = self.last_report
+        if not r:
+            return "no sends yet"
+        return (f"sent {r['sent']}/{r['total']} • failed {r['failed']} ({r['dropped']} permanent)"
+                f" • retried {r['retried']}"
+                f" • {r['elapsed']:.1f}s ({r['per_sec']:.1f} msg/s)")
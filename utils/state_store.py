@@ -0,0 +1,163 @@
+import json
+import os
+import time
+from collections import OrderedDict
+
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
+
+# Conversation state ("which flow is this user in, and with what data") keyed by (namespace, user id).
+# Every entry has a TTL so abandoned flows are evicted instead of living for the life of the process.
+DEFAULT_TTL = 3600          # seconds
+DEFAULT_MAXSIZE = 100_000   # entries (memory backend)
+
+
+# Values are JSON (never pickle: a blob read back from a shared server must not be able to run code).
+# Sets round-trip through a tagged list; dict keys come back as strings.
+def _default(value):
+    if isinstance(value, (set, frozenset)):
+        return {"__set__": sorted(value)}
+    raise TypeError(f"state value of type {type(value).__name__} is not JSON-serializable")
+
+
+def _hook(obj: dict):
+    return set(obj["__set__"]) if obj.keys() == {"__set__"} else obj
+
+
+def dumps(value) -> bytes:
+    return json.dumps(value, default=_default, separators=(",", ":")).encode()
+
+
+def loads(blob: bytes):
+    return json.loads(blob, object_hook=_hook)
+
+
+class MemoryStateStore:
+    """
+    In-process backend: LRU-bounded OrderedDict with per-entry expiry.
+    Values are serialized on write (same semantics as the Redis backend: mutate, then set() again),
+    which also gives exact byte accounting.
+    """
+
+    def __init__(self, maxsize: int = DEFAULT_MAXSIZE, ttl: float = DEFAULT_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()   # (ns, key) -> (expires_at, blob)
+        self.bytes = 0
+        self.evicted = 0
+        self.expired = 0
+
+    def _drop(self, k):
+        _, blob = self._data.pop(k)
+        self.bytes -= len(blob)
+
+    def _live(self, k):
+        item = self._data.get(k)
+        if item is None:
+            return None
+        if item[0] < time.monotonic():
+            self._drop(k)
+            self.expired += 1
+            return None
+        self._data.move_to_end(k)
+        return item[1]
+
+    async def get(self, ns: str, key, default=None):
+        blob = self._live((ns, str(key)))
+        return default if blob is None else loads(blob)
+
+    async def has(self, ns: str, key) -> bool:
+        return self._live((ns, str(key))) is not None
+
+    async def set(self, ns: str, key, value=True, ttl: float | None = None):
+        k = (ns, str(key))
+        if k in self._data:
+            self._drop(k)
+        blob = dumps(value)
+        self._data[k] = (time.monotonic() + (ttl or self.ttl), blob)
+        self.bytes += len(blob)
+        while len(self._data) > self.maxsize:
+            self._drop(next(iter(self._data)))
+            self.evicted += 1
+
+    async def pop(self, ns: str, key, default=None):
+        k = (ns, str(key))
+        blob = self._live(k)
+        if blob is None:
+            return default
+        self._drop(k)
+        return loads(blob)
+
+    async def close(self):
+        pass
+
+    def sweep(self) -> int:
+        """Drop every expired entry now (lookups also expire lazily). Returns entries removed."""
+        now = time.monotonic()
+        dead = [k for k, (exp, _) in self._data.items() if exp < now]
+        for k in dead:
+            self._drop(k)
+        self.expired += len(dead)
+        return len(dead)
+
+    def stats(self) -> dict:
+        return {
+            "backend": "memory",
+            "entries": len(self._data),
+            "bytes": self.bytes,
+            "evicted": self.evicted,
+            "expired": self.expired,
+        }
+
+
+class RedisStateStore:
+    """
+    Redis backend over redis.asyncio. Commands draw from the client's connection pool, so
+    concurrent lookups run side by side instead of queueing behind one socket.
+    TTL is enforced by the server (SET ... PX); the size bound is the server's maxmemory policy,
+    e.g. `maxmemory-policy volatile-lru`.
+    """
+
+    def __init__(self, url: str, ttl: float = DEFAULT_TTL, prefix: str = "state"):
+        self._redis = aioredis.from_url(url)   # user/password/db come from the URL
+        self.ttl = ttl
+        self.prefix = prefix
+        self.commands = 0
+
+    def _k(self, ns: str, key) -> str:
+        return f"{self.prefix}:{ns}:{key}"
+
+    async def get(self, ns: str, key, default=None):
+        self.commands += 1
+        blob = await self._redis.get(self._k(ns, key))
+        return default if blob is None else loads(blob)
+
+    async def has(self, ns: str, key) -> bool:
+        self.commands += 1
+        return bool(await self._redis.exists(self._k(ns, key)))
+
+    async def set(self, ns: str, key, value=True, ttl: float | None = None):
+        self.commands += 1
+        await self._redis.set(self._k(ns, key), dumps(value), px=int((ttl or self.ttl) * 1000))
+
+    async def pop(self, ns: str, key, default=None):
+        self.commands += 1
+        blob = await self._redis.getdel(self._k(ns, key))   # Redis >= 6.2
+        return default if blob is None else loads(blob)
+
+    async def close(self):
+        await self._redis.aclose()
+
+    def sweep(self) -> int:
+        return 0   # the server expires keys itself
+
+    def stats(self) -> dict:
+        return {"backend": "redis", "commands": self.commands}
+
+
+def make_state_store():
+    """STATE_REDIS_URL=redis://[[user]:password@]host:port/db selects Redis; otherwise in-memory."""
+    url = os.getenv("STATE_REDIS_URL")
+    if url:
+        return RedisStateStore(url)
+    return MemoryStateStore()